@@ -0,0 +1,181 @@
+import argparse
+import sys
+import time
+
+import config
+import connection_manager
+import feedback_matrix
+import maintenance
+import migrations
+import sql_query
+
+
+def rebuild_aggregates(arguments):
+
+    """
+    Recompute the feedback aggregates from the raw feedback history
+    """
+
+    with connection_manager.transaction() as cursor:
+        count = sql_query.rebuild_feedback_aggregates(cursor)
+
+    print("Rebuilt", count, "feedback aggregates")
+
+
+def run_maintenance(arguments):
+
+    """
+    Remove the rows left by missing results and compact the database
+    """
+
+    report = maintenance.run_maintenance(arguments.vacuum_min_free)
+
+    print(
+        "Removed",
+        report["links_removed"],
+        "links and",
+        report["aggregates_removed"],
+        "feedback aggregates of missing rows",
+    )
+    print(
+        "Database vacuumed" if report["vacuumed"] else "Database not vacuumed",
+        "in",
+        report["seconds"],
+        "seconds",
+    )
+
+
+def import_feedbacks(arguments):
+
+    """
+    Import searches with their feedbacks from an NDJSON file in the format of /extract_all_feedbacks_stream
+    """
+
+    import main as api
+
+    importer = api.FeedbackImport(
+        arguments.conversation_id,
+        arguments.chunk_size or config.get_int("import_chunk_size"),
+    )
+
+    input_file = (
+        sys.stdin if arguments.path == "-" else open(arguments.path, encoding="utf-8")
+    )
+
+    try:
+        for line in input_file:
+            chunk = importer.add_line(line)
+            if chunk is not None:
+                importer.store(chunk)
+        importer.store(importer.take_chunk())
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+
+    report = importer.report()
+    print(
+        "Imported",
+        report["searches_imported"],
+        "searches and",
+        report["feedbacks_imported"],
+        "feedbacks",
+    )
+
+
+def export_matrix(arguments):
+
+    """
+    Write the feedback counts as a sparse matrix of searches x results in .npy files
+    """
+
+    start = time.perf_counter()
+    report = feedback_matrix.export_feedback_matrix(
+        arguments.directory, arguments.chunk_size
+    )
+
+    print(
+        "Exported",
+        report["entries"],
+        "feedback counts of",
+        report["queries"],
+        "searches and",
+        report["results"],
+        "results in",
+        round(time.perf_counter() - start, 3),
+        "seconds",
+    )
+
+
+def main():
+
+    """
+    Administration commands of the reranking database, run from the app directory:
+        python admin.py rebuild-aggregates
+        python admin.py maintenance [--chunk-size 500] [--vacuum-min-free 0.1]
+        python admin.py import feedbacks.ndjson [--conversation-id import] [--chunk-size 5000]
+        python admin.py export-matrix matrix/ [--chunk-size 10000]
+    """
+
+    parser = argparse.ArgumentParser(description="Reranking database administration")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser(
+        "rebuild-aggregates",
+        help="recompute the feedback_aggregate table from search_reranking_feedback",
+    ).set_defaults(function=rebuild_aggregates)
+
+    maintenance_parser = subparsers.add_parser(
+        "maintenance",
+        help="remove the links and aggregates of missing rows, then ANALYZE and VACUUM",
+    )
+    maintenance_parser.add_argument(
+        "--vacuum-min-free",
+        type=float,
+        default=None,
+        help="share of free pages above which the database is vacuumed, 1 to never vacuum",
+    )
+    maintenance_parser.set_defaults(function=run_maintenance)
+
+    import_parser = subparsers.add_parser(
+        "import",
+        help="import the searches and feedbacks of an NDJSON extraction (/extract_all_feedbacks_stream)",
+    )
+    import_parser.add_argument("path", help="NDJSON file to import, - to read stdin")
+    import_parser.add_argument(
+        "--conversation-id",
+        default="import",
+        help="conversation id of the searches imported without one",
+    )
+    import_parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="feedbacks stored per transaction, import_chunk_size by default",
+    )
+    import_parser.set_defaults(function=import_feedbacks)
+
+    export_parser = subparsers.add_parser(
+        "export-matrix",
+        help="write the chosen and ignored counts as a CSR matrix of searches x results in .npy files",
+    )
+    export_parser.add_argument(
+        "directory", help="directory of the files, created if missing"
+    )
+    export_parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="rows read from the database at a time, export_chunk_size by default",
+    )
+    export_parser.set_defaults(function=export_matrix)
+
+    arguments = parser.parse_args()
+
+    migrations.run_migrations()
+    arguments.function(arguments)
+
+    connection_manager.close_all_connections()
+
+
+if __name__ == "__main__":
+    main()
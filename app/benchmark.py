@@ -0,0 +1,684 @@
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import cache
+import connection_manager
+import log_writer
+import migrations
+import sql_query
+import storage
+
+# Sizes of the synthetic databases, any of them can be overridden on the command line
+presets = {
+    "10k": {
+        "searches": 1000,
+        "queries": 200,
+        "results": 2000,
+        "tags": 200,
+        "groups": 20,
+        "feedbacks": 10000,
+    },
+    "100k": {
+        "searches": 10000,
+        "queries": 2000,
+        "results": 20000,
+        "tags": 1000,
+        "groups": 50,
+        "feedbacks": 100000,
+    },
+    "1m": {
+        "searches": 100000,
+        "queries": 20000,
+        "results": 200000,
+        "tags": 5000,
+        "groups": 100,
+        "feedbacks": 1000000,
+    },
+}
+
+# Timings slower than the baseline by less than this are measurement noise
+noise_floor_ms = 0.05
+
+
+def synthetic_words(count, generator):
+
+    """
+    Output: list of count distinct lower case words
+    """
+
+    words = set()
+
+    while len(words) < count:
+        words.add(
+            "".join(
+                generator.choice("abcdefghijklmnopqrstuvwxyz")
+                for i in range(generator.randint(4, 10))
+            )
+        )
+
+    return sorted(words)
+
+
+def generate_database(sizes, seed=0):
+
+    """
+    Fill the empty database of connection_manager.database with synthetic searches, results, tags, groups
+    and feedbacks, in the schema of the last migration
+
+    Input:  sizes: dict of the number of searches, distinct queries, results, tags, groups and feedbacks
+            seed: seed of the random generator, the same seed gives the same database
+    """
+
+    generator = random.Random(seed)
+    words = synthetic_words(2000, generator)
+
+    tags = [
+        (i + 1, words[i % len(words)] + str(i), "datasud") for i in range(sizes["tags"])
+    ]
+    groups = [
+        (i + 1, "group" + str(i), " ".join(generator.sample(words, 5)), "datasud")
+        for i in range(sizes["groups"])
+    ]
+    queries = [
+        " ".join(generator.sample(words, generator.randint(1, 3)))
+        for i in range(sizes["queries"])
+    ]
+    owners = ["organisation" + str(i) for i in range(50)]
+
+    results = []
+    tag_links = []
+    group_links = []
+
+    for i in range(sizes["results"]):
+
+        result_tags = generator.sample(tags, min(len(tags), generator.randint(0, 5)))
+        result_groups = generator.sample(
+            groups, min(len(groups), generator.randint(0, 2))
+        )
+
+        metadata = [
+            " ".join(generator.sample(words, generator.randint(3, 6))),
+            "benchmark-" + str(i),
+            " ".join(generator.sample(words, 10)),
+            "datasud",
+            generator.choice(owners),
+        ] + [None] * (len(sql_query.attributes) - 5)
+
+        results.append(
+            [i + 1]
+            + metadata
+            + [
+                sql_query.compute_result_identity("datasud", metadata[1]),
+                sql_query.compute_result_fingerprint(
+                    metadata,
+                    [tag[1] for tag in result_tags],
+                    [(group[1], group[2]) for group in result_groups],
+                ),
+            ]
+        )
+        tag_links += [(i + 1, tag[0]) for tag in result_tags]
+        group_links += [(i + 1, group[0]) for group in result_groups]
+
+    searches = [
+        (
+            i + 1,
+            "benchmark-" + str(i),
+            generator.choice(queries),
+            "datasud",
+            "2021-07-02 10:36:11",
+        )
+        for i in range(sizes["searches"])
+    ]
+
+    feedbacks = [
+        (
+            generator.randint(1, sizes["searches"]),
+            generator.randint(0, 19),
+            generator.randint(0, 19),
+            generator.randint(1, sizes["results"]),
+            generator.choices([0, 1, -1], weights=[70, 15, 15])[0],
+            "feedback",
+            "datasud",
+        )
+        for i in range(sizes["feedbacks"])
+    ]
+
+    with connection_manager.transaction() as cursor:
+
+        cursor.executemany(
+            "INSERT INTO result_tag(id, name, portal) VALUES(?, ?, ?);", tags
+        )
+        cursor.executemany(
+            "INSERT INTO result_group(id, name, description, portal) VALUES(?, ?, ?, ?);",
+            groups,
+        )
+        cursor.executemany(
+            "INSERT INTO result(id, "
+            + ", ".join(sql_query.attributes)
+            + ", identity, fingerprint) VALUES("
+            + ", ".join(["?"] * (len(sql_query.attributes) + 3))
+            + ");",
+            results,
+        )
+        cursor.executemany(
+            "INSERT INTO link_results_tags(result_id, tag_id) VALUES(?, ?);", tag_links
+        )
+        cursor.executemany(
+            "INSERT INTO link_results_groups(result_id, group_id) VALUES(?, ?);",
+            group_links,
+        )
+        cursor.executemany(
+            "INSERT INTO search(id, conversation_id, user_search, portal, date) VALUES(?, ?, ?, ?, ?);",
+            searches,
+        )
+        cursor.executemany(
+            "INSERT INTO search_reranking_feedback(search_id, old_rank, new_rank, result_id, feedback, methods_used, origin_source) "
+            "VALUES(?, ?, ?, ?, ?, ?, ?);",
+            feedbacks,
+        )
+
+        sql_query.rebuild_feedback_aggregates(cursor)
+
+        cursor.execute("ANALYZE;")
+
+
+def load_results(cursor, result_ids):
+
+    """
+    Output: list of objects of type main.Result of the results of result_ids
+    """
+
+    import main as api
+
+    results = []
+
+    for result_id in result_ids:
+
+        row = cursor.execute(
+            "SELECT " + ", ".join(sql_query.attributes) + " FROM result WHERE id = ?;",
+            (result_id,),
+        ).fetchone()
+
+        result = dict(zip(sql_query.attributes, row))
+        result["tags"] = sql_query.get_result_tags_list(cursor, result_id)
+        result["groups"] = [
+            {"name": name, "description": description}
+            for name, description in sql_query.get_result_groups_list(cursor, result_id)
+        ]
+
+        results.append(api.Result(**result))
+
+    return results
+
+
+def time_operation(function, arguments_list, calls, warmup=3):
+
+    """
+    Input:  function: function timed
+            arguments_list: list of the arguments of the calls, used in turn
+            calls: number of calls timed
+            warmup: number of calls made before timing, to fill the sqlite page cache
+
+    Output: dict of the number of calls and of the median, 95th percentile and mean duration of a call in ms
+    """
+
+    for i in range(warmup):
+        function(*arguments_list[i % len(arguments_list)])
+
+    durations = []
+
+    for i in range(calls):
+        arguments = arguments_list[i % len(arguments_list)]
+        start = time.perf_counter()
+        function(*arguments)
+        durations.append((time.perf_counter() - start) * 1000)
+
+    durations.sort()
+
+    return {
+        "calls": calls,
+        "median_ms": round(statistics.median(durations), 4),
+        "p95_ms": round(
+            durations[min(len(durations) - 1, int(len(durations) * 0.95))], 4
+        ),
+        "mean_ms": round(statistics.mean(durations), 4),
+    }
+
+
+def without_cache(function):
+
+    """
+    Output: function emptying the feedback and response caches before each call, so that the database path is timed
+    """
+
+    def uncached(*arguments):
+        cache.feedback_counts.clear()
+        cache.responses.clear()
+        return function(*arguments)
+
+    return uncached
+
+
+def fill_memory_storage(memory_storage, page_size=500):
+
+    """
+    Copy the searches and feedbacks of the database of connection_manager.database into a MemoryStorage,
+    so that both backends are timed on the same data
+
+    Input:  memory_storage: object of type storage.MemoryStorage, empty
+            page_size: number of searches copied at a time
+    """
+
+    import main as api
+
+    sqlite_storage = storage.SqliteStorage()
+
+    with connection_manager.transaction() as cursor:
+        conversation_ids = dict(
+            cursor.execute("SELECT id, conversation_id FROM search;")
+        )
+
+    after_search_id = 0
+
+    while True:
+
+        page = sqlite_storage.get_feedback_extraction_page(after_search_id, page_size)
+        if len(page) == 0:
+            return
+
+        after_search_id = page[-1]["search_id"]
+
+        memory_storage.import_searches(
+            [
+                (
+                    conversation_ids[search["search_id"]],
+                    search["user_search"],
+                    search["search_target"],
+                    search["portal"],
+                    search["date"],
+                    [
+                        (
+                            api.parse_result(feedback["result"]),
+                            feedback["old_rank"],
+                            feedback["new_rank"],
+                            feedback["feedback"],
+                            feedback["methods_used"],
+                            feedback["origin_source"],
+                        )
+                        for feedback in search["feedbacks"]
+                    ],
+                )
+                for search in page
+            ]
+        )
+
+
+def load_samples(calls, list_size, seed=0):
+
+    """
+    Input:  calls, list_size, seed: see run_benchmarks
+
+    Output: list of (conversation_id, user_search, results_list) of searches and results of the database
+            of connection_manager.database, drawn at random
+    """
+
+    generator = random.Random(seed)
+
+    with connection_manager.transaction() as cursor:
+
+        searches = cursor.execute(
+            "SELECT conversation_id, user_search FROM search ORDER BY id;"
+        ).fetchall()
+        result_count = cursor.execute("SELECT MAX(id) FROM result;").fetchone()[0]
+
+        samples = []
+        for i in range(min(calls, 50)):
+            conversation_id, user_search = generator.choice(searches)
+            results_list = load_results(
+                cursor,
+                generator.sample(
+                    range(1, result_count + 1), min(list_size, result_count)
+                ),
+            )
+            samples.append((conversation_id, user_search, results_list))
+
+    return samples
+
+
+def run_benchmarks(samples, calls, seed=0):
+
+    """
+    Time the hot paths of the API on storage.backend
+
+    Input:  samples: searches and results reranked, see load_samples
+            calls: number of calls timed for each function, extract_feedbacks is called at most 5 times
+            seed: seed of the random generator choosing the feedbacks
+
+    Output: dict of function name -> timings, see time_operation
+    """
+
+    import main as api
+    import reranking
+
+    generator = random.Random(seed)
+
+    storage.backend.load_indexes()
+    cache.feedback_counts.clear()
+    cache.responses.clear()
+
+    timings = {}
+
+    timings["get_result_ids"] = time_operation(
+        storage.backend.get_result_ids,
+        [(results_list,) for c, s, results_list in samples],
+        calls,
+    )
+
+    # The feedback counts of a results list and of its similar searches, read together before scoring
+    timings["prefetch_feedback_counts"] = time_operation(
+        without_cache(
+            lambda user_search, results_list, identities: reranking.prefetch_feedback_counts(
+                [(user_search, results_list, identities)]
+            )
+        ),
+        [
+            (
+                user_search,
+                results_list,
+                [sql_query.result_identity(result) for result in results_list],
+            )
+            for c, user_search, results_list in samples
+        ],
+        calls,
+    )
+
+    timings["compute_feedback_score"] = time_operation(
+        without_cache(reranking.compute_feedback_score),
+        [(user_search, results_list[0]) for c, user_search, results_list in samples],
+        calls,
+    )
+
+    # A whole reranking from the lookup of the feedbacks to the queueing of its log, without the response cache
+    timings["rerank_with_etags"] = time_operation(
+        without_cache(
+            lambda *reranking_query: reranking.rerank_with_etags([reranking_query])
+        ),
+        [
+            (
+                conversation_id,
+                user_search,
+                [api.Results_List(api_hostname="datasud", results_list=results_list)],
+                True,
+                True,
+                None,
+                None,
+                True,
+            )
+            for conversation_id, user_search, results_list in samples
+        ],
+        calls,
+    )
+    log_writer.writer.flush()
+
+    # The rerankings of a batch of 10 searches, from their queueing to the end of their write.
+    # The writer doesn't wait flush_interval for more rerankings so that only the write is timed.
+    flush_interval, log_writer.writer.flush_interval = (
+        log_writer.writer.flush_interval,
+        0,
+    )
+    timings["log_writer_batch"] = time_operation(
+        lambda batch: (
+            log_writer.writer.submit_batch(batch),
+            log_writer.writer.flush(),
+        ),
+        [
+            (
+                [
+                    reranking.reranking_log(
+                        conversation_id,
+                        user_search,
+                        [
+                            (result, "datasud", i)
+                            for i, result in enumerate(results_list)
+                        ],
+                        1,
+                        0,
+                    )
+                    for conversation_id, user_search, results_list in (
+                        samples[i:] + samples[:i]
+                    )[:10]
+                ],
+            )
+            for i in range(len(samples))
+        ],
+        calls,
+    )
+    log_writer.writer.flush_interval = flush_interval
+
+    # Every call stores a new search target, which must be unique for its search
+    run_id = int(time.time())
+    timings["update_feedback"] = time_operation(
+        storage.backend.update_feedback,
+        [
+            (
+                conversation_id,
+                user_search,
+                "benchmark-{}-{}".format(run_id, i),
+                [
+                    api.Result_Feedback(
+                        result=result, feedback=generator.choice([1, -1])
+                    )
+                    for result in results_list[:3]
+                ],
+            )
+            for i, (conversation_id, user_search, results_list) in enumerate(
+                samples * (calls // len(samples) + 1)
+            )
+        ],
+        calls,
+        warmup=0,
+    )
+
+    timings["extract_feedbacks"] = time_operation(
+        storage.backend.extract_feedbacks, [()], min(calls, 5), warmup=1
+    )
+
+    return timings
+
+
+def compare_to_baseline(report, baseline, tolerance):
+
+    """
+    Input:  report: benchmark report, see main
+            baseline: previous report used as reference
+            tolerance: relative slowdown of the median accepted before flagging a regression
+
+    Output: list of the names of the functions slower than the baseline
+    """
+
+    regressions = []
+
+    if baseline.get("sizes") != report["sizes"]:
+        print(
+            "Baseline measured with other sizes", baseline.get("sizes"), "not compared"
+        )
+        return regressions
+
+    for name, timing in report["timings"].items():
+
+        reference = baseline["timings"].get(name)
+        if reference is None:
+            continue
+
+        slowdown = timing["median_ms"] - reference["median_ms"]
+        if slowdown > noise_floor_ms and timing["median_ms"] > reference[
+            "median_ms"
+        ] * (1 + tolerance):
+            regressions.append(name)
+
+    return regressions
+
+
+def print_report(report, baseline, regressions):
+
+    print(
+        "{:<34}{:>12}{:>12}{:>14}".format(
+            "function", "median ms", "p95 ms", "baseline ms"
+        )
+    )
+
+    for name, timing in report["timings"].items():
+
+        reference = (baseline or {}).get("timings", {}).get(name, {}).get("median_ms")
+
+        print(
+            "{:<34}{:>12.3f}{:>12.3f}{:>14}{}".format(
+                name,
+                timing["median_ms"],
+                timing["p95_ms"],
+                "-" if reference is None else "{:.3f}".format(reference),
+                "  REGRESSION" if name in regressions else "",
+            )
+        )
+
+
+def main():
+
+    """
+    Benchmark of the scoring and storage functions on a synthetic database, run from the app directory:
+        python benchmark.py --size 100k
+        python benchmark.py --size 100k --save-baseline
+    Exits with status 1 when a function is slower than the baseline.
+    """
+
+    parser = argparse.ArgumentParser(description="Reranking benchmark")
+    parser.add_argument("--size", choices=sorted(presets), default="10k")
+    for key in presets["10k"]:
+        parser.add_argument(
+            "--" + key, type=int, help="number of " + key + ", overrides --size"
+        )
+    parser.add_argument(
+        "--database",
+        default="data/benchmark.db",
+        help="synthetic database, generated again unless --keep-database",
+    )
+    parser.add_argument("--keep-database", action="store_true")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--list-size", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--backend",
+        choices=sorted(storage.backends) + ["all"],
+        default="all",
+        help="storage backend timed, the memory backend being filled from the synthetic database",
+    )
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="write the timings to the baseline file instead of comparing them",
+    )
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--output", help="also write the report to this json file")
+
+    arguments = parser.parse_args()
+
+    sizes = dict(presets[arguments.size])
+    for key in sizes:
+        if getattr(arguments, key) is not None:
+            sizes[key] = getattr(arguments, key)
+
+    # Every module reads the database path from connection_manager
+    database = Path(arguments.database)
+    connection_manager.database = str(database)
+    # The synthetic database is generated and upgraded through sqlite whatever the storage_backend of the config
+    storage.backend = storage.SqliteStorage()
+
+    import main as api
+
+    if not arguments.keep_database or not database.is_file():
+        for path in [
+            database,
+            Path(str(database) + "-wal"),
+            Path(str(database) + "-shm"),
+        ]:
+            if path.is_file():
+                path.unlink()
+        migrations.run_migrations()
+        start = time.perf_counter()
+        generate_database(sizes, arguments.seed)
+        print("Generated", sizes, "in", round(time.perf_counter() - start, 1), "s")
+
+    api.upgrade_database()
+
+    backends = (
+        sorted(storage.backends) if arguments.backend == "all" else [arguments.backend]
+    )
+    timings = {}
+
+    try:
+
+        samples = load_samples(arguments.calls, arguments.list_size, arguments.seed)
+
+        for name in backends:
+
+            if name == "sqlite":
+                storage.backend = storage.SqliteStorage()
+            else:
+                start = time.perf_counter()
+                storage.backend = storage.backends[name]()
+                fill_memory_storage(storage.backend)
+                print(
+                    "Loaded the",
+                    name,
+                    "storage in",
+                    round(time.perf_counter() - start, 1),
+                    "s",
+                )
+
+            # The timings of each backend are reported as backend.function
+            for function, timing in run_benchmarks(
+                samples, arguments.calls, arguments.seed
+            ).items():
+                timings[name + "." + function] = timing
+
+        report = {
+            "sizes": sizes,
+            "calls": arguments.calls,
+            "list_size": arguments.list_size,
+            "timings": timings,
+        }
+
+    finally:
+        api.close_database()
+
+    baseline = None
+    regressions = []
+
+    if not arguments.save_baseline and Path(arguments.baseline).is_file():
+        with open(arguments.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_to_baseline(report, baseline, arguments.tolerance)
+
+    print_report(report, baseline, regressions)
+
+    for path in [arguments.output] + (
+        [arguments.baseline] if arguments.save_baseline else []
+    ):
+        if path:
+            with open(path, "w", encoding="utf-8") as report_file:
+                json.dump(report, report_file, indent=4)
+            print("Report written to", path)
+
+    if len(regressions) > 0:
+        print("Regressions:", ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
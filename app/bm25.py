@@ -0,0 +1,246 @@
+import threading
+
+import numpy as np
+
+import config
+import sql_query
+
+
+def result_fields(title, description, tags, groups):
+
+    """
+    Input:  title, description: texts of the result
+            tags: list of tag names
+            groups: list of (name, description) of the groups
+
+    Output: dict of field -> text of the result indexed by BM25
+    """
+
+    return {
+        "title": title or "",
+        "description": description or "",
+        "tags": " ".join(tags),
+        "groups": " ".join(
+            name + " " + (description or "") for name, description in groups
+        ),
+    }
+
+
+def fields_of_result(result):
+
+    """
+    Input:  result: object of type main.Result
+
+    Output: dict of field -> text of the result indexed by BM25
+    """
+
+    return result_fields(
+        result.title,
+        result.description,
+        result.tags or [],
+        [(group.name, group.description) for group in result.groups or []],
+    )
+
+
+class BM25Index:
+
+    """
+    Inverted index of the words of the results stored in the database, with the statistics used by BM25:
+    number of results, length of each result and weighted frequency of each word in each result.
+    The frequency of a word sums its occurrences in every field of the result multiplied by the field weight.
+    """
+
+    def __init__(self, k1, b, field_weights):
+
+        """
+        Input:  k1: saturation of the word frequencies
+                b: normalization of the frequencies by the length of the result, from 0 (none) to 1 (full)
+                field_weights: dict of field -> weight of its words, missing fields weigh 1
+        """
+
+        self.lock = threading.Lock()
+        self.k1 = k1
+        self.b = b
+        self.field_weights = field_weights
+        self.clear()
+
+    def clear(self):
+
+        self.document_ids = {}  # result identity -> document
+        self.document_words = []  # document -> words of the result
+        self.document_lengths = []  # document -> weighted number of words of the result
+        self.total_length = 0.0
+        self.postings = {}  # word -> {document: weighted frequency}
+
+    def word_frequencies(self, fields):
+
+        """
+        Input:  fields: dict of field -> text, see result_fields
+
+        Output: (dict of word -> weighted frequency, weighted number of words)
+        """
+
+        frequencies = {}
+
+        for field, text in fields.items():
+            weight = self.field_weights.get(field, 1.0)
+            for word in sql_query.search_words(text):
+                frequencies[word] = frequencies.get(word, 0) + weight
+
+        return frequencies, sum(frequencies.values())
+
+    def load(self, cursor):
+
+        """
+        Replace the index by the results of the database
+
+        Input:  cursor: connection to database
+        """
+
+        tags = {}
+        for result_id, name in cursor.execute(
+            "SELECT lt.result_id, t.name FROM link_results_tags AS lt JOIN result_tag AS t ON t.id = lt.tag_id;"
+        ):
+            tags.setdefault(result_id, []).append(name)
+
+        groups = {}
+        for result_id, name, description in cursor.execute(
+            "SELECT lg.result_id, g.name, g.description FROM link_results_groups AS lg "
+            "JOIN result_group AS g ON g.id = lg.group_id;"
+        ):
+            groups.setdefault(result_id, []).append((name, description))
+
+        self.replace(
+            [
+                (
+                    identity,
+                    result_fields(
+                        title,
+                        description,
+                        tags.get(result_id, []),
+                        groups.get(result_id, []),
+                    ),
+                )
+                for result_id, identity, title, description in cursor.execute(
+                    "SELECT id, identity, title, description FROM result WHERE identity IS NOT NULL;"
+                )
+            ]
+        )
+
+    def replace(self, documents):
+
+        """
+        Replace the index by a list of results
+
+        Input:  documents: list of (result identity, fields of the result), see result_fields
+        """
+
+        documents = [
+            (identity, self.word_frequencies(fields)) for identity, fields in documents
+        ]
+
+        with self.lock:
+            self.clear()
+            for identity, (frequencies, length) in documents:
+                self.store(identity, frequencies, length)
+
+    def add(self, result):
+
+        """
+        Index a result inserted or updated in the database, replacing its previous version
+
+        Input:  result: object of type main.Result
+        """
+
+        frequencies, length = self.word_frequencies(fields_of_result(result))
+
+        with self.lock:
+            self.store(sql_query.result_identity(result), frequencies, length)
+
+    def store(self, identity, frequencies, length):
+
+        document = self.document_ids.get(identity)
+
+        if document is None:
+            document = len(self.document_lengths)
+            self.document_ids[identity] = document
+            self.document_words.append(())
+            self.document_lengths.append(0.0)
+        else:
+            for word in self.document_words[document]:
+                del self.postings[word][document]
+
+        for word, frequency in frequencies.items():
+            if word not in self.postings:
+                self.postings[word] = {}
+            self.postings[word][document] = frequency
+
+        self.total_length += length - self.document_lengths[document]
+        self.document_words[document] = tuple(frequencies)
+        self.document_lengths[document] = length
+
+    def scores(self, search, results_list, identities=None):
+
+        """
+        Compute the BM25 score of each result for a search
+
+        Input:  search: search entered by the user
+                results_list: list of objects of type main.Result
+                identities: sql_query.result_identity of each result, computed if not given
+
+        Output: vector of the BM25 scores divided by the best one, so that the best result scores 1.
+                Results not indexed yet are scored from their own text with the statistics of the index.
+        """
+
+        words = list(dict.fromkeys(sql_query.search_words(search)))
+        frequencies = np.zeros((len(results_list), len(words)))
+        lengths = np.zeros(len(results_list))
+
+        if len(words) == 0 or len(results_list) == 0:
+            return lengths
+
+        if identities is None:
+            identities = [sql_query.result_identity(result) for result in results_list]
+
+        with self.lock:
+
+            document_count = len(self.document_lengths)
+            average_length = self.total_length / max(document_count, 1) or 1.0
+
+            postings = [self.postings.get(word, {}) for word in words]
+            document_frequencies = np.array([len(posting) for posting in postings])
+
+            for i, (result, identity) in enumerate(zip(results_list, identities)):
+
+                document = self.document_ids.get(identity)
+
+                if document is not None:
+                    frequencies[i] = [posting.get(document, 0) for posting in postings]
+                    lengths[i] = self.document_lengths[document]
+                else:
+                    result_frequencies, lengths[i] = self.word_frequencies(
+                        fields_of_result(result)
+                    )
+                    frequencies[i] = [result_frequencies.get(word, 0) for word in words]
+
+        idf = np.log(
+            1
+            + (document_count - document_frequencies + 0.5)
+            / (document_frequencies + 0.5)
+        )
+        saturation = frequencies + self.k1 * (
+            1 - self.b + self.b * lengths[:, None] / average_length
+        )
+        scores = (idf * frequencies * (self.k1 + 1) / saturation).sum(axis=1)
+
+        if scores.max() > 0:
+            scores /= scores.max()
+
+        return scores
+
+
+index = BM25Index(
+    config.get_float("bm25_k1"),
+    config.get_float("bm25_b"),
+    config.get_weights("bm25_field_weights"),
+)
@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+missing = object()
+
+
+class LRUCache:
+
+    """
+    Bounded in-memory cache with least recently used eviction and an optional time to live.
+    Entries can be tagged with groups so that every entry of a group is invalidated at once.
+    """
+
+    def __init__(self, max_entries, ttl=0, clock=time.monotonic):
+
+        """
+        Input:  max_entries: number of entries kept before evicting the least recently used one
+                ttl: seconds an entry stays valid, 0 to keep entries until they are evicted
+                clock: function returning the current time in seconds, used for the ttl
+        """
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (value, expiration, groups)
+        self.groups = {}  # group -> set of keys
+        self.lock = threading.Lock()
+        self.invalidations = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=missing):
+
+        """
+        Output: value of the key, default if it is not cached or expired
+        """
+
+        with self.lock:
+
+            entry = self.entries.get(key)
+
+            if entry is not None and (entry[1] is None or entry[1] > self.clock()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry is not None:
+                self.remove(key)
+
+            self.misses += 1
+            return default
+
+    def version(self):
+
+        """
+        Output: number of invalidations so far, to give to set when the value was read before a possible write
+        """
+
+        return self.invalidations
+
+    def set(self, key, value, groups=(), version=None):
+
+        """
+        Input:  key, value: entry to cache
+                groups: groups the entry belongs to
+                version: result of version() taken before computing value, the value is not cached
+                         if an invalidation happened since as it may be stale
+        """
+
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+
+            if version is not None and version != self.invalidations:
+                return
+
+            if key in self.entries:
+                self.remove(key)
+
+            expiration = self.clock() + self.ttl if self.ttl > 0 else None
+            self.entries[key] = (value, expiration, tuple(groups))
+
+            for group in groups:
+                self.groups.setdefault(group, set()).add(key)
+
+            while len(self.entries) > self.max_entries:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+
+        """
+        Remove an entry, the lock must be held by the caller
+        """
+
+        value, expiration, groups = self.entries.pop(key)
+
+        for group in groups:
+            keys = self.groups.get(group)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.groups[group]
+
+    def invalidate_groups(self, groups):
+
+        """
+        Remove every entry belonging to one of the groups
+
+        Output: number of entries removed
+        """
+
+        removed = 0
+
+        with self.lock:
+
+            self.invalidations += 1
+
+            for group in groups:
+                for key in list(self.groups.get(group, ())):
+                    self.remove(key)
+                    removed += 1
+
+        return removed
+
+    def update_groups(self, groups, function):
+
+        """
+        Replace the value of every entry belonging to one of the groups by function(value),
+        used to apply a write to the cached values instead of dropping them
+
+        Output: number of entries updated
+        """
+
+        updated = 0
+
+        with self.lock:
+
+            self.invalidations += 1
+
+            for group in groups:
+                for key in self.groups.get(group, ()):
+                    value, expiration, key_groups = self.entries[key]
+                    self.entries[key] = (function(value), expiration, key_groups)
+                    updated += 1
+
+        return updated
+
+    def clear(self):
+
+        with self.lock:
+            self.invalidations += 1
+            self.entries.clear()
+            self.groups.clear()
+
+    def stats(self):
+
+        """
+        Output: counters of the cache
+        """
+
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+# Feedback counts (chosen, ignored, total) of (normalized search, result identity, portal),
+# grouped by (normalized search, result identity). Writes of this process update or invalidate their entries,
+# the ttl bounds how long writes of other workers take to be seen.
+feedback_counts = LRUCache(
+    config.get_int("feedback_cache_size"), config.get_int("feedback_cache_ttl")
+)
+
+# Rerankings (etag, fused results) of the queries, see reranking.response_cache_key, grouped by the grams
+# of their normalized search, see query_index.response_groups. The searches, proposals and feedbacks stored
+# by this process invalidate them, the ttl bounds how long the writes of other workers take to change the ranking.
+responses = LRUCache(
+    config.get_int("response_cache_size"), config.get_int("response_cache_ttl")
+)
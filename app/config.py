@@ -0,0 +1,122 @@
+import os
+import shlex
+from pathlib import Path
+
+# Values used when a key is missing from api-config.config
+defaults = {
+    "storage_backend": "sqlite",
+    "database_path": "data/user_reranking_feedback.db",
+    "sqlite_cache_size": "-20000",
+    "sqlite_mmap_size": "268435456",
+    "sqlite_busy_timeout": "5000",
+    "database_threads": "8",
+    "feedback_cache_size": "50000",
+    "feedback_cache_ttl": "300",
+    "response_cache_size": "10000",
+    "response_cache_ttl": "30",
+    "log_queue_size": "10000",
+    "log_queue_policy": "block",
+    "log_queue_timeout": "1",
+    "log_batch_size": "200",
+    "log_flush_interval": "0.05",
+    "scoring_threads": "4",
+    "signal_weights": "feedback:1,metadata:1,lexical:0.5",
+    "metadata_compaction_size": "1000",
+    "metadata_refresh_interval": "600",
+    "feedback_half_life_days": "180",
+    "similar_searches_count": "5",
+    "similar_searches_min_similarity": "0.6",
+    "similar_searches_max_postings": "5000",
+    "similar_searches_cache_size": "10000",
+    "bm25_k1": "1.2",
+    "bm25_b": "0.75",
+    "bm25_field_weights": "title:2,description:1,tags:1.5,groups:1",
+    "fusion_strategy": "rrf",
+    "fusion_rrf_k": "60",
+    "fusion_source_weights": "",
+    "metrics_enabled": "true",
+    "import_chunk_size": "5000",
+    "export_chunk_size": "10000",
+    "maintenance_vacuum_min_free": "0.1",
+}
+
+# api-config.config sits next to the app directory when running locally, and is copied inside it in the docker image
+config_paths = [
+    Path(__file__).resolve().parent.parent / "api-config.config",
+    Path(__file__).resolve().parent / "api-config.config",
+]
+
+
+def read_config_file(path):
+
+    """
+    Input:  path: path of a configuration file written as shell variable assignments (key="value")
+
+    Output: dict of the values of the file
+    """
+
+    values = {}
+
+    with open(path, encoding="utf-8") as config_file:
+        for line in config_file:
+            tokens = shlex.split(line, comments=True)
+            if len(tokens) > 0 and "=" in tokens[0]:
+                key, value = tokens[0].split("=", 1)
+                values[key] = value
+
+    return values
+
+
+def load_config():
+
+    """
+    Output: configuration of the API, read from the file given by the RERANKING_CONFIG environment variable
+            or from api-config.config, completed with the default values
+    """
+
+    values = dict(defaults)
+
+    paths = config_paths
+    if os.environ.get("RERANKING_CONFIG"):
+        paths = [Path(os.environ["RERANKING_CONFIG"])]
+
+    for path in paths:
+        if path.is_file():
+            values.update(read_config_file(path))
+            break
+
+    return values
+
+
+values = load_config()
+
+
+def get_str(key):
+
+    return values[key]
+
+
+def get_int(key):
+
+    return int(values[key])
+
+
+def get_float(key):
+
+    return float(values[key])
+
+
+def get_weights(key):
+
+    """
+    Output: dict of the weights written as "name:weight,name:weight" for the key
+    """
+
+    weights = {}
+
+    for item in values[key].split(","):
+        if ":" in item:
+            name, weight = item.rsplit(":", 1)
+            weights[name.strip()] = float(weight)
+
+    return weights
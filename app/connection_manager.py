@@ -0,0 +1,112 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import config
+
+database = config.get_str("database_path")
+
+thread_data = threading.local()
+
+# Every connection handed to a thread, so that they can all be closed when the API stops
+open_connections = []
+open_connections_lock = threading.Lock()
+# Functions called when a transaction is rolled back, to drop in-memory state built from its writes
+rollback_callbacks = []
+# (name, number of arguments, function) of the python functions used by the SQL queries, added to every connection
+sql_functions = []
+
+# Incremented when the connections are closed, threads then open a new one on their next request
+generation = 0
+
+
+def connect(**kwargs):
+
+    """
+    Open a new connection to the database with the pragmas of api-config.config
+
+    Input:  kwargs: extra arguments given to sqlite3.connect
+
+    Output: sqlite3 connection
+    """
+
+    sqliteConnection = sqlite3.connect(
+        database,
+        timeout=config.get_int("sqlite_busy_timeout") / 1000,
+        check_same_thread=False,
+        **kwargs
+    )
+
+    sqliteConnection.execute("PRAGMA journal_mode = WAL;")
+    sqliteConnection.execute("PRAGMA synchronous = NORMAL;")
+    sqliteConnection.execute(
+        "PRAGMA cache_size = {};".format(config.get_int("sqlite_cache_size"))
+    )
+    sqliteConnection.execute(
+        "PRAGMA mmap_size = {};".format(config.get_int("sqlite_mmap_size"))
+    )
+    sqliteConnection.execute(
+        "PRAGMA busy_timeout = {};".format(config.get_int("sqlite_busy_timeout"))
+    )
+
+    for name, arguments_count, function in sql_functions:
+        sqliteConnection.create_function(name, arguments_count, function)
+
+    return sqliteConnection
+
+
+def get_connection():
+
+    """
+    Output: connection of the current thread, opened on its first call and reused afterwards
+    """
+
+    if getattr(thread_data, "generation", None) != generation:
+
+        sqliteConnection = connect()
+
+        with open_connections_lock:
+            open_connections.append(sqliteConnection)
+
+        thread_data.connection = sqliteConnection
+        thread_data.generation = generation
+
+    return thread_data.connection
+
+
+@contextmanager
+def transaction():
+
+    """
+    Give a cursor on the connection of the current thread,
+    commit when the block ends and rollback if it raises an exception
+    """
+
+    sqliteConnection = get_connection()
+    cursor = sqliteConnection.cursor()
+
+    try:
+        yield cursor
+        sqliteConnection.commit()
+    except BaseException:
+        sqliteConnection.rollback()
+        for callback in rollback_callbacks:
+            callback()
+        raise
+    finally:
+        cursor.close()
+
+
+def close_all_connections():
+
+    """
+    Close every connection opened by get_connection
+    """
+
+    global generation
+
+    with open_connections_lock:
+        generation += 1
+        for sqliteConnection in open_connections:
+            sqliteConnection.close()
+        open_connections.clear()
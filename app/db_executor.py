@@ -0,0 +1,58 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+# Bounded pool of threads running the blocking database work of the endpoints,
+# each thread keeps its own connection through connection_manager
+executor = None
+
+
+def get_executor():
+
+    """
+    Output: thread pool of the database work, started on its first use
+    """
+
+    global executor
+
+    if executor is None:
+        executor = ThreadPoolExecutor(
+            max_workers=config.get_int("database_threads"),
+            thread_name_prefix="database",
+        )
+
+    return executor
+
+
+async def run(function, *args, **kwargs):
+
+    """
+    Run a blocking function in the database thread pool without blocking the event loop
+
+    Input:  function: function to call, followed by its arguments
+
+    Output: value returned by the function
+    """
+
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(context.run, function, *args, **kwargs)
+    )
+
+
+def shutdown():
+
+    """
+    Wait for the running database work to finish and stop the threads
+    """
+
+    global executor
+
+    if executor is not None:
+        executor.shutdown(wait=True)
+        executor = None
@@ -0,0 +1,238 @@
+import json
+import sqlite3
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+import config
+import connection_manager
+
+# Counts of every (normalized search, result) having at least one chosen or ignored feedback,
+# read in the order of the primary key of feedback_aggregate so that SQLite streams them without sorting
+sqlite_matrix_entries_query = (
+    "SELECT user_search, result_id, SUM(chosen), SUM(ignored) FROM feedback_aggregate "
+    "WHERE result_id IN (SELECT id FROM result) "
+    "GROUP BY user_search, result_id HAVING SUM(chosen) > 0 OR SUM(ignored) > 0 "
+    "ORDER BY user_search, result_id"
+)
+
+
+def fetch_chunks(cursor, sql_command, chunk_size):
+
+    """
+    Input:  cursor: connection to database
+            sql_command: query to run
+            chunk_size: number of rows fetched at a time
+
+    Output: generator of the lists of rows of the query, the query being run at the first iteration
+    """
+
+    cursor.execute(sql_command)
+
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if len(rows) == 0:
+            return
+        yield rows
+
+
+def write_feedback_matrix(directory, shape, entry_count, result_chunks, entry_chunks):
+
+    """
+    Write the feedback counts as a CSR sparse matrix of normalized searches x results, in .npy files
+    that can be opened without copy by np.load(path, mmap_mode="r"):
+        indptr.npy:     int64, entries of row i are at indptr[i]:indptr[i + 1]
+        indices.npy:    int32, column of each entry
+        chosen.npy:     int32, number of times the result was chosen for the search
+        ignored.npy:    int32, number of times the result was ignored for the search
+        result_ids.npy: int64, id in the database of the result of each column
+        queries.ndjson: normalized search of each row, one JSON string per line
+        results.ndjson: {"id", "portal", "url"} of the result of each column, one per line
+        matrix.json:    shape of the matrix, number of entries and date of the export
+    The arrays are filled chunk by chunk, the matrix is never held in memory.
+
+    Input:  directory: directory of the files, created if missing
+            shape: (number of rows, number of results)
+            entry_count: number of entries of the matrix
+            result_chunks: iterable of lists of (result id, portal, url), ordered by id
+            entry_chunks: iterable of lists of (normalized search, result id, chosen, ignored),
+                          ordered by search then result id
+
+    Output: dict with the number of queries, results and entries written
+    """
+
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+
+    query_count, result_count = shape
+
+    result_ids = np.lib.format.open_memmap(
+        path / "result_ids.npy", mode="w+", dtype=np.int64, shape=(result_count,)
+    )
+    indptr = np.lib.format.open_memmap(
+        path / "indptr.npy", mode="w+", dtype=np.int64, shape=(query_count + 1,)
+    )
+    indices, chosen, ignored = [
+        np.lib.format.open_memmap(
+            path / name, mode="w+", dtype=np.int32, shape=(entry_count,)
+        )
+        for name in ["indices.npy", "chosen.npy", "ignored.npy"]
+    ]
+
+    position = 0
+
+    with open(path / "results.ndjson", "w", encoding="utf-8") as results_file:
+        for rows in result_chunks:
+            result_ids[position : position + len(rows)] = [row[0] for row in rows]
+            position += len(rows)
+            results_file.writelines(
+                json.dumps({"id": row[0], "portal": row[1], "url": row[2]}) + "\n"
+                for row in rows
+            )
+
+    if position != result_count:
+        raise ValueError("Got {} results for {} columns".format(position, result_count))
+
+    row = 0
+    position = 0
+    previous_search = None
+
+    with open(path / "queries.ndjson", "w", encoding="utf-8") as queries_file:
+        for entries in entry_chunks:
+
+            if position + len(entries) > entry_count:
+                raise ValueError("Got more than {} entries".format(entry_count))
+
+            starts = []
+            for offset, entry in enumerate(entries):
+                if entry[0] != previous_search:
+                    starts.append(position + offset)
+                    queries_file.write(json.dumps(entry[0]) + "\n")
+                    previous_search = entry[0]
+
+            if row + len(starts) > query_count:
+                raise ValueError("Got more than {} searches".format(query_count))
+
+            indptr[row : row + len(starts)] = starts
+            row += len(starts)
+
+            entry_ids = np.asarray([entry[1] for entry in entries], dtype=np.int64)
+            columns = np.searchsorted(result_ids, entry_ids)
+            if np.any(
+                result_ids[np.minimum(columns, max(result_count - 1, 0))] != entry_ids
+            ):
+                raise ValueError("Got an entry for a result missing from the results")
+
+            end = position + len(entries)
+            indices[position:end] = columns
+            chosen[position:end] = [entry[2] for entry in entries]
+            ignored[position:end] = [entry[3] for entry in entries]
+            position = end
+
+    if (row, position) != (query_count, entry_count):
+        raise ValueError(
+            "Got {} searches and {} entries for a matrix of {} and {}".format(
+                row, position, query_count, entry_count
+            )
+        )
+
+    indptr[row] = position
+
+    for array in [result_ids, indptr, indices, chosen, ignored]:
+        array.flush()
+
+    with open(path / "matrix.json", "w", encoding="utf-8") as manifest_file:
+        json.dump(
+            {
+                "shape": [query_count, result_count],
+                "entries": entry_count,
+                "exported_at": datetime.now(timezone.utc).isoformat(),
+            },
+            manifest_file,
+        )
+
+    return {"queries": query_count, "results": result_count, "entries": entry_count}
+
+
+def export_feedback_matrix(directory, chunk_size=None):
+
+    """
+    Export the counts of the feedback_aggregate table as a CSR matrix, see write_feedback_matrix.
+    The rows are read chunk_size at a time from a single read transaction, so that the export sees
+    one snapshot of the database while the API keeps writing.
+
+    Input:  directory: directory of the files, created if missing
+            chunk_size: number of rows fetched at a time, export_chunk_size by default
+
+    Output: dict with the number of queries, results and entries written
+    """
+
+    if chunk_size is None:
+        chunk_size = config.get_int("export_chunk_size")
+    chunk_size = max(chunk_size, 1)
+
+    sqliteConnection = connection_manager.connect(isolation_level=None)
+    results_cursor = sqliteConnection.cursor()
+    entries_cursor = sqliteConnection.cursor()
+
+    try:
+
+        results_cursor.execute("BEGIN;")
+
+        result_count = results_cursor.execute(
+            "SELECT COUNT(*) FROM result;"
+        ).fetchone()[0]
+        query_count, entry_count = results_cursor.execute(
+            "SELECT COUNT(DISTINCT user_search), COUNT(*) FROM ("
+            + sqlite_matrix_entries_query
+            + ");"
+        ).fetchone()
+
+        report = write_feedback_matrix(
+            directory,
+            (query_count, result_count),
+            entry_count,
+            fetch_chunks(
+                results_cursor,
+                "SELECT id, portal, url FROM result ORDER BY id;",
+                chunk_size,
+            ),
+            fetch_chunks(entries_cursor, sqlite_matrix_entries_query + ";", chunk_size),
+        )
+
+        results_cursor.execute("COMMIT;")
+
+    except sqlite3.Error as error:
+        print("Failed to export the feedback matrix", error)
+        raise
+
+    finally:
+        results_cursor.close()
+        entries_cursor.close()
+        sqliteConnection.close()
+
+    return report
+
+
+def load_feedback_matrix(directory):
+
+    """
+    Input:  directory: directory written by write_feedback_matrix
+
+    Output: dict of the arrays of the matrix mapped read only from their files,
+            with the lists of its queries and results
+    """
+
+    path = Path(directory)
+
+    matrix = {
+        name: np.load(path / (name + ".npy"), mmap_mode="r")
+        for name in ["indptr", "indices", "chosen", "ignored", "result_ids"]
+    }
+
+    for name in ["queries", "results"]:
+        with open(path / (name + ".ndjson"), encoding="utf-8") as vocabulary_file:
+            matrix[name] = [json.loads(line) for line in vocabulary_file]
+
+    return matrix
@@ -0,0 +1,266 @@
+import queue
+import threading
+import time
+
+import config
+import metrics
+import storage
+
+stop_signal = object()
+
+
+class LogWriter:
+
+    """
+    Background writer of the reranking logs. Rerankings are queued by the requests and written by a single thread,
+    which groups the rerankings queued by concurrent requests in one transaction.
+    """
+
+    def __init__(self, max_size, policy, timeout, batch_size, flush_interval):
+
+        """
+        Input:  max_size: number of submissions (a reranking or a batch of rerankings) the queue holds
+                          before applying the backpressure policy
+                policy: "block" to make the request wait for space in the queue up to timeout seconds
+                        before dropping its log, "drop" to drop the log right away
+                timeout: seconds a request waits for space in the queue with the "block" policy
+                batch_size: maximum number of rerankings written in one transaction
+                flush_interval: seconds the writer waits for more rerankings before writing a batch
+        """
+
+        self.queue = queue.Queue(maxsize=max_size)
+        self.policy = policy
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.thread = None
+        self.stopped = False
+        # Guards the thread, the stopped flag and the counters updated by the request threads
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+
+    def start(self):
+
+        """
+        Start the writer thread if it is not running, the rerankings submitted after stop
+        are dropped until it is started again
+        """
+
+        with self.lock:
+            self.stopped = False
+            self.start_thread()
+
+    def start_thread(self):
+
+        """
+        Start the writer thread if it is not running, the lock must be held by the caller
+        """
+
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="log_writer", daemon=True
+            )
+            self.thread.start()
+
+    def submit(self, conversation_id, search, proposed_results, methods_used):
+
+        """
+        Queue the results proposed for a search, see sql_query.store_proposed_results
+
+        Output: True if the reranking was queued, False if it was dropped because the queue is full
+        """
+
+        return self.submit_batch(
+            [(conversation_id, search, proposed_results, methods_used)]
+        )
+
+    def submit_batch(self, rerankings):
+
+        """
+        Queue the results proposed for several searches, they take one place in the queue
+        and are written in the same transaction
+
+        Input:  rerankings: list of (conversation_id, search, proposed_results, methods_used)
+
+        Output: True if the rerankings were queued, False if they were dropped because the queue is full
+                or the writer is stopped
+        """
+
+        if len(rerankings) == 0:
+            return True
+
+        # The writer is started by the first submission, but not again once it was stopped
+        with self.lock:
+            stopped = self.stopped
+            if stopped:
+                self.dropped += len(rerankings)
+            else:
+                self.start_thread()
+
+        if stopped:
+            print(
+                "-LOG_WRITER-\nWriter stopped, reranking logs dropped for",
+                [reranking[1] for reranking in rerankings],
+                "\n",
+            )
+            return False
+
+        item = [
+            (conversation_id, search, proposed_results, methods_used, 0)
+            for conversation_id, search, proposed_results, methods_used in rerankings
+        ]
+
+        try:
+            if self.policy == "block":
+                self.queue.put(item, timeout=self.timeout)
+            else:
+                self.queue.put_nowait(item)
+        except queue.Full:
+            with self.lock:
+                self.dropped += len(item)
+            print(
+                "-LOG_WRITER-\nQueue full, reranking logs dropped for",
+                [reranking[1] for reranking in item],
+                "\n",
+            )
+            return False
+
+        with self.lock:
+            self.submitted += len(item)
+        return True
+
+    def run(self):
+
+        """
+        Loop of the writer thread: wait for a reranking, gather the ones queued during flush_interval and write them
+        """
+
+        while True:
+
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            # Every item of the queue is a list of rerankings, a flush marker or the stop signal
+            rerankings = []
+            markers = []
+
+            while True:
+                if batch[-1] is stop_signal:
+                    break
+                if isinstance(batch[-1], threading.Event):
+                    # A flush waits for the rerankings queued before its marker, they are written right away
+                    markers.append(batch[-1])
+                    break
+                rerankings += batch[-1]
+                if len(rerankings) >= self.batch_size:
+                    break
+                try:
+                    batch.append(
+                        self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                    )
+                except queue.Empty:
+                    break
+
+            try:
+                if len(rerankings) > 0:
+                    with metrics.stage("log_write"):
+                        storage.backend.store_rerankings(rerankings)
+                    self.written += len(rerankings)
+                    self.batches += 1
+            except Exception as error:
+                print("-LOG_WRITER-\nError while writing reranking logs", error, "\n")
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+                for marker in markers:
+                    marker.set()
+
+            if batch[-1] is stop_signal:
+                return
+
+    def flush(self):
+
+        """
+        Wait until the rerankings queued before the call are written, the ones submitted
+        while it waits are not waited for
+        """
+
+        with self.lock:
+            thread = self.thread
+
+        if thread is None:
+            return
+
+        marker = threading.Event()
+        self.queue.put(marker)
+
+        # The marker is never reached if the writer is stopped meanwhile, stop writes the queue itself
+        while not marker.wait(0.1):
+            if not thread.is_alive():
+                return
+
+    def stop(self):
+
+        """
+        Write the queued rerankings and stop the writer thread
+        """
+
+        with self.lock:
+            self.stopped = True
+            thread, self.thread = self.thread, None
+
+        if thread is not None:
+            self.queue.put(stop_signal)
+            thread.join()
+
+    def stats(self):
+
+        """
+        Output: counters of the writer, queued being the number of submissions waiting in the queue
+        """
+
+        return {
+            "queued": self.queue.qsize(),
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "written": self.written,
+            "batches": self.batches,
+        }
+
+
+writer = LogWriter(
+    config.get_int("log_queue_size"),
+    config.get_str("log_queue_policy"),
+    config.get_float("log_queue_timeout"),
+    config.get_int("log_batch_size"),
+    config.get_float("log_flush_interval"),
+)
+
+metrics.registry += [
+    metrics.Gauge(
+        "reranking_log_queue_depth",
+        "Submissions of reranking logs waiting in the queue of the log writer",
+        lambda: writer.queue.qsize(),
+    ),
+    metrics.Gauge(
+        "reranking_log_submitted_total",
+        "Number of reranking logs queued for the log writer",
+        lambda: writer.submitted,
+        "counter",
+    ),
+    metrics.Gauge(
+        "reranking_log_dropped_total",
+        "Number of reranking logs dropped because the queue was full or the writer stopped",
+        lambda: writer.dropped,
+        "counter",
+    ),
+    metrics.Gauge(
+        "reranking_log_written_total",
+        "Number of reranking logs written by the log writer",
+        lambda: writer.written,
+        "counter",
+    ),
+]
@@ -1,11 +1,18 @@
 import json
 import numpy as np
+import sqlite3
 from enum import Enum
 
+import cache
+import config
+import db_executor
+import log_writer
+import metrics
 import reranking
-import sql_query
+import storage
 
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Header, Query, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from typing import List, Tuple, Optional
 
@@ -71,6 +78,7 @@ class Result_Reranking_Feedback(BaseModel):
     new_rank: int
     feedback: Feedback
     methods_used: str
+    origin_source: Optional[str]
 
 
 class Add_Result_Feedback_Query(BaseModel):
@@ -132,6 +140,11 @@ class API_Hostname(str, Enum):
     others = "Other"
 
 
+class Fusion_Strategy(str, Enum):
+    rrf = "rrf"
+    weighted = "weighted"
+
+
 class Results_List(BaseModel):
 
     api_hostname: API_Hostname
@@ -149,6 +162,9 @@ class Search_Reranking_Query(BaseModel):
     user_search: str
     use_feedback: Optional[bool] = True
     use_metadata: Optional[bool] = False
+    use_lexical: Optional[bool] = True
+    fusion: Optional[Fusion_Strategy]
+    top_k: Optional[int] = Field(None, gt=0)
 
     class Config:
         schema_extra = {
@@ -216,27 +232,412 @@ class databaseFeedbacksExctraction(BaseModel):
         }
 
 
+def feedback_value(value):
+
+    """
+    Output: value of the Feedback, checked without building the enum for every feedback of an import
+    """
+
+    if value not in feedback_values:
+        raise ValueError("{} is not a valid Feedback".format(value))
+
+    return int(value)
+
+
+feedback_values = {feedback.value for feedback in Feedback}
+
+result_text_fields = ["title", "url", "description", "portal"]
+result_optional_fields = [
+    "owner_org",
+    "owner_org_description",
+    "maintainer",
+    "dataset_publication_date",
+    "dataset_modification_date",
+    "metadata_creation_date",
+    "metadata_modification_date",
+]
+
+
+def parse_result(data):
+
+    """
+    Build a Result from a result of an import, only checking the types of its fields
+    instead of validating every result of a large import with pydantic
+
+    Input:  data: dict of the result, as written by /extract_all_feedbacks_stream
+
+    Output: object of type Result
+    """
+
+    values = {}
+
+    for field in result_text_fields:
+        if not isinstance(data[field], str):
+            raise ValueError("result {} is not a string".format(field))
+        values[field] = data[field]
+
+    for field in result_optional_fields:
+        value = data.get(field)
+        if value is not None and not isinstance(value, str):
+            raise ValueError("result {} is not a string".format(field))
+        values[field] = value
+
+    tags = data.get("tags")
+    if tags is not None and not all(isinstance(tag, str) for tag in tags):
+        raise ValueError("result tags are not strings")
+
+    groups = data.get("groups")
+    if groups is not None:
+        groups = [
+            Group.construct(
+                name=str(group["name"]), description=group.get("description")
+            )
+            for group in groups
+        ]
+
+    return Result.construct(tags=tags, groups=groups, **values)
+
+
+class FeedbackImport:
+
+    """
+    Read an NDJSON import of searches in the format of /extract_all_feedbacks_stream, one line at a time,
+    and give them to storage.backend.import_searches in chunks of about chunk_size feedbacks
+    """
+
+    def __init__(self, conversation_id, chunk_size):
+
+        self.conversation_id = conversation_id
+        self.chunk_size = chunk_size
+        self.line_number = 0
+        self.searches_imported = 0
+        self.feedbacks_imported = 0
+        self.chunk = []
+        self.chunk_feedbacks = 0
+        # (portal, url) -> (data, Result), a result is parsed again only when its data changes
+        self.results = {}
+        # results already stored by the import, see sql_query.import_searches
+        self.stored_results = {}
+
+    def parse_search(self, data):
+
+        """
+        Input:  data: search read from a line of the import
+
+        Output: (conversation_id, user_search, search_target, portal, date, feedbacks), see storage.Storage.import_searches
+        """
+
+        feedbacks = []
+
+        for feedback in data.get("feedbacks") or []:
+
+            result = feedback["result"]
+            key = (result["portal"], result["url"])
+            if key not in self.results or self.results[key][0] != result:
+                self.results[key] = (result, parse_result(result))
+
+            feedbacks.append(
+                (
+                    self.results[key][1],
+                    int(feedback["old_rank"]),
+                    int(feedback["new_rank"]),
+                    feedback_value(feedback["feedback"]),
+                    str(feedback["methods_used"]),
+                    feedback.get("origin_source"),
+                )
+            )
+
+        return (
+            str(data.get("conversation_id") or self.conversation_id),
+            str(data["user_search"]),
+            str(data.get("search_target") or ""),
+            str(data["portal"]),
+            str(data["date"]),
+            feedbacks,
+        )
+
+    def add_line(self, line):
+
+        """
+        Input:  line: line of the import, as str or bytes
+
+        Output: chunk of searches to store once enough feedbacks were read, None otherwise
+        """
+
+        self.line_number += 1
+
+        if not line.strip():
+            return None
+
+        try:
+            search = self.parse_search(json.loads(line))
+        except KeyError as error:
+            raise ValueError(
+                "line {}: missing field {}".format(self.line_number, error)
+            )
+        except (ValueError, TypeError, AttributeError) as error:
+            raise ValueError(
+                "line {}: invalid search, {}".format(self.line_number, error)
+            )
+
+        self.chunk.append(search)
+        self.chunk_feedbacks += len(search[5])
+
+        if self.chunk_feedbacks >= self.chunk_size:
+            return self.take_chunk()
+        return None
+
+    def take_chunk(self):
+
+        """
+        Output: searches read since the last chunk
+        """
+
+        chunk = self.chunk
+        self.chunk = []
+        self.chunk_feedbacks = 0
+
+        return chunk
+
+    def store(self, chunk):
+
+        """
+        Store a chunk of searches, run by the database threads
+        """
+
+        if len(chunk) > 0:
+            self.feedbacks_imported += storage.backend.import_searches(
+                chunk, self.stored_results
+            )
+            self.searches_imported += len(chunk)
+
+    def report(self):
+
+        return {
+            "searches_imported": self.searches_imported,
+            "feedbacks_imported": self.feedbacks_imported,
+        }
+
+
 # Launch API
 app = FastAPI()
 
+# Path of the route of every endpoint, filled at startup once all the routes are declared
+route_paths = {}
+
+
+@app.on_event("startup")
+def upgrade_database():
+    """
+    Create the database or bring it up to date with the current schema
+    """
+
+    storage.backend.open()
+    storage.backend.load_indexes()
+
+    log_writer.writer.start()
+
+
+@app.on_event("startup")
+def index_route_paths():
+    """
+    Map the endpoints to the paths of their routes, used to label the metrics
+    """
+
+    route_paths.clear()
+    route_paths.update({route.endpoint: route.path for route in app.routes})
+
+
+@app.on_event("shutdown")
+def close_database():
+    """
+    Write the queued reranking logs, wait for the running database work
+    and close the connections of the worker threads
+    """
+
+    log_writer.writer.stop()
+    db_executor.shutdown()
+    reranking.shutdown_scoring()
+    storage.backend.close()
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """
+    Record the latency and the number of SQL statements of every request, labeled by the path of its route
+    """
+
+    token = metrics.start_request()
+    response = await call_next(request)
+
+    if token is not None:
+        metrics.end_request(
+            token,
+            request.method,
+            route_paths.get(request.scope.get("endpoint"), "unmatched"),
+            response.status_code,
+        )
+
+    return response
+
 
 @app.get("/extract_all_feedbacks", response_model=List[databaseFeedbacksExctraction])
 async def extract_results_feedback():
     """
     ## Function
-    Extract all the database feedbacks and return it as a JSON object
+    Extract all the database feedbacks and return it as a JSON object,
+    use /extract_all_feedbacks_stream for large databases
     """
 
-    data = sql_query.extract_database_feedbacks()
+    data = await db_executor.run(storage.backend.extract_feedbacks)
     return data
 
 
+@app.get("/extract_all_feedbacks_stream")
+async def stream_results_feedback(
+    after_search_id: int = Query(
+        0, description="Only return the searches with a greater id"
+    ),
+    limit: Optional[int] = Query(
+        None, gt=0, description="Maximum number of searches returned"
+    ),
+):
+    """
+    ## Function
+    Stream the database feedbacks as NDJSON, one search per line, with the same format as /extract_all_feedbacks
+    plus the **search_id** of the search. Only one page of searches is held in memory at a time.
+    ## Parameter
+    ### Optional
+    - **after_search_id**: only return the searches with a greater id, give the search_id of the last line
+    received to get the next page
+    - **limit**: maximum number of searches returned, default to every search
+    """
+
+    async def generate_lines():
+
+        page_after_search_id = after_search_id
+        remaining = limit
+
+        while remaining is None or remaining > 0:
+
+            page_size = 500 if remaining is None else min(500, remaining)
+
+            page = await db_executor.run(
+                storage.backend.get_feedback_extraction_page,
+                page_after_search_id,
+                page_size,
+            )
+
+            if len(page) == 0:
+                return
+
+            yield "".join(
+                json.dumps(search, ensure_ascii=False) + "\n" for search in page
+            )
+
+            page_after_search_id = page[-1]["search_id"]
+            if remaining is not None:
+                remaining -= len(page)
+
+    return StreamingResponse(generate_lines(), media_type="application/x-ndjson")
+
+
+@app.post("/import_feedbacks")
+async def import_feedbacks(
+    request: Request,
+    conversation_id: str = Query(
+        "import", description="Conversation id of the searches imported without one"
+    ),
+    chunk_size: Optional[int] = Query(
+        None, gt=0, description="Number of feedbacks stored per transaction"
+    ),
+):
+    """
+    ## Function
+    Import searches with their feedbacks, sent as NDJSON in the format of /extract_all_feedbacks_stream:
+    one search per line with its **user_search**, **search_target**, **portal**, **date** and **feedbacks**.
+    The body is read as it arrives and stored in chunks, each one in its own transaction.
+    Importing the same searches twice stores them twice.
+    ## Parameter
+    ### Optional
+    - **conversation_id**: conversation id of the searches imported without one, default to "import"
+    - **chunk_size**: number of feedbacks stored per transaction, default to import_chunk_size
+    """
+
+    importer = FeedbackImport(
+        conversation_id, chunk_size or config.get_int("import_chunk_size")
+    )
+    pending = b""
+
+    try:
+
+        async for data in request.stream():
+
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+
+            for line in lines:
+                chunk = importer.add_line(line)
+                if chunk is not None:
+                    await db_executor.run(importer.store, chunk)
+
+        # The last line may not end with a line break
+        chunk = importer.add_line(pending)
+        if chunk is None:
+            chunk = importer.take_chunk()
+        await db_executor.run(importer.store, chunk)
+
+    except ValueError as error:
+        raise HTTPException(
+            status_code=400, detail={"error": str(error), **importer.report()}
+        )
+    except sqlite3.Error as error:
+        raise HTTPException(
+            status_code=500, detail={"error": str(error), **importer.report()}
+        )
+
+    return importer.report()
+
+
+@app.get("/cache_stats")
+async def get_cache_stats():
+    """
+    ## Function
+    Return the hit, miss and eviction counters of the in-memory caches of this worker,
+    and the queue depth and dropped count of its reranking log writer
+    """
+
+    return {
+        "feedback_counts": cache.feedback_counts.stats(),
+        "responses": cache.responses.stats(),
+        "log_writer": log_writer.writer.stats(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    ## Function
+    Return the metrics of this worker in the Prometheus text format: latency of each endpoint,
+    time spent in each stage of the reranking, SQL statements and rows of each request,
+    and queue depth and dropped count of the reranking log writer
+    """
+
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/search_reranking", response_model=List[Result])
-async def manage_query_reranking(query: Search_Reranking_Query):
+async def manage_query_reranking(
+    query: Search_Reranking_Query,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+):
 
     """
     ## Function
-    Take the results of one or multiple searches and rerank the results
+    Take the results of one or multiple searches and rerank the results.
+    Every results list is scored concurrently, then the lists are merged into one list where a result
+    returned by several sources appears once.
     
     ### Required parameters
     - **conversation_id**: rasa id of the conversation
@@ -262,20 +663,83 @@ async def manage_query_reranking(query: Search_Reranking_Query):
     
     ### Optional parameters
     - **use_feedback**: if True, use feedback for reranking, default to True
-    - **use_metadata**: if True, do nothing for now, default to False
+    - **use_metadata**: if True, use the tags, groups and owner_org of the results chosen by past users for that search, default to False
+    - **use_lexical**: if True, use the BM25 relevance of the title, description, tags and groups of the results
+    for the search, default to True
+    - **fusion**: how the results lists are merged, default to the fusion_strategy of api-config.config
+        - **rrf**: reciprocal rank fusion, each source adds weight / (k + rank of the result in the source)
+        - **weighted**: each source adds weight * score of the result in the source
+    - **top_k**: only return the top_k best results, only these are fully sorted, default to every result
+
+    ### Conditional requests
+    The response has an **ETag** header identifying the ranking. An identical query sent with that value in
+    **If-None-Match** gets an empty 304 response while the ranking is unchanged. Rankings are cached for
+    response_cache_ttl seconds and dropped as soon as a feedback is given to their search.
     """
 
-    output_data = reranking.rerank_results(
-        query.conversation_id,
-        query.user_search,
-        query.data,
-        query.use_feedback,
-        query.use_metadata,
+    [(etag, output_data)] = await db_executor.run(
+        reranking.rerank_with_etags,
+        [
+            (
+                query.conversation_id,
+                query.user_search,
+                query.data,
+                query.use_feedback,
+                query.use_metadata,
+                query.fusion.value if query.fusion is not None else None,
+                query.top_k,
+                query.use_lexical,
+            )
+        ],
     )
 
+    etag = '"' + etag + '"'
+
+    if if_none_match is not None and (
+        if_none_match.strip() == "*"
+        or etag
+        in [tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")]
+    ):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    response.headers["ETag"] = etag
     return output_data
 
 
+@app.post("/search_reranking_batch", response_model=List[List[Result]])
+async def manage_batch_reranking(queries: List[Search_Reranking_Query]):
+
+    """
+    ## Function
+    Rerank the results of several searches in one call, for example the reformulations of a search
+    or the same search made on several portals. The feedbacks of every search are read together
+    and their logs are written in one transaction.
+
+    ### Parameters
+    - a list of queries of /search_reranking, with the same required and optional parameters
+
+    ### Output
+    - the reranked results of each query, in the order of the queries
+    """
+
+    return await db_executor.run(
+        reranking.rerank_batch,
+        [
+            (
+                query.conversation_id,
+                query.user_search,
+                query.data,
+                query.use_feedback,
+                query.use_metadata,
+                query.fusion.value if query.fusion is not None else None,
+                query.top_k,
+                query.use_lexical,
+            )
+            for query in queries
+        ],
+    )
+
+
 @app.post("/add_search")
 async def add_search(search: Add_Search_Query):
     """
@@ -289,8 +753,12 @@ async def add_search(search: Add_Search_Query):
     - **date**: date of the search [yy-mm-dd hh:mm:ss]
     """
 
-    sql_query.add_new_search_query(
-        search.conversation_id, search.user_search, search.portal, search.date
+    await db_executor.run(
+        storage.backend.add_search,
+        search.conversation_id,
+        search.user_search,
+        search.portal,
+        search.date,
     )
 
 
@@ -324,10 +792,38 @@ async def add_results_feedback(feedbacks: Add_Result_Feedback_Query):
                 - A **group** must have a **name** attribute as string, and optionally a **description**
     """
 
-    sql_query.update_proposed_result_feedback(
+    # The feedbacks update the rerankings logged for that search, which may still be queued
+    await db_executor.run(log_writer.writer.flush)
+
+    await db_executor.run(
+        storage.backend.update_feedback,
         feedbacks.conversation_id,
         feedbacks.user_search,
         feedbacks.search_target,
         feedbacks.feedbacks_list,
     )
 
+
+@app.post("/maintenance")
+async def run_maintenance(
+    vacuum_min_free: Optional[float] = Query(
+        None,
+        ge=0,
+        le=1,
+        description="Share of free pages above which the database is vacuumed",
+    ),
+):
+    """
+    ## Function
+    Remove the links and feedback aggregates of missing results, tags and groups, refresh the statistics
+    of the query planner and VACUUM the database if enough of it is free.
+    The API keeps serving, only VACUUM pauses the writes for its whole run.
+    ## Parameter
+    ### Optional
+    - **vacuum_min_free**: share of free pages above which the database is vacuumed, default to maintenance_vacuum_min_free
+    """
+
+    # The queued rerankings are written before the rows they reference are checked
+    await db_executor.run(log_writer.writer.flush)
+
+    return await db_executor.run(storage.backend.run_maintenance, vacuum_min_free)
@@ -0,0 +1,106 @@
+import sqlite3
+import time
+
+import config
+import connection_manager
+
+
+def remove_dangling_rows(cursor):
+
+    """
+    Delete the links and the feedback aggregates of missing results, tags and groups.
+    The tags and groups linked to no result are kept: the other workers keep their ids in their vocabulary
+    and would link new results to deleted rows.
+
+    Input:  cursor: connection to database
+
+    Output: (number of links removed, number of feedback aggregates removed)
+    """
+
+    links_removed = cursor.execute(
+        "DELETE FROM link_results_tags WHERE result_id NOT IN (SELECT id FROM result) "
+        "OR tag_id NOT IN (SELECT id FROM result_tag);"
+    ).rowcount
+    links_removed += cursor.execute(
+        "DELETE FROM link_results_groups WHERE result_id NOT IN (SELECT id FROM result) "
+        "OR group_id NOT IN (SELECT id FROM result_group);"
+    ).rowcount
+    aggregates_removed = cursor.execute(
+        "DELETE FROM feedback_aggregate WHERE result_id NOT IN (SELECT id FROM result);"
+    ).rowcount
+
+    return links_removed, aggregates_removed
+
+
+def run_in_transaction(cursor, function, *arguments):
+
+    """
+    Run a step of the maintenance in its own write transaction, the API writers wait for it
+    up to sqlite_busy_timeout so the steps are kept short
+    """
+
+    cursor.execute("BEGIN IMMEDIATE;")
+    try:
+        output = function(cursor, *arguments)
+        cursor.execute("COMMIT;")
+    except sqlite3.Error:
+        cursor.execute("ROLLBACK;")
+        raise
+
+    return output
+
+
+def run_maintenance(vacuum_min_free=None):
+
+    """
+    Remove the links and aggregates of missing rows, then refresh the statistics of the query planner
+    and VACUUM the database when enough of it is free pages.
+    The API keeps serving during the maintenance, only VACUUM blocks the writers for its whole run.
+    The duplicate results are merged once and for all by migration_result_identity.
+
+    Input:  vacuum_min_free: share of free pages above which the database is vacuumed,
+                             maintenance_vacuum_min_free by default, 1 to never vacuum
+
+    Output: dict reporting what was done
+    """
+
+    if vacuum_min_free is None:
+        vacuum_min_free = config.get_float("maintenance_vacuum_min_free")
+
+    start = time.perf_counter()
+    report = {"links_removed": 0, "aggregates_removed": 0, "vacuumed": False}
+
+    sqliteConnection = connection_manager.connect(isolation_level=None)
+    cursor = sqliteConnection.cursor()
+
+    try:
+
+        report["links_removed"], report["aggregates_removed"] = run_in_transaction(
+            cursor, remove_dangling_rows
+        )
+
+        # Keep ANALYZE cheap on large databases by sampling the indexes
+        cursor.execute("PRAGMA analysis_limit = 1000;")
+        cursor.execute("ANALYZE;")
+
+        free_pages = cursor.execute("PRAGMA freelist_count;").fetchone()[0]
+        pages = cursor.execute("PRAGMA page_count;").fetchone()[0]
+
+        if pages > 0 and free_pages / pages >= vacuum_min_free:
+            cursor.execute("VACUUM;")
+            report["vacuumed"] = True
+
+        # Fold the WAL back into the database so that the file shrinks with the vacuum
+        cursor.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+    except sqlite3.Error as error:
+        print("Failed to run the database maintenance", error)
+        raise
+
+    finally:
+        cursor.close()
+        sqliteConnection.close()
+
+    report["seconds"] = round(time.perf_counter() - start, 3)
+
+    return report
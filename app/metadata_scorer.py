@@ -0,0 +1,400 @@
+import threading
+import time
+
+import numpy as np
+
+import config
+import sql_query
+import storage
+
+
+def metadata_features(result):
+
+    """
+    Input:  result: object of type main.Result
+
+    Output: list without duplicates of the (kind, name) metadata of the result: its tags, its groups and its owner_org
+    """
+
+    features = [("tag", tag) for tag in result.tags or []]
+    features += [("group", group.name) for group in result.groups or []]
+
+    if result.owner_org:
+        features.append(("owner_org", result.owner_org))
+
+    return list(dict.fromkeys(features))
+
+
+def build_csr(rows, columns, values, row_count):
+
+    """
+    Build a CSR sparse matrix from its coordinates, values of the same (row, column) are summed
+
+    Input:  rows, columns, values: vectors of the coordinates and values of the entries
+            row_count: number of rows of the matrix
+
+    Output: (indptr, indices, data) of the matrix, the indices of every row being sorted
+    """
+
+    rows = np.asarray(rows, dtype=np.int64)
+    columns = np.asarray(columns, dtype=np.int64)
+    values = np.asarray(values, dtype=float)
+
+    order = np.lexsort((columns, rows))
+    rows, columns, values = rows[order], columns[order], values[order]
+
+    if len(rows) > 0:
+        starts = np.flatnonzero(
+            np.concatenate(
+                ([True], (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1]))
+            )
+        )
+        rows, columns, values = (
+            rows[starts],
+            columns[starts],
+            np.add.reduceat(values, starts),
+        )
+
+    indptr = np.zeros(row_count + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=row_count))
+
+    return indptr, columns, values
+
+
+class AffinityMatrix:
+
+    """
+    Affinity of every search for the tags, groups and owner_org of the results chosen for it, learned from
+    the positive feedbacks. The number of chosen results having each metadata is stored as a CSR sparse matrix
+    of searches x metadata. The feedbacks received since its last compaction are kept in a small dict
+    merged at lookup, and folded into the matrix once it grows past compaction_size entries.
+    """
+
+    def __init__(self, compaction_size, refresh_interval):
+
+        """
+        Input:  compaction_size: number of pending entries triggering the compaction of the matrix
+                refresh_interval: seconds before the matrix is reloaded from the database in the background,
+                                  to get the feedbacks stored by the other workers, 0 to never reload it
+        """
+
+        self.lock = threading.Lock()
+        self.compaction_size = compaction_size
+        self.refresh_interval = refresh_interval
+        self.refreshing = False
+        # The reloads run one after the other on a single thread, which keeps a single connection to the database
+        self.reload_requested = threading.Event()
+        self.refresher = None
+        self.refresher_lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+
+        self.loaded_at = None
+        self.rows = {}  # normalized search -> row
+        self.columns = {}  # (kind, name) -> column
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int64)
+        self.data = np.zeros(0)
+        self.chosen = np.zeros(0)  # number of chosen results of each row
+        self.pending = {}  # row -> {column: count}
+        self.pending_chosen = {}  # row -> count
+        self.pending_size = 0
+
+    def get_row(self, search_key):
+
+        if search_key not in self.rows:
+            self.rows[search_key] = len(self.rows)
+
+        return self.rows[search_key]
+
+    def get_column(self, feature):
+
+        if feature not in self.columns:
+            self.columns[feature] = len(self.columns)
+
+        return self.columns[feature]
+
+    def load(self, cursor):
+
+        """
+        Replace the matrix by the affinities computed from the feedback_aggregate table
+
+        Input:  cursor: connection to database
+        """
+
+        chosen_results = cursor.execute(
+            "SELECT user_search, result_id, SUM(chosen) FROM feedback_aggregate "
+            "WHERE chosen > 0 GROUP BY user_search, result_id;"
+        ).fetchall()
+
+        chosen_ids = "SELECT result_id FROM feedback_aggregate WHERE chosen > 0"
+
+        features = {}
+        for result_id, name in cursor.execute(
+            "SELECT lt.result_id, t.name FROM link_results_tags AS lt JOIN result_tag AS t ON t.id = lt.tag_id "
+            "WHERE lt.result_id IN (" + chosen_ids + ");"
+        ):
+            features.setdefault(result_id, set()).add(("tag", name))
+        for result_id, name in cursor.execute(
+            "SELECT lg.result_id, g.name FROM link_results_groups AS lg JOIN result_group AS g ON g.id = lg.group_id "
+            "WHERE lg.result_id IN (" + chosen_ids + ");"
+        ):
+            features.setdefault(result_id, set()).add(("group", name))
+        for result_id, owner_org in cursor.execute(
+            "SELECT id, owner_org FROM result WHERE owner_org IS NOT NULL AND owner_org != '' "
+            "AND id IN (" + chosen_ids + ");"
+        ):
+            features.setdefault(result_id, set()).add(("owner_org", owner_org))
+
+        self.replace(chosen_results, features)
+
+    def replace(self, chosen_results, features):
+
+        """
+        Replace the matrix by the affinities computed from the chosen results of every search
+
+        Input:  chosen_results: list of (normalized search, result_id, number of times the result was chosen)
+                features: dict of result_id -> (kind, name) metadata of the result, see metadata_features
+        """
+
+        with self.lock:
+
+            self.clear()
+
+            rows, columns, values = [], [], []
+            chosen = {}
+
+            for user_search, result_id, count in chosen_results:
+                row = self.get_row(user_search)
+                chosen[row] = chosen.get(row, 0) + count
+                for feature in features.get(result_id, ()):
+                    rows.append(row)
+                    columns.append(self.get_column(feature))
+                    values.append(count)
+
+            self.indptr, self.indices, self.data = build_csr(
+                rows, columns, values, len(self.rows)
+            )
+            self.chosen = np.zeros(len(self.rows))
+            for row, count in chosen.items():
+                self.chosen[row] = count
+
+            self.loaded_at = time.monotonic()
+
+    def reload(self):
+
+        """
+        Reload the matrix from the database, run by the refresher thread.
+        A feedback committed while the tables are read may be missed until the next reload.
+        """
+
+        try:
+            storage.backend.load_affinities()
+        except Exception as error:
+            print("-METADATA_AFFINITIES-\nError while reloading", error, "\n")
+        finally:
+            self.refreshing = False
+
+    def refresh(self):
+
+        """
+        Run the reloads of the matrix as they are requested, for as long as the API runs
+        """
+
+        while True:
+            self.reload_requested.wait()
+            self.reload_requested.clear()
+            self.reload()
+
+    def request_reload(self):
+
+        """
+        Ask the refresher thread for a reload of the matrix, starting the thread on the first request
+        """
+
+        with self.refresher_lock:
+            if self.refresher is None or not self.refresher.is_alive():
+                self.refresher = threading.Thread(
+                    target=self.refresh, name="metadata_affinities", daemon=True
+                )
+                self.refresher.start()
+
+        self.reload_requested.set()
+
+    def ensure_loaded(self):
+
+        """
+        Load the matrix on its first use, and start its reload when it is older than refresh_interval
+        """
+
+        if self.loaded_at is None:
+            storage.backend.load_affinities()
+
+        elif (
+            self.refresh_interval > 0
+            and time.monotonic() - self.loaded_at > self.refresh_interval
+            and not self.refreshing
+        ):
+            self.refreshing = True
+            self.request_reload()
+
+    def add_feedback(self, search, result, chosen):
+
+        """
+        Update the affinities of a search with a new feedback
+
+        Input:  search: search entered by the user
+                result: object of type main.Result
+                chosen: change of the number of times the result was chosen for that search
+        """
+
+        if chosen == 0 or self.loaded_at is None:
+            return
+
+        self.add_feedbacks([(sql_query.normalize_search(search), result, chosen)])
+
+    def add_feedbacks(self, feedbacks):
+
+        """
+        Update the affinities with many feedbacks at once, the matrix being compacted at most once
+
+        Input:  feedbacks: list of (normalized search, result, change of the number of times the result was chosen)
+        """
+
+        if self.loaded_at is None:
+            return
+
+        # The metadata of a result found in several feedbacks are listed once
+        features = {}
+
+        with self.lock:
+
+            for search_key, result, chosen in feedbacks:
+
+                if chosen == 0:
+                    continue
+
+                if id(result) not in features:
+                    features[id(result)] = [
+                        self.get_column(feature)
+                        for feature in metadata_features(result)
+                    ]
+
+                row = self.get_row(search_key)
+                self.pending_chosen[row] = self.pending_chosen.get(row, 0) + chosen
+
+                pending_row = self.pending.setdefault(row, {})
+                for column in features[id(result)]:
+                    pending_row[column] = pending_row.get(column, 0) + chosen
+                self.pending_size += len(features[id(result)])
+
+            if self.pending_size >= self.compaction_size:
+                self.compact()
+
+    def compact(self):
+
+        """
+        Fold the pending feedbacks into the matrix, called with the lock held
+        """
+
+        rows = [np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))]
+        columns = [self.indices]
+        values = [self.data]
+
+        for row, pending_row in self.pending.items():
+            rows.append(np.full(len(pending_row), row))
+            columns.append(np.fromiter(pending_row.keys(), dtype=np.int64))
+            values.append(np.fromiter(pending_row.values(), dtype=float))
+
+        self.indptr, self.indices, self.data = build_csr(
+            np.concatenate(rows),
+            np.concatenate(columns),
+            np.concatenate(values),
+            len(self.rows),
+        )
+
+        chosen = np.zeros(len(self.rows))
+        chosen[: len(self.chosen)] = self.chosen
+        for row, count in self.pending_chosen.items():
+            chosen[row] += count
+        self.chosen = chosen
+
+        self.pending = {}
+        self.pending_chosen = {}
+        self.pending_size = 0
+
+    def scores(self, search, results_list):
+
+        """
+        Compute the metadata score of each result for a search
+
+        Input:  search: search entered by the user
+                results_list: list of objects of type main.Result
+
+        Output: vector of the mean affinity of the search for the metadata of each result,
+                the affinity of a metadata being the share of the results chosen for that search having it
+        """
+
+        self.ensure_loaded()
+
+        scores = np.zeros(len(results_list))
+
+        features = [metadata_features(result) for result in results_list]
+        owners = np.repeat(
+            np.arange(len(results_list)), [len(result) for result in features]
+        )
+
+        with self.lock:
+
+            row = self.rows.get(sql_query.normalize_search(search))
+            if row is None or len(owners) == 0:
+                return scores
+
+            columns = np.array(
+                [
+                    self.columns.get(feature, -1)
+                    for result in features
+                    for feature in result
+                ],
+                dtype=np.int64,
+            )
+
+            chosen = self.pending_chosen.get(row, 0)
+            if row < len(self.chosen):
+                chosen += self.chosen[row]
+            if chosen <= 0:
+                return scores
+
+            counts = np.zeros(len(columns))
+
+            if row < len(self.indptr) - 1:
+                row_columns = self.indices[self.indptr[row] : self.indptr[row + 1]]
+                row_data = self.data[self.indptr[row] : self.indptr[row + 1]]
+                if len(row_columns) > 0:
+                    positions = np.minimum(
+                        np.searchsorted(row_columns, columns), len(row_columns) - 1
+                    )
+                    found = row_columns[positions] == columns
+                    counts[found] = row_data[positions[found]]
+
+            pending_row = self.pending.get(row)
+            if pending_row:
+                counts += [pending_row.get(column, 0) for column in columns]
+
+        feature_counts = np.bincount(owners, minlength=len(results_list))
+        affinity_sums = np.bincount(
+            owners, weights=counts / chosen, minlength=len(results_list)
+        )
+        has_features = feature_counts > 0
+        scores[has_features] = (
+            affinity_sums[has_features] / feature_counts[has_features]
+        )
+
+        return np.clip(scores, 0, 1)
+
+
+affinities = AffinityMatrix(
+    config.get_int("metadata_compaction_size"),
+    config.get_float("metadata_refresh_interval"),
+)
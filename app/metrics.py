@@ -0,0 +1,339 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+# Metrics are recorded only when enabled in api-config.config, rendering them is only done when /metrics is scraped
+enabled = config.get_str("metrics_enabled").lower() == "true"
+
+latency_buckets = [
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+]
+count_buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000]
+
+# RequestSqlCounts of the current request, None outside of a request
+request_sql_counts = contextvars.ContextVar("request_sql_counts", default=None)
+
+
+def format_labels(names, values, extra=""):
+
+    labels = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        labels.append(extra)
+
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value):
+
+    if value == float("inf"):
+        return "+Inf"
+
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+class Counter:
+
+    """
+    Prometheus counter, one value per combination of labels
+    """
+
+    def __init__(self, name, description, label_names=()):
+
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> count
+
+    def inc(self, label_values=(), amount=1):
+
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+
+        lines = [
+            "# HELP {} {}".format(self.name, self.description),
+            "# TYPE {} counter".format(self.name),
+        ]
+
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(
+                    self.name
+                    + format_labels(self.label_names, label_values)
+                    + " "
+                    + format_value(value)
+                )
+
+        return lines
+
+
+class Histogram:
+
+    """
+    Prometheus histogram, one set of buckets per combination of labels
+    """
+
+    def __init__(self, name, description, label_names=(), buckets=latency_buckets):
+
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> [count of each bucket, sum, count]
+
+    def observe(self, label_values, value):
+
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            bucket_counts = self.values[label_values]
+            bucket_counts[0][index] += 1
+            bucket_counts[1] += value
+            bucket_counts[2] += 1
+
+    def render(self):
+
+        lines = [
+            "# HELP {} {}".format(self.name, self.description),
+            "# TYPE {} histogram".format(self.name),
+        ]
+
+        with self.lock:
+            for label_values, (bucket_counts, total, count) in sorted(
+                self.values.items()
+            ):
+                cumulative = 0
+                for bound, bucket_count in zip(
+                    self.buckets + [float("inf")], bucket_counts
+                ):
+                    cumulative += bucket_count
+                    lines.append(
+                        self.name
+                        + "_bucket"
+                        + format_labels(
+                            self.label_names,
+                            label_values,
+                            'le="{}"'.format(format_value(bound)),
+                        )
+                        + " "
+                        + str(cumulative)
+                    )
+                labels = format_labels(self.label_names, label_values)
+                lines.append(self.name + "_sum" + labels + " " + format_value(total))
+                lines.append(self.name + "_count" + labels + " " + str(count))
+
+        return lines
+
+
+class RequestSqlCounts:
+
+    """
+    Number of SQL statements run by the sql_query functions for a request and of the rows they read or wrote,
+    updated by the scoring threads of the request which share it through the copied context
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.statements = 0
+        self.rows = 0
+
+    def add(self, statements, rows):
+
+        with self.lock:
+            self.statements += statements
+            self.rows += rows
+
+    def get(self):
+
+        """
+        Output: (statements, rows)
+        """
+
+        with self.lock:
+            return self.statements, self.rows
+
+
+class Gauge:
+
+    """
+    Prometheus metric without labels whose value is kept by another module and read when the metrics are rendered,
+    a gauge or a counter
+    """
+
+    def __init__(self, name, description, read, metric_type="gauge"):
+
+        """
+        Input:  read: function returning the current value
+                metric_type: "gauge" or "counter"
+        """
+
+        self.name = name
+        self.description = description
+        self.read = read
+        self.metric_type = metric_type
+
+    def render(self):
+
+        return [
+            "# HELP {} {}".format(self.name, self.description),
+            "# TYPE {} {}".format(self.name, self.metric_type),
+            self.name + " " + format_value(self.read()),
+        ]
+
+
+request_latency = Histogram(
+    "http_request_duration_seconds",
+    "Latency of the requests until their response starts",
+    ("method", "endpoint", "status"),
+)
+stage_latency = Histogram(
+    "reranking_stage_duration_seconds",
+    "Time spent in each stage of the reranking pipeline",
+    ("stage",),
+)
+request_sql_statements = Histogram(
+    "http_request_sql_statements",
+    "Number of SQL statements run for a request",
+    ("endpoint",),
+    count_buckets,
+)
+request_sql_rows = Histogram(
+    "http_request_sql_rows",
+    "Number of rows read or written by the SQL statements of a request",
+    ("endpoint",),
+    count_buckets,
+)
+sql_statements = Counter(
+    "sql_statements_total", "Number of SQL statements run by the worker"
+)
+sql_rows = Counter(
+    "sql_rows_total",
+    "Number of rows read or written by the SQL statements run by the worker",
+)
+
+# Metrics rendered by /metrics, the modules keeping their own counters add theirs
+registry = [
+    request_latency,
+    stage_latency,
+    request_sql_statements,
+    request_sql_rows,
+    sql_statements,
+    sql_rows,
+]
+
+
+def count_sql(statements, rows):
+
+    """
+    Record SQL statements run by sql_query, in the totals and in the counts of the current request
+
+    Input:  statements: number of statements run
+            rows: number of rows they read or wrote
+    """
+
+    if not enabled:
+        return
+
+    sql_statements.inc((), statements)
+    sql_rows.inc((), rows)
+
+    counts = request_sql_counts.get()
+    if counts is not None:
+        counts.add(statements, rows)
+
+
+@contextmanager
+def stage(name):
+
+    """
+    Time the code run inside the with block as a stage of the reranking pipeline
+
+    Input:  name: name of the stage
+    """
+
+    if not enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_latency.observe((name,), time.perf_counter() - start)
+
+
+def start_request():
+
+    """
+    Start counting the SQL statements of a request, the counts are shared with the threads
+    running its database work through the copied context
+
+    Output: token given to end_request
+    """
+
+    if not enabled:
+        return None
+
+    return (time.perf_counter(), request_sql_counts.set(RequestSqlCounts()))
+
+
+def end_request(token, method, endpoint, status):
+
+    """
+    Record the latency and the SQL counts of a request
+
+    Input:  token: value returned by start_request
+            method, endpoint, status: labels of the request, endpoint being the path of the route
+    """
+
+    if token is None:
+        return
+
+    start, counts_token = token
+    statements, rows = request_sql_counts.get().get()
+    request_sql_counts.reset(counts_token)
+
+    request_latency.observe(
+        (method, endpoint, str(status)), time.perf_counter() - start
+    )
+    request_sql_statements.observe((endpoint,), statements)
+    request_sql_rows.observe((endpoint,), rows)
+
+
+def render():
+
+    """
+    Output: every metric in the Prometheus text format
+    """
+
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+
+    return "\n".join(lines) + "\n"
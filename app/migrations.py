@@ -0,0 +1,483 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+import connection_manager
+
+
+def execute_script(cursor, script):
+
+    """
+    Run every statement of an SQL script inside the current transaction,
+    unlike cursor.executescript which commits it first
+    """
+
+    for statement in script.split(";"):
+        if statement.strip():
+            cursor.execute(statement)
+
+
+def migration_initial_schema(cursor):
+
+    """
+    Create the tables of the first version of the database, see db-SQL.txt
+    """
+
+    execute_script(
+        cursor,
+        """
+        CREATE TABLE IF NOT EXISTS search (
+            "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+            "conversation_id" VARCHAR(255) NOT NULL,
+            "user_search" VARCHAR(255) NOT NULL,
+            "portal" VARCHAR (255) NOT NULL,
+            "date" DATETIME NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS search_target_feedback (
+            "search_id" INTEGER NOT NULL,
+            "search_target" VARCHAR(255) NOT NULL,
+            FOREIGN KEY ("search_id")
+                REFERENCES search ("id"),
+            PRIMARY KEY (search_id, search_target)
+        );
+
+        CREATE TABLE IF NOT EXISTS result_tag (
+            "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+            "name" VARCHAR(255) NOT NULL,
+            "portal" VARCHAR(255) NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS result_group (
+            "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+            "name" VARCHAR(255) NOT NULL,
+            "description" VARCHAR(255),
+            "portal" VARCHAR(255) NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS result (
+            "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+            "title" VARCHAR(255) NOT NULL,
+            "url" VARCHAR(255) NOT NULL,
+            "description" VARCHAR(255) NOT NULL,
+            "portal" VARCHAR(255) NOT NULL,
+            "owner_org" VARCHAR(255),
+            "owner_org_description" VARCHAR(255),
+            "maintainer" VARCHAR(255),
+            "dataset_publication_date" VARCHAR(255),
+            "dataset_modification_date" VARCHAR(255),
+            "metadata_creation_date" VARCHAR(255),
+            "metadata_modification_date" VARCHAR(255)
+        );
+
+        CREATE TABLE IF NOT EXISTS link_results_tags (
+            "result_id" INTEGER NOT NULL,
+            "tag_id" INTEGER NOT NULL,
+            FOREIGN KEY ("result_id")
+                REFERENCES result ("id"),
+            FOREIGN KEY ("tag_id")
+                REFERENCES result_tag ("id")
+            PRIMARY KEY (result_id, tag_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS link_results_groups (
+            "result_id" INTEGER NOT NULL,
+            "group_id" INTEGER NOT NULL,
+            FOREIGN KEY ("result_id")
+                REFERENCES result ("id"),
+            FOREIGN KEY ("group_id")
+                REFERENCES result_group ("id")
+            PRIMARY KEY (result_id, group_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS search_reranking_feedback (
+            "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+            "search_id" INTEGER NOT NULL,
+            "old_rank" INTEGER NOT NULL,
+            "new_rank" INTEGER NOT NULL,
+            "result_id" INTEGER NOT NULL,
+            "feedback" INTEGER NOT NULL,
+            "methods_used" VARCHAR(255) NOT NULL,
+            FOREIGN KEY ("search_id")
+                REFERENCES search ("id"),
+            FOREIGN KEY ("result_id")
+                REFERENCES result ("id")
+        );
+        """,
+    )
+
+
+def result_identity_v2(portal, url):
+
+    """
+    Frozen copy of sql_query.compute_result_identity as of version 2
+
+    Output: stable identity key of the result
+    """
+
+    return hashlib.blake2b(
+        (portal + "\x1f" + url).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+def result_fingerprint_v2(cursor, row):
+
+    """
+    Frozen copy of sql_query.compute_result_fingerprint as of version 2, reading the tags and groups
+    of the result without the vocabulary cache
+
+    Input:  cursor: connection to database
+            row: row of the result table, without the identity and fingerprint columns
+
+    Output: compact hash of the result content
+    """
+
+    tags = [
+        name
+        for (name,) in cursor.execute(
+            "SELECT t.name FROM link_results_tags AS lt JOIN result_tag AS t ON t.id = lt.tag_id "
+            "WHERE lt.result_id = ?;",
+            (row[0],),
+        )
+    ]
+    groups = [
+        [name, description]
+        for name, description in cursor.execute(
+            "SELECT g.name, g.description FROM link_results_groups AS lg "
+            "JOIN result_group AS g ON g.id = lg.group_id WHERE lg.result_id = ?;",
+            (row[0],),
+        )
+    ]
+
+    content = [
+        list(row[1:12]),
+        sorted(tags),
+        sorted(groups, key=str),
+    ]
+
+    return hashlib.blake2b(
+        json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+        digest_size=8,
+    ).hexdigest()
+
+
+def migration_result_identity(cursor):
+
+    """
+    Add the identity and fingerprint columns to the result table and fill them for the results already stored.
+    When several rows share the same portal and url, the most recent one gets the identity and the older
+    duplicates are merged into it: their feedbacks and their tags and groups are moved to it, then they are deleted.
+    """
+
+    columns = [column[1] for column in cursor.execute("PRAGMA table_info(result);")]
+
+    if "identity" not in columns:
+        cursor.execute("ALTER TABLE result ADD COLUMN identity CHAR(32);")
+    if "fingerprint" not in columns:
+        cursor.execute("ALTER TABLE result ADD COLUMN fingerprint CHAR(16);")
+
+    # identity -> id of the row holding it
+    canonical_ids = {
+        identity: result_id
+        for result_id, identity in cursor.execute(
+            "SELECT id, identity FROM result WHERE identity IS NOT NULL;"
+        ).fetchall()
+    }
+
+    legacy_results = cursor.execute(
+        "SELECT id, portal, url FROM result WHERE identity IS NULL ORDER BY id DESC;"
+    ).fetchall()
+
+    promoted_ids = set()
+    duplicates = []
+
+    for result_id, portal, url in legacy_results:
+
+        identity = result_identity_v2(portal, url)
+
+        if identity in canonical_ids:
+            duplicates.append((result_id, canonical_ids[identity]))
+        else:
+            canonical_ids[identity] = result_id
+            promoted_ids.add(result_id)
+
+    for duplicate_id, canonical_id in duplicates:
+
+        # A search keeps one feedback row per result, the one of the canonical row,
+        # which takes the feedback of the duplicate when it had none
+        cursor.execute(
+            """
+            UPDATE search_reranking_feedback SET feedback = (
+                SELECT duplicate.feedback FROM search_reranking_feedback AS duplicate
+                WHERE duplicate.search_id = search_reranking_feedback.search_id
+                AND duplicate.result_id = ?1 AND duplicate.feedback != 0
+                ORDER BY duplicate.id LIMIT 1
+            )
+            WHERE result_id = ?2 AND feedback = 0 AND EXISTS (
+                SELECT 1 FROM search_reranking_feedback AS duplicate
+                WHERE duplicate.search_id = search_reranking_feedback.search_id
+                AND duplicate.result_id = ?1 AND duplicate.feedback != 0
+            );
+            """,
+            (duplicate_id, canonical_id),
+        )
+        cursor.execute(
+            """
+            DELETE FROM search_reranking_feedback
+            WHERE result_id = ?1 AND search_id IN (
+                SELECT search_id FROM search_reranking_feedback WHERE result_id = ?2
+            );
+            """,
+            (duplicate_id, canonical_id),
+        )
+        cursor.execute(
+            "UPDATE search_reranking_feedback SET result_id = ? WHERE result_id = ?;",
+            (canonical_id, duplicate_id),
+        )
+
+        for table, column in [
+            ("link_results_tags", "tag_id"),
+            ("link_results_groups", "group_id"),
+        ]:
+            cursor.execute(
+                "INSERT OR IGNORE INTO {0}(result_id, {1}) "
+                "SELECT ?, {1} FROM {0} WHERE result_id = ?;".format(table, column),
+                (canonical_id, duplicate_id),
+            )
+            cursor.execute(
+                "DELETE FROM {} WHERE result_id = ?;".format(table), (duplicate_id,)
+            )
+
+        cursor.execute("DELETE FROM result WHERE id = ?;", (duplicate_id,))
+
+    # The fingerprints are computed once the tags and groups of the duplicates are merged
+    fingerprinted_ids = promoted_ids | set(
+        canonical_id for duplicate_id, canonical_id in duplicates
+    )
+    identities = {result_id: identity for identity, result_id in canonical_ids.items()}
+
+    for result_id in sorted(fingerprinted_ids):
+
+        row = cursor.execute(
+            "SELECT * FROM result WHERE id = ?;", (result_id,)
+        ).fetchone()
+
+        fingerprint = result_fingerprint_v2(cursor, row)
+
+        cursor.execute(
+            "UPDATE result SET identity = ?, fingerprint = ? WHERE id = ?;",
+            (identities[result_id], fingerprint, result_id),
+        )
+
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS result_identity_index ON result(identity);"
+    )
+
+
+def migration_lookup_indexes(cursor):
+
+    """
+    Index the columns used by the lookups done on every request.
+    The link tables are already indexed by result_id through their primary key.
+    """
+
+    execute_script(
+        cursor,
+        """
+        CREATE INDEX IF NOT EXISTS search_user_search_index ON search(user_search, portal);
+        CREATE INDEX IF NOT EXISTS search_conversation_index ON search(conversation_id, user_search);
+        CREATE INDEX IF NOT EXISTS search_reranking_feedback_search_result_index ON search_reranking_feedback(search_id, result_id);
+        CREATE INDEX IF NOT EXISTS search_reranking_feedback_result_index ON search_reranking_feedback(result_id);
+        CREATE INDEX IF NOT EXISTS result_tag_name_index ON result_tag(name, portal);
+        CREATE INDEX IF NOT EXISTS result_group_name_index ON result_group(name, description, portal);
+        CREATE INDEX IF NOT EXISTS link_results_tags_tag_index ON link_results_tags(tag_id);
+        CREATE INDEX IF NOT EXISTS link_results_groups_group_index ON link_results_groups(group_id);
+        """,
+    )
+
+
+def migration_feedback_aggregate(cursor):
+
+    """
+    Create the table of the feedback counts of every (search, portal, result) and fill it from the history
+    """
+
+    execute_script(
+        cursor,
+        """
+        CREATE TABLE IF NOT EXISTS feedback_aggregate (
+            "user_search" VARCHAR(255) NOT NULL,
+            "portal" VARCHAR(255) NOT NULL,
+            "result_id" INTEGER NOT NULL,
+            "chosen" INTEGER NOT NULL DEFAULT 0,
+            "ignored" INTEGER NOT NULL DEFAULT 0,
+            "total" INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY ("result_id")
+                REFERENCES result ("id"),
+            PRIMARY KEY (user_search, result_id, portal)
+        );
+
+        DELETE FROM feedback_aggregate;
+
+        INSERT INTO feedback_aggregate(user_search, portal, result_id, chosen, ignored, total)
+        SELECT normalize_search(s.user_search), s.portal, srf.result_id,
+        SUM(srf.feedback = 1), SUM(srf.feedback = -1), COUNT(*)
+        FROM search_reranking_feedback AS srf JOIN search AS s ON s.id = srf.search_id
+        GROUP BY 1, 2, 3;
+        """,
+    )
+
+
+def migration_origin_source(cursor):
+
+    """
+    Record the source (api_hostname) of each proposed result, old_rank being its rank in that source.
+    Results logged before keep a NULL source.
+    """
+
+    columns = [
+        column[1]
+        for column in cursor.execute("PRAGMA table_info(search_reranking_feedback);")
+    ]
+
+    if "origin_source" not in columns:
+        cursor.execute(
+            "ALTER TABLE search_reranking_feedback ADD COLUMN origin_source VARCHAR(255);"
+        )
+
+
+def migration_search_normalization(cursor):
+
+    """
+    Group the feedback aggregates again, searches are now normalized without accents, plurals nor stopwords
+    """
+
+    execute_script(
+        cursor,
+        """
+        DELETE FROM feedback_aggregate;
+
+        INSERT INTO feedback_aggregate(user_search, portal, result_id, chosen, ignored, total)
+        SELECT normalize_search(s.user_search), s.portal, srf.result_id,
+        SUM(srf.feedback = 1), SUM(srf.feedback = -1), COUNT(*)
+        FROM search_reranking_feedback AS srf JOIN search AS s ON s.id = srf.search_id
+        GROUP BY 1, 2, 3;
+        """,
+    )
+
+
+def migration_feedback_decay(cursor):
+
+    """
+    Add the feedback counts decayed with the age of their search, kept with the day they are decayed to,
+    and fill them from the history
+    """
+
+    columns = [
+        column[1] for column in cursor.execute("PRAGMA table_info(feedback_aggregate);")
+    ]
+
+    for column, definition in [
+        ("decayed_chosen", "REAL NOT NULL DEFAULT 0"),
+        ("decayed_ignored", "REAL NOT NULL DEFAULT 0"),
+        ("decayed_total", "REAL NOT NULL DEFAULT 0"),
+        ("decayed_at", "REAL NOT NULL DEFAULT 0"),
+    ]:
+        if column not in columns:
+            cursor.execute(
+                "ALTER TABLE feedback_aggregate ADD COLUMN {} {};".format(
+                    column, definition
+                )
+            )
+
+    # The counts are decayed to the day of the migration
+    cursor.execute(
+        """
+        INSERT INTO feedback_aggregate(user_search, portal, result_id, chosen, ignored, total,
+        decayed_chosen, decayed_ignored, decayed_total, decayed_at)
+        SELECT normalize_search(s.user_search), s.portal, srf.result_id,
+        SUM(srf.feedback = 1), SUM(srf.feedback = -1), COUNT(*),
+        SUM((srf.feedback = 1) * decay_factor(?1 - search_day(s.date))),
+        SUM((srf.feedback = -1) * decay_factor(?1 - search_day(s.date))),
+        SUM(decay_factor(?1 - search_day(s.date))), ?1
+        FROM search_reranking_feedback AS srf JOIN search AS s ON s.id = srf.search_id
+        GROUP BY 1, 2, 3
+        ON CONFLICT(user_search, result_id, portal) DO UPDATE SET
+        decayed_chosen = excluded.decayed_chosen, decayed_ignored = excluded.decayed_ignored,
+        decayed_total = excluded.decayed_total, decayed_at = excluded.decayed_at;
+        """,
+        (time.time() / 86400,),
+    )
+
+
+# Ordered list of (version, migration), the version of the database is stored in its user_version pragma.
+# Every migration must be idempotent so that it can be applied to databases created from db-SQL.txt.
+# A shipped migration is never changed, so it holds its own SQL and frozen copies of the helpers it needs
+# instead of calling sql_query which keeps evolving.
+# It may use the SQL functions registered by connection_manager.connect (normalize_search, search_day, decay_factor).
+migrations = [
+    (1, migration_initial_schema),
+    (2, migration_result_identity),
+    (3, migration_lookup_indexes),
+    (4, migration_feedback_aggregate),
+    (5, migration_origin_source),
+    (6, migration_search_normalization),
+    (7, migration_feedback_decay),
+]
+
+
+def get_schema_version(cursor):
+
+    """
+    Output: version of the schema of the database, 0 if no migration was ever applied
+    """
+
+    return cursor.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def run_migrations():
+
+    """
+    Apply every migration newer than the version of the database, each one in its own transaction,
+    then refresh the statistics used by the sqlite query planner
+
+    Output: version of the schema after the migrations
+    """
+
+    Path(connection_manager.database).parent.mkdir(parents=True, exist_ok=True)
+
+    sqliteConnection = connection_manager.connect(isolation_level=None)
+    cursor = sqliteConnection.cursor()
+
+    try:
+
+        version = get_schema_version(cursor)
+
+        for migration_version, migration in migrations:
+
+            if migration_version <= version:
+                continue
+
+            cursor.execute("BEGIN IMMEDIATE;")
+            try:
+                migration(cursor)
+                cursor.execute("PRAGMA user_version = {};".format(migration_version))
+                cursor.execute("COMMIT;")
+            except sqlite3.Error:
+                cursor.execute("ROLLBACK;")
+                raise
+
+            print("Database migrated to version", migration_version, migration.__name__)
+            version = migration_version
+
+        # Keep ANALYZE cheap on large databases by sampling the indexes
+        cursor.execute("PRAGMA analysis_limit = 1000;")
+        cursor.execute("ANALYZE;")
+
+        return version
+
+    finally:
+        cursor.close()
+        sqliteConnection.close()
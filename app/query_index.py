@@ -0,0 +1,235 @@
+import math
+import threading
+from array import array
+
+import numpy as np
+
+import cache
+import config
+
+
+def search_grams(search_key):
+
+    """
+    Input:  search_key: search normalized by sql_query.normalize_search
+
+    Output: set of the character trigrams and of the words of the search
+    """
+
+    padded = " " + search_key + " "
+
+    grams = {padded[i : i + 3] for i in range(len(padded) - 2)}
+    grams.update("w:" + word for word in search_key.split())
+
+    return grams
+
+
+def response_groups(search_keys):
+
+    """
+    Input:  search_keys: searches normalized by sql_query.normalize_search whose feedbacks or proposals changed
+
+    Output: groups of cache.responses to invalidate. A ranking is grouped by the grams of its search,
+            which it shares with every search similar to it, including the ones stored after it was cached.
+    """
+
+    return sorted(
+        set().union(*[search_grams(search_key) for search_key in search_keys])
+    )
+
+
+class QueryIndex:
+
+    """
+    Inverted index of the n-grams of the past searches, used to find the searches similar to a new one.
+    Every gram maps to the array of the ids of the searches containing it, searches are only ever appended
+    so the index is updated in place. Grams shared by more than max_postings searches are too common
+    to tell searches apart and are not used for lookups.
+    The similar searches found are cached per search until a new search is stored.
+    """
+
+    def __init__(self, max_postings, cache_size=0):
+
+        """
+        Input:  max_postings: number of searches above which a gram is ignored by the lookups
+                cache_size: number of lookups kept, 0 to disable the cache
+        """
+
+        self.lock = threading.Lock()
+        self.max_postings = max_postings
+        self.lookups = cache.LRUCache(cache_size)
+        self.clear()
+
+    def clear(self):
+
+        self.lookups.clear()
+
+        self.search_ids = {}  # search key -> id
+        self.search_keys = []  # id -> search key
+        self.gram_counts = array("i")  # id -> number of grams of the search
+        self.postings = {}  # gram -> array of the ids of the searches containing it
+
+    def load(self, cursor):
+
+        """
+        Replace the index by the searches having feedbacks in the database
+
+        Input:  cursor: connection to database
+        """
+
+        self.replace(
+            [
+                row[0]
+                for row in cursor.execute(
+                    "SELECT DISTINCT user_search FROM feedback_aggregate;"
+                )
+            ]
+        )
+
+    def replace(self, search_keys):
+
+        """
+        Replace the index by a list of searches
+
+        Input:  search_keys: searches normalized by sql_query.normalize_search
+        """
+
+        with self.lock:
+            self.clear()
+            for search_key in search_keys:
+                self.store(search_key)
+
+    def add(self, search_key):
+
+        """
+        Add a search to the index if it is not there yet
+
+        Input:  search_key: search normalized by sql_query.normalize_search
+
+        Output: True if the search was added, False if it was already there
+        """
+
+        with self.lock:
+            return self.store(search_key)
+
+    def store(self, search_key):
+
+        if search_key in self.search_ids:
+            return False
+
+        # A new search can be similar to any search looked up so far
+        self.lookups.clear()
+
+        search_id = len(self.search_keys)
+        self.search_ids[search_key] = search_id
+        self.search_keys.append(search_key)
+
+        grams = search_grams(search_key)
+        self.gram_counts.append(len(grams))
+
+        for gram in grams:
+            if gram not in self.postings:
+                self.postings[gram] = array("i")
+            self.postings[gram].append(search_id)
+
+        return True
+
+    def similar_searches(self, search_key, count, min_similarity):
+
+        """
+        Input:  search_key: search normalized by sql_query.normalize_search
+                count: maximum number of similar searches returned
+                min_similarity: minimum similarity of the searches returned
+
+        Output: list of (search key, similarity) of the most similar searches, the search itself excluded,
+                the similarity being the Dice coefficient 2 * shared grams / (grams of both searches)
+        """
+
+        with self.lock:
+
+            key = (search_key, count, min_similarity)
+            similar = self.lookups.get(key)
+
+            if similar is cache.missing:
+                similar = self.find_similar_searches(search_key, count, min_similarity)
+                self.lookups.set(key, similar)
+
+            return list(similar)
+
+    def find_similar_searches(self, search_key, count, min_similarity):
+
+        """
+        Find the similar searches of a search in the postings, see similar_searches.
+        The lock must be held by the caller, the buffers of the postings are read while the arrays can't grow.
+        """
+
+        grams = search_grams(search_key)
+
+        if count <= 0 or len(grams) == 0:
+            return []
+
+        # A search B reaching min_similarity shares at least min_shared grams with the search A, whatever its length.
+        # The ids of the searches are sorted in every posting since searches are only appended.
+        min_similarity = max(min_similarity, 1e-6)
+        min_shared = math.ceil(
+            min_similarity * len(grams) / (2 - min_similarity) - 1e-9
+        )
+
+        postings = sorted(
+            (self.postings.get(gram, array("i")) for gram in grams), key=len,
+        )
+
+        # Every search sharing min_shared grams has one of the len(grams) - min_shared + 1 rarest grams,
+        # candidates are only gathered from these and the other grams are checked for the candidates only
+        prefix_size = len(grams) - min_shared + 1
+        prefix = [
+            np.frombuffer(posting, dtype=np.int32)
+            for posting in postings[:prefix_size]
+            if 0 < len(posting) <= self.max_postings
+        ]
+
+        if len(prefix) == 0:
+            return []
+
+        candidates, shared_grams = np.unique(np.concatenate(prefix), return_counts=True)
+        del prefix
+
+        # Candidates are dropped as soon as the grams left can't bring them to min_shared
+        remaining_grams = len(postings) - prefix_size
+        for posting in postings[prefix_size:]:
+            remaining_grams -= 1
+            if len(posting) > self.max_postings:
+                continue
+            posting = np.frombuffer(posting, dtype=np.int32)
+            positions = np.minimum(
+                np.searchsorted(posting, candidates), len(posting) - 1
+            )
+            shared_grams += posting[positions] == candidates
+            keep = shared_grams + remaining_grams >= min_shared
+            candidates, shared_grams = candidates[keep], shared_grams[keep]
+            if len(candidates) == 0:
+                break
+        posting = None
+
+        candidate_grams = np.frombuffer(self.gram_counts, dtype=np.int32)[candidates]
+        similarities = 2 * shared_grams / (len(grams) + candidate_grams)
+
+        keep = similarities >= min_similarity
+        own_id = self.search_ids.get(search_key)
+        if own_id is not None:
+            keep &= candidates != own_id
+
+        candidates, similarities = candidates[keep], similarities[keep]
+
+        # Most similar first, the oldest search first among the same similarity
+        order = np.lexsort((candidates, -similarities))[:count]
+
+        return [
+            (self.search_keys[candidates[i]], float(similarities[i])) for i in order
+        ]
+
+
+searches = QueryIndex(
+    config.get_int("similar_searches_max_postings"),
+    config.get_int("similar_searches_cache_size"),
+)
@@ -1,35 +1,50 @@
+import contextvars
+import hashlib
 import json
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
 
+import bm25
+import cache
+import config
+import log_writer
+import metadata_scorer
+import metrics
+import query_index
 import sql_query
+import storage
 
 data_path = Path("data")
 
+scoring_executor = None
 
-def second_key_from_tuple(tuple):
-    """
-    Return second value of a tuple, used for sorting array of dimension [n, 2] on the second value
-    """
-
-    return tuple[1]
 
-
-def sort_array_of_tuple_with_second_value(array):
+def feedback_scores_from_counts(counts):
 
     """
-    Return an array of tuple sorted by second key values
+    Compute the feedback scores from the feedback counts of the results
+    Input:  counts: array of shape (n, 3) of (chosen, ignored, total) of each result for that search, counts borrowed
+                    from similar searches being weighted by their similarity,
+                    chosen: number of times the result was chosen, ignored: number of times it was not chosen,
+                    total: number of times it was proposed
+    Output: vector of the feedback scores, default value to 0.4 if no feedbacks available
     """
 
-    array.sort(key=second_key_from_tuple, reverse=True)
+    base_score = 0.4
 
-    return array
+    counts = np.asarray(counts, dtype=float).reshape(-1, 3)
+    chosen, ignored, total = counts[:, 0], counts[:, 1], counts[:, 2]
 
+    # remove a point for every 10 users that didn't choose it
+    chosen = chosen - np.floor(ignored / 10)
 
-def remove_second_key_from_array_of_tuple(array):
+    feedback_scores = np.full(len(counts), base_score)
+    has_feedback = total > 0
+    feedback_scores[has_feedback] += chosen[has_feedback] / total[has_feedback]
 
-    return [array[i][0] for i in range(len(array))]
+    return np.clip(feedback_scores, 0, 1)
 
 
 def compute_feedback_score(user_search, result):
@@ -54,130 +69,679 @@ def compute_feedback_score(user_search, result):
     return feedback_score
     """
 
-    # get feedback for that particular keyword1 -> keyword2 sequence (TODO: check for similar search?)
-    feedbacks = sql_query.get_feedback_for_reranking(user_search, result)
-    chosen = 0
-    ignored = 0
-    base_score = 0.4
-    if feedbacks is not None and len(feedbacks) > 0:
-        for feedback in feedbacks:
-            if feedback == 1:
-                chosen += 1
-            if feedback == -1:
-                ignored += 1
+    # get feedback for that particular keyword1 -> keyword2 sequence, and for the similar searches
+    return float(
+        feedback_scores_from_counts(get_feedback_counts(user_search, [result]))[0]
+    )
 
-        # remove a point for every 10 users that didn't choose it
-        chosen -= int(ignored / 10)
 
-        feedback_score = base_score + (chosen / len(feedbacks))
+class FeedbackLookup:
 
-    else:
-        feedback_score = base_score
+    """
+    Feedback counts of the searches of a reranking or of a batch of rerankings, with the similar searches
+    of each one, read from the cache and from the storage once before the results are scored
+    """
+
+    def __init__(self):
+
+        self.similar = {}  # search key -> list of (similar search key, similarity)
+        self.counts = {}  # (search key, result identity) -> (chosen, ignored, total)
 
-    # print(result.title, ":", max(0, min(feedback_score, 1)))
+    def get(self, search_key, identities):
 
-    return max(0, min(feedback_score, 1))
+        """
+        Output: array of shape (n, 3) of the counts of the results of identities for the search
+        """
 
+        return np.array(
+            [self.counts[(search_key, identity)] for identity in identities],
+            dtype=float,
+        ).reshape(-1, 3)
 
-def add_feedback_score_to_results(user_search, results_list):
+
+def prefetch_feedback_counts(lookups):
 
     """
-    Get feedback score for each result in result_list
+    Read the feedback counts of several results lists at once: the similar searches of every search are found,
+    the counts already cached are reused and the others are read from the storage in one call
+
+    Input:  lookups: list of (user_search, results_list, identities) scored with their feedbacks,
+                     identities being the sql_query.result_identity of each result
+
+    Output: FeedbackLookup holding the counts of every result for its search and their similar searches
+    """
+
+    prefetched = FeedbackLookup()
+    missed = {}  # search key -> {identity: result}
+
+    for user_search, results_list, identities in lookups:
+
+        search_key = sql_query.normalize_search(user_search)
+
+        if search_key not in prefetched.similar:
+            prefetched.similar[search_key] = query_index.searches.similar_searches(
+                search_key,
+                config.get_int("similar_searches_count"),
+                config.get_float("similar_searches_min_similarity"),
+            )
+
+        keys = [search_key] + [
+            key for key, similarity in prefetched.similar[search_key]
+        ]
+
+        for result, identity in zip(results_list, identities):
+            for key in keys:
+                if (key, identity) in prefetched.counts or identity in missed.get(
+                    key, ()
+                ):
+                    continue
+                counts = cache.feedback_counts.get((key, identity, None))
+                if counts is cache.missing:
+                    missed.setdefault(key, {})[identity] = result
+                else:
+                    prefetched.counts[(key, identity)] = counts
+
+    if len(missed) > 0:
+
+        cache_version = cache.feedback_counts.version()
+
+        # Feedback counts not cached are fetched at once instead of one query per search and result
+        missed_counts = storage.backend.get_feedback_counts_batch(
+            [(key, list(results.values())) for key, results in missed.items()]
+        )
+
+        for (key, results), counts_list in zip(missed.items(), missed_counts):
+            for identity, counts in zip(results, counts_list):
+                prefetched.counts[(key, identity)] = counts
+                cache.feedback_counts.set(
+                    (key, identity, None),
+                    counts,
+                    groups=[(key, identity)],
+                    version=cache_version,
+                )
+
+    return prefetched
+
+
+def get_feedback_counts(user_search, results_list, prefetched=None, identities=None):
+
+    """
+    Get the feedback counts of each result in result_list, the counts of the most similar past searches
+    are added weighted by their similarity
 
     Input:  user_search: keyword entered by the user
             results_list: list of proposed result to the user
+            prefetched: FeedbackLookup holding the counts of these results, read from the storage if not given
+            identities: sql_query.result_identity of each result, computed if not given
 
-    Output: list of type ((result_url, result_title), feedback_score)
+    Output: array of shape (n, 3) of (chosen, ignored, total) of each result
     """
 
-    new_list = []
+    if identities is None:
+        identities = [sql_query.result_identity(result) for result in results_list]
 
-    for result in results_list:
+    if prefetched is None:
+        prefetched = prefetch_feedback_counts([(user_search, results_list, identities)])
 
-        feedback_score = compute_feedback_score(user_search, result)
+    search_key = sql_query.normalize_search(user_search)
 
-        print(feedback_score, result.title)
+    feedback_counts = prefetched.get(search_key, identities)
 
-        new_list.append((result, feedback_score))
+    for similar_key, similarity in prefetched.similar[search_key]:
+        feedback_counts += similarity * prefetched.get(similar_key, identities)
 
-    return new_list
+    return feedback_counts
 
 
-def add_reranking_to_db(
-    conversation_id, user_search, data, final_data, flag_feedback, flag_metadata
+def combine_signals(signals, weights):
+
+    """
+    Input:  signals: dict of name -> vector of the scores of the results for that signal
+            weights: dict of name -> weight of the signal, missing signals weigh 1
+
+    Output: vector of the weighted sum of the signals
+    """
+
+    names = list(signals)
+    matrix = np.vstack([signals[name] for name in names])
+    weight_vector = np.array([weights.get(name, 1.0) for name in names])
+
+    return weight_vector @ matrix
+
+
+def rank_order(scores, tiebreak=None, top_k=None):
+
+    """
+    Input:  scores: vector of the scores of the results
+            tiebreak: vector ordering the results with the same score, lowest first, default to their index
+            top_k: if given, only the top_k best results are sorted and returned
+
+    Output: indices of the results by decreasing score
+    """
+
+    scores = np.asarray(scores, dtype=float)
+    if tiebreak is None:
+        tiebreak = np.arange(len(scores))
+    tiebreak = np.asarray(tiebreak)
+
+    candidates = np.arange(len(scores))
+
+    if top_k is not None and top_k < len(scores):
+        # Only the results scoring at least as much as the top_k-th one are sorted
+        kth_score = scores[np.argpartition(-scores, top_k - 1)[top_k - 1]]
+        candidates = np.flatnonzero(scores >= kth_score)
+
+    order = candidates[np.lexsort((tiebreak[candidates], -scores[candidates]))]
+
+    return order[:top_k]
+
+
+def get_scoring_executor():
+
+    """
+    Output: thread pool scoring the results lists of a search concurrently, started on its first use
+    """
+
+    global scoring_executor
+
+    if scoring_executor is None:
+        scoring_executor = ThreadPoolExecutor(
+            max_workers=config.get_int("scoring_threads"), thread_name_prefix="scoring"
+        )
+
+    return scoring_executor
+
+
+def shutdown_scoring():
+
+    """
+    Wait for the running scorings to finish and stop the threads
+    """
+
+    global scoring_executor
+
+    if scoring_executor is not None:
+        scoring_executor.shutdown(wait=True)
+        scoring_executor = None
+
+
+def score_results_list(
+    user_search,
+    results_list,
+    use_feedback,
+    use_metadata,
+    use_lexical,
+    prefetched=None,
+    identities=None,
+):
+
+    """
+    Score the results of one source
+
+    Input:  user_search: keyword entered by the user
+            results_list: results of the source, in the order returned by the source
+            use_feedback: if True, score the results with their feedbacks
+            use_metadata: if True, score the results with the affinity of the search for their tags, groups and owner_org
+            use_lexical: if True, score the results with the BM25 relevance of their text for the search
+            prefetched: FeedbackLookup holding the feedback counts of the results, see prefetch_feedback_counts
+            identities: sql_query.result_identity of each result, computed if not given
+
+    Output: vector of the scores of the results, in the order of results_list
+    """
+
+    if identities is None and (use_feedback or use_lexical):
+        identities = [sql_query.result_identity(result) for result in results_list]
+
+    signals = {}
+
+    if use_feedback:
+        with metrics.stage("feedback"):
+            signals["feedback"] = feedback_scores_from_counts(
+                get_feedback_counts(user_search, results_list, prefetched, identities)
+            )
+
+    if use_metadata:
+        with metrics.stage("metadata"):
+            signals["metadata"] = metadata_scorer.affinities.scores(
+                user_search, results_list
+            )
+
+    if use_lexical:
+        with metrics.stage("lexical"):
+            signals["lexical"] = bm25.index.scores(
+                user_search, results_list, identities
+            )
+
+    if len(signals) == 0:
+        # Without any signal the results are only ranked by their position in the source
+        return 1 / (1 + np.arange(len(results_list), dtype=float))
+
+    return combine_signals(signals, config.get_weights("signal_weights"))
+
+
+def fuse_rankings(
+    sources,
+    source_scores,
+    strategy,
+    rrf_k=60,
+    source_weights=None,
+    top_k=None,
+    source_identities=None,
 ):
 
+    """
+    Merge the scored results lists of several sources into one ranking,
+    a result returned by several sources is kept once, identified by sql_query.result_identity
+
+    Input:  sources: list of (api_hostname, results_list), results_list in the order returned by the source
+            source_scores: vector of the scores of the results of each source, see score_results_list
+            strategy: "rrf" to sum weight / (rrf_k + rank) over the sources of a result (reciprocal rank fusion),
+                      "weighted" to sum weight * score
+            rrf_k: rank offset of the reciprocal rank fusion
+            source_weights: weight of each api_hostname, missing sources weigh 1
+            top_k: if given, only the top_k best results are returned
+            source_identities: sql_query.result_identity of the results of each source, computed if not given
+
+    Output: list of (result, origin_source, old_rank) sorted by decreasing fused score, origin_source being the source
+            where the result had its best rank before reranking, and old_rank that rank
+    """
+
+    if source_weights is None:
+        source_weights = {}
+
+    if source_identities is None:
+        source_identities = [
+            [sql_query.result_identity(result) for result in results_list]
+            for api_hostname, results_list in sources
+        ]
+
+    fused_ids = {}
+    results = []
+    origins = []
+    contributions = []
+
+    for source_index, ((api_hostname, results_list), scores, identities) in enumerate(
+        zip(sources, source_scores, source_identities)
+    ):
+
+        # Position in the source and fused id of every result, a result returned twice by the same source only counts once
+        positions = []
+        ids = []
+        seen = set()
+
+        for old_rank, (result, identity) in enumerate(zip(results_list, identities)):
+
+            if identity in seen:
+                continue
+            seen.add(identity)
+
+            if identity not in fused_ids:
+                fused_ids[identity] = len(results)
+                results.append(result)
+                origins.append([old_rank, source_index])
+            elif old_rank < origins[fused_ids[identity]][0]:
+                origins[fused_ids[identity]] = [old_rank, source_index]
+
+            positions.append(old_rank)
+            ids.append(fused_ids[identity])
+
+        positions = np.array(positions, dtype=np.int64)
+        scores = np.asarray(scores, dtype=float)[positions]
+
+        if len(sources) == 1:
+            # A single source keeps the order of its scores whatever the strategy, without sorting the whole list
+            contribution = scores
+        elif strategy == "weighted":
+            contribution = source_weights.get(api_hostname, 1.0) * scores
+        else:
+            ranks = np.empty(len(positions))
+            ranks[rank_order(scores, positions)] = np.arange(len(positions))
+            contribution = source_weights.get(api_hostname, 1.0) / (rrf_k + ranks + 1)
+
+        contributions.append((np.array(ids, dtype=np.int64), contribution))
+
+    fused_scores = np.zeros(len(results))
+    for ids, contribution in contributions:
+        np.add.at(fused_scores, ids, contribution)
+
+    # Ties are broken by the rank in the origin source, then by the order of the sources
+    origins = np.array(origins, dtype=np.int64).reshape(-1, 2)
+    tiebreak = origins[:, 0] * len(sources) + origins[:, 1]
+
+    return [
+        (results[i], sources[origins[i, 1]][0], int(origins[i, 0]))
+        for i in rank_order(fused_scores, tiebreak, top_k)
+    ]
+
+
+def reranking_log(
+    conversation_id,
+    user_search,
+    fused_results,
+    flag_feedback,
+    flag_metadata,
+    flag_lexical=0,
+):
+
+    """
+    Input:  fused_results: list of (result, origin_source, old_rank) in the final order, see fuse_rankings
+
+    Output: (conversation_id, user_search, proposed_results, methods_used) written by log_writer
+    """
+
     methods_used = ""
     if flag_feedback:
         methods_used += "feedback"
     if flag_metadata:
         methods_used += " metadata"
+    if flag_lexical:
+        methods_used += " lexical"
 
-    for i, result in enumerate(final_data):
-
-        old_rank = 0
+    return (
+        conversation_id,
+        user_search,
+        [
+            (result, old_rank, i, origin_source)
+            for i, (result, origin_source, old_rank) in enumerate(fused_results)
+        ],
+        methods_used,
+    )
 
-        for j, old_result in enumerate(data):
 
-            if result == old_result:
+def add_reranking_to_db(
+    conversation_id,
+    user_search,
+    fused_results,
+    flag_feedback,
+    flag_metadata,
+    flag_lexical=0,
+):
 
-                old_rank = j
+    """
+    Input:  fused_results: list of (result, origin_source, old_rank) in the final order, see fuse_rankings
+    """
 
-        sql_query.add_proposed_result(
-            conversation_id=conversation_id,
-            search=user_search,
-            result=result,
-            feedback=0,
-            old_rank=old_rank,
-            new_rank=i,
-            methods_used=methods_used,
+    # Written by the background log writer so that the response doesn't wait for the database
+    log_writer.writer.submit(
+        *reranking_log(
+            conversation_id,
+            user_search,
+            fused_results,
+            flag_feedback,
+            flag_metadata,
+            flag_lexical,
         )
+    )
 
 
-def rerank_results(conversation_id, user_search, data, use_feedback, use_metadata):
+def rerank_results(
+    conversation_id,
+    user_search,
+    data,
+    use_feedback,
+    use_metadata,
+    fusion=None,
+    top_k=None,
+    use_lexical=True,
+):
 
-    feedback_data = []
+    """
+    Rerank the results lists of every source and merge them into one list
+
+    Input:  conversation_id: id of the conversation where the search was done
+            user_search: keyword entered by the user
+            data: list of main.Results_List, one per source
+            use_feedback: if True, rank the results of each source with their feedbacks
+            use_metadata: if True, rank the results of each source with the metadata of the results chosen for that search
+            fusion: fusion strategy of the sources, "rrf" or "weighted", default to the fusion_strategy of the config
+            top_k: if given, only the top_k best results are returned
+            use_lexical: if True, rank the results of each source with the BM25 relevance of their text for the search
+
+    Output: list of results without duplicates
+    """
 
-    flag_feedback = 0
-    flag_metadata = 0
+    return rerank_batch(
+        [
+            (
+                conversation_id,
+                user_search,
+                data,
+                use_feedback,
+                use_metadata,
+                fusion,
+                top_k,
+                use_lexical,
+            )
+        ]
+    )[0]
 
-    if use_feedback:
 
-        flag_feedback = 1
+def rerank_batch(rerankings):
 
-        for result_list in data:
+    """
+    Rerank the results of several searches at once, see rerank_with_etags
 
-            if (
-                result_list.api_hostname == "datasud"
-            ):  # TODO Gérer plusieurs listes de résultats en entrée
+    Output: list of the reranked results of each search, in the order of rerankings
+    """
 
-                feedback_data = add_feedback_score_to_results(
-                    user_search, result_list.results_list
-                )
-                feedback_data = sort_array_of_tuple_with_second_value(feedback_data)
-                feedback_data = remove_second_key_from_array_of_tuple(feedback_data)
+    return [results for etag, results in rerank_with_etags(rerankings)]
 
-    else:
 
-        feedback_data = data
+def result_content(result):
 
-    if use_metadata:
+    """
+    Input:  result: object of type main.Result
 
-        flag_metadata = 1
+    Output: list of the values of every field of the result, groups as [name, description]
+    """
 
-        final_data = feedback_data  # TODO Gérer d'autre méthode de reranking
+    return [
+        [[group.name, group.description] for group in value]
+        if name == "groups" and value is not None
+        else value
+        for name, value in result.__dict__.items()
+    ]
 
-    else:
 
-        final_data = feedback_data
+def response_cache_key(
+    user_search, sources, use_feedback, use_metadata, use_lexical, fusion, top_k
+):
+
+    """
+    Input:  sources: list of (api_hostname, results_list), see fuse_rankings
+            other parameters: see rerank_results, fusion being resolved to a strategy
+
+    Output: canonical hash of a reranking query, two queries with the same hash get the same ranking
+            as long as the feedbacks they use don't change. The whole content of every result is part of it
+            since the metadata of a result change its lexical and metadata scores.
+    """
+
+    # The results are hashed together in a single pass, a hash per result costs more than the rest of a cached reranking
+    content = [
+        user_search,
+        [
+            [api_hostname, [result_content(result) for result in results_list]]
+            for api_hostname, results_list in sources
+        ],
+        bool(use_feedback),
+        bool(use_metadata),
+        bool(use_lexical),
+        fusion,
+        top_k,
+    ]
+
+    return hashlib.blake2b(
+        json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+        digest_size=16,
+    ).hexdigest()
+
+
+def rerank_with_etags(rerankings):
+
+    """
+    Rerank the results of several searches at once. A query already reranked is answered from cache.responses,
+    the others have their feedback counts read together, every results list is scored concurrently,
+    and the logs of every search are queued as one write.
+
+    Input:  rerankings: list of (conversation_id, user_search, data, use_feedback, use_metadata, fusion, top_k, use_lexical),
+                        see rerank_results
+
+    Output: list of (etag, reranked results) of each search, in the order of rerankings,
+            the etag changing whenever the ranking of the query changes
+    """
+
+    searches = []
 
-    add_reranking_to_db(
+    for (
         conversation_id,
         user_search,
-        data[0].results_list,
-        final_data,
-        flag_feedback,
-        flag_metadata,
-    )
+        data,
+        use_feedback,
+        use_metadata,
+        fusion,
+        top_k,
+        use_lexical,
+    ) in rerankings:
+
+        sources = [
+            (
+                getattr(result_list.api_hostname, "value", result_list.api_hostname),
+                result_list.results_list,
+            )
+            for result_list in data
+        ]
+        fusion = fusion or config.get_str("fusion_strategy")
+        key = response_cache_key(
+            user_search, sources, use_feedback, use_metadata, use_lexical, fusion, top_k
+        )
+
+        searches.append(
+            {
+                "conversation_id": conversation_id,
+                "user_search": user_search,
+                "sources": sources,
+                "use_feedback": use_feedback,
+                "use_metadata": use_metadata,
+                "use_lexical": use_lexical,
+                "fusion": fusion,
+                "top_k": top_k,
+                "key": key,
+                "cached": cache.responses.get(key),
+            }
+        )
+
+    missed = [search for search in searches if search["cached"] is cache.missing]
+    cache_version = cache.responses.version()
+
+    # The identities of the results are computed once and shared by the feedback lookup, the scoring and the fusion
+    for search in missed:
+        search["identities"] = [
+            [sql_query.result_identity(result) for result in results_list]
+            for api_hostname, results_list in search["sources"]
+        ]
+
+    # The feedback counts of every results list are read before scoring, in one call to the storage
+    with metrics.stage("feedback_lookup"):
+        prefetched = prefetch_feedback_counts(
+            [
+                (search["user_search"], results_list, identities)
+                for search in missed
+                if search["use_feedback"]
+                for (api_hostname, results_list), identities in zip(
+                    search["sources"], search["identities"]
+                )
+            ]
+        )
+
+    tasks = [
+        (
+            search["user_search"],
+            results_list,
+            search["use_feedback"],
+            search["use_metadata"],
+            search["use_lexical"],
+            prefetched,
+            identities,
+        )
+        for search in missed
+        for (api_hostname, results_list), identities in zip(
+            search["sources"], search["identities"]
+        )
+    ]
+
+    # Every results list is scored in its own thread, a single one is scored right away.
+    # The threads run in a copy of the context of the request so that their SQL statements are counted for it.
+    if len(tasks) > 1:
+        scores = list(
+            get_scoring_executor().map(
+                lambda context, arguments: context.run(score_results_list, *arguments),
+                [contextvars.copy_context() for task in tasks],
+                tasks,
+            )
+        )
+    else:
+        scores = [score_results_list(*task) for task in tasks]
+
+    for search in missed:
+
+        source_scores = scores[: len(search["sources"])]
+        scores = scores[len(search["sources"]) :]
+
+        with metrics.stage("sorting"):
+            fused_results = fuse_rankings(
+                search["sources"],
+                source_scores,
+                search["fusion"],
+                config.get_int("fusion_rrf_k"),
+                config.get_weights("fusion_source_weights"),
+                search["top_k"],
+                search["identities"],
+            )
+
+        # The key covers the content of every source, a result is then told apart by its origin source and rank
+        etag = hashlib.blake2b(
+            (
+                search["key"]
+                + "".join(
+                    "\x1f" + origin_source + "\x1f" + str(old_rank)
+                    for result, origin_source, old_rank in fused_results
+                )
+            ).encode("utf-8"),
+            digest_size=16,
+        ).hexdigest()
+        search["cached"] = (etag, fused_results)
+
+        # The ranking is dropped from the cache by the feedbacks and proposals of the search or of any search
+        # similar to it, see query_index.response_groups
+        cache.responses.set(
+            search["key"],
+            search["cached"],
+            groups=query_index.response_groups(
+                [sql_query.normalize_search(search["user_search"])]
+            ),
+            version=cache_version,
+        )
 
-    return final_data
+    # Cached rankings are logged too since the results are proposed again to the user
+    with metrics.stage("log_submit"):
+        log_writer.writer.submit_batch(
+            [
+                reranking_log(
+                    search["conversation_id"],
+                    search["user_search"],
+                    search["cached"][1],
+                    int(bool(search["use_feedback"])),
+                    int(bool(search["use_metadata"])),
+                    int(bool(search["use_lexical"])),
+                )
+                for search in searches
+            ]
+        )
+
+    return [
+        (
+            search["cached"][0],
+            [result for result, origin_source, old_rank in search["cached"][1]],
+        )
+        for search in searches
+    ]
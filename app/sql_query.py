@@ -1,6 +1,21 @@
+import hashlib
+import json
+import re
 import sqlite3
+import time
+import unicodedata
+from datetime import datetime, timezone
 
-database = "data/user_reranking_feedback.db"
+import bm25
+import cache
+import config
+import connection_manager
+import metadata_scorer
+import metrics
+import query_index
+import vocabulary
+
+database = connection_manager.database
 
 attributes = [
     "title",
@@ -28,6 +43,10 @@ def run_sql_command(cursor, sql_command, data):
 
         record = cursor.fetchall()
 
+        metrics.count_sql(
+            1, len(record) if len(record) > 0 else max(cursor.rowcount, 0)
+        )
+
         return record
 
     except sqlite3.Error as error:
@@ -51,6 +70,31 @@ def run_sql_command(cursor, sql_command, data):
         return None
 
 
+# Parameter: Database pointer, sql command, and the list of data to run the command with
+# Function: Run the sql command once for every data in a single call
+def run_sql_many(cursor, sql_command, data_list):
+
+    try:
+        cursor.executemany(sql_command, data_list)
+
+        metrics.count_sql(len(data_list), max(cursor.rowcount, 0))
+
+        return cursor.rowcount
+
+    except sqlite3.Error as error:
+
+        print(
+            "\nError while running this command: \n",
+            sql_command,
+            "\n",
+            error,
+            "\nNumber of data: ",
+            len(data_list),
+            "\n",
+        )
+        return None
+
+
 def add_new_tag(cursor, tag, portal):
 
     """
@@ -64,8 +108,11 @@ def add_new_tag(cursor, tag, portal):
 
     sqlite_add_tag_query = "INSERT INTO result_tag(name, portal) VALUES (?, ?);"
 
-    run_sql_command(cursor, sqlite_add_tag_query, (tag, portal))
-    return get_tag_id(cursor, tag, portal)
+    if run_sql_command(cursor, sqlite_add_tag_query, (tag, portal)) is None:
+        return None
+
+    vocabulary.tags_and_groups.add_tag(cursor.lastrowid, tag, portal)
+    return cursor.lastrowid
 
 
 def get_tag_id(cursor, tag, portal=None):
@@ -78,16 +125,24 @@ def get_tag_id(cursor, tag, portal=None):
             return None if tag not found
     """
 
+    vocabulary.tags_and_groups.ensure_loaded(cursor)
+
+    tag_id = vocabulary.tags_and_groups.get_tag_id(tag, portal)
+    if tag_id is not None:
+        return tag_id
+
+    # The tag may have been stored by another worker since the vocabulary was loaded
     if portal is not None:
         sqlite_get_tag_id_query = (
-            "SELECT id FROM result_tag WHERE name = ? and portal = ?;"
+            "SELECT id, portal FROM result_tag WHERE name = ? and portal = ?;"
         )
         tag_id = run_sql_command(cursor, sqlite_get_tag_id_query, [tag, portal])
     else:
-        sqlite_get_tag_id_query = "SELECT id FROM result_tag WHERE name = ?;"
+        sqlite_get_tag_id_query = "SELECT id, portal FROM result_tag WHERE name = ?;"
         tag_id = run_sql_command(cursor, sqlite_get_tag_id_query, [tag])
 
     if tag_id is not None and len(tag_id) > 0:
+        vocabulary.tags_and_groups.add_tag(tag_id[0][0], tag, tag_id[0][1])
         return tag_id[0][0]
     return None
 
@@ -102,10 +157,17 @@ def get_tag_name(cursor, tag_id):
             return None if tag not found
     """
 
-    sqlite_get_tag_name_query = "SELECT name FROM result_tag WHERE id = ?;"
+    vocabulary.tags_and_groups.ensure_loaded(cursor)
+
+    tag_name = vocabulary.tags_and_groups.get_tag_name(tag_id)
+    if tag_name is not None:
+        return tag_name
+
+    sqlite_get_tag_name_query = "SELECT name, portal FROM result_tag WHERE id = ?;"
     tag_name = run_sql_command(cursor, sqlite_get_tag_name_query, [tag_id])
 
     if tag_name is not None and len(tag_name) > 0:
+        vocabulary.tags_and_groups.add_tag(tag_id, tag_name[0][0], tag_name[0][1])
         return tag_name[0][0]
     return None
 
@@ -133,30 +195,6 @@ def get_result_tags_list(cursor, result_id):
     )
 
 
-def get_result_tags_ids(cursor, result_id):
-
-    """
-    Input:  cursor: connection to database
-            result_id: id of the result in the db
-
-    Output: return IDs of every tags linked to the result
-    """
-
-    sqlite_get_tags_ids_query = (
-        "SELECT tag_id FROM link_results_tags WHERE result_id = ?;"
-    )
-
-    tags_ids = run_sql_command(cursor, sqlite_get_tags_ids_query, [result_id])
-
-    if tags_ids is not None and len(tags_ids) > 0:
-        output_list = []
-        for tag_id in tags_ids:
-            output_list.append(tag_id[0])
-        return output_list
-    else:
-        return None
-
-
 def add_new_tag_result_link(cursor, result_id, tag, portal):
 
     tag_id = get_tag_id(cursor, tag, portal)
@@ -197,10 +235,18 @@ def add_new_group(cursor, group, portal):
         "INSERT INTO result_group(name, description, portal) VALUES (?, ?, ?);"
     )
 
-    run_sql_command(
-        cursor, sqlite_add_group_query, [group.name, group.description, portal]
+    if (
+        run_sql_command(
+            cursor, sqlite_add_group_query, [group.name, group.description, portal]
+        )
+        is None
+    ):
+        return None
+
+    vocabulary.tags_and_groups.add_group(
+        cursor.lastrowid, group.name, group.description, portal
     )
-    return get_group_id(cursor, group, portal)
+    return cursor.lastrowid
 
 
 def get_group_id(cursor, group, portal=None):
@@ -213,13 +259,22 @@ def get_group_id(cursor, group, portal=None):
             return None if group not found
     """
 
+    vocabulary.tags_and_groups.ensure_loaded(cursor)
+
+    group_id = vocabulary.tags_and_groups.get_group_id(
+        group.name, group.description, portal
+    )
+    if group_id is not None:
+        return group_id
+
+    # The group may have been stored by another worker since the vocabulary was loaded
     if group.description is not None:
         sqlite_get_group_id_query = (
-            "SELECT id FROM result_group WHERE name = ? and description = ?"
+            "SELECT id, portal FROM result_group WHERE name = ? and description = ?"
         )
     else:
         sqlite_get_group_id_query = (
-            "SELECT id FROM result_group WHERE name = ? and description IS ?"
+            "SELECT id, portal FROM result_group WHERE name = ? and description IS ?"
         )
 
     if portal is not None:
@@ -234,6 +289,9 @@ def get_group_id(cursor, group, portal=None):
         )
 
     if group_id is not None and len(group_id) > 0:
+        vocabulary.tags_and_groups.add_group(
+            group_id[0][0], group.name, group.description, group_id[0][1]
+        )
         return group_id[0][0]
     return None
 
@@ -248,13 +306,20 @@ def get_group_data(cursor, group_id):
             return None if group not found
     """
 
+    vocabulary.tags_and_groups.ensure_loaded(cursor)
+
+    group_data = vocabulary.tags_and_groups.get_group_data(group_id)
+    if group_data is not None:
+        return group_data
+
     sqlite_get_group_data_query = (
-        "SELECT name, description FROM result_group WHERE id = ?;"
+        "SELECT name, description, portal FROM result_group WHERE id = ?;"
     )
     group_data = run_sql_command(cursor, sqlite_get_group_data_query, [group_id])
 
     if group_data is not None and len(group_data) > 0:
-        return group_data[0]
+        vocabulary.tags_and_groups.add_group(group_id, *group_data[0])
+        return group_data[0][:2]
     return None
 
 
@@ -281,30 +346,6 @@ def get_result_groups_list(cursor, result_id):
     )
 
 
-def get_result_groups_ids(cursor, result_id):
-
-    """
-    Input:  cursor: connection to database
-            result_id: id of the result in the db
-
-    Output: return IDs of every groups linked to the result
-    """
-
-    sqlite_get_groups_ids_query = (
-        "SELECT group_id FROM link_results_groups WHERE result_id = ?;"
-    )
-
-    groups_ids = run_sql_command(cursor, sqlite_get_groups_ids_query, [result_id])
-
-    if groups_ids is not None and len(groups_ids) > 0:
-        output_list = []
-        for group_id in groups_ids:
-            output_list.append(group_id[0])
-        return output_list
-    else:
-        return None
-
-
 def add_new_group_result_link(cursor, result_id, group, portal):
 
     group_id = get_group_id(cursor, group, portal)
@@ -346,31 +387,87 @@ def build_query_data(result):
     return params
 
 
-def build_query_where(result, ignore_portal=False):
+def compute_result_identity(portal, url):
 
     """
-    Input:  result: object of type main.result
+    Input:  portal: data portal hosting the result
+            url: url of the result
 
-    Output: string with the format attribute1 = ? AND attribute2 = ? etc...
+    Output: stable identity key of the result, a dataset keeps it when its metadata change
     """
 
-    str_query = ""
-    ignored_attributes = ["tags", "groups", "portal"]
+    return hashlib.blake2b(
+        (portal + "\x1f" + url).encode("utf-8"), digest_size=16
+    ).hexdigest()
 
-    for attribute in result:
-        # tags and groups are not checked
-        if attribute[0] not in ignored_attributes:
-            if attribute[1] == None:
-                str_query += " " + attribute[0] + " IS NULL AND"
-            elif type(attribute[1]) == str:
-                str_query += " " + attribute[0] + ' = "' + attribute[1] + '" AND'
-            else:
-                str_query += " " + attribute[0] + " = " + attribute[1] + " AND"
 
-    if ignore_portal:
-        return str_query[: len(str_query) - 4] + ";"
-    else:
-        return str_query + ' portal = "' + result.portal + '"'
+def compute_result_fingerprint(metadata, tags, groups):
+
+    """
+    Input:  metadata: list of the result values, in the same order as attributes
+            tags: list of tag names, or None
+            groups: list of (name, description) of the groups, or None
+
+    Output: compact hash of the result content, used to detect a metadata change
+    """
+
+    content = [
+        list(metadata),
+        sorted(tags) if tags else [],
+        sorted([list(group) for group in groups], key=str) if groups else [],
+    ]
+
+    return hashlib.blake2b(
+        json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+        digest_size=8,
+    ).hexdigest()
+
+
+def result_identity(result):
+
+    """
+    Input:  result: object of type main.Result
+
+    Output: stable identity key of the result
+    """
+
+    return compute_result_identity(result.portal, result.url)
+
+
+def result_fingerprint(result):
+
+    """
+    Input:  result: object of type main.Result
+
+    Output: content hash of the result metadata, tags and groups
+    """
+
+    return compute_result_fingerprint(
+        build_query_data(result),
+        result.tags,
+        [(group.name, group.description) for group in result.groups]
+        if result.groups is not None
+        else None,
+    )
+
+
+def add_result_links(cursor, result_id, result):
+
+    """
+    Link the tags and groups of the result to its entry in the database
+
+    Input:  cursor: connection to database
+            result_id: id of the result in the db
+            result: object of type main.Result
+    """
+
+    if result.tags is not None:
+        for tag in result.tags:
+            add_new_tag_result_link(cursor, result_id, tag, result.portal)
+
+    if result.groups is not None:
+        for group in result.groups:
+            add_new_group_result_link(cursor, result_id, group, result.portal)
 
 
 def add_new_result_to_DB(cursor, result):
@@ -384,204 +481,905 @@ def add_new_result_to_DB(cursor, result):
     Output: return newly created result's id
     """
 
-    attribute_query = "(" + ", ".join(attributes) + ")"
-    value_query = "(" + "?, " * (len(attributes) - 1) + "?)"
+    columns = attributes + ["identity", "fingerprint"]
+    attribute_query = "(" + ", ".join(columns) + ")"
+    value_query = "(" + "?, " * (len(columns) - 1) + "?)"
     sqlite_add_result_to_db_query = (
         "INSERT INTO result" + attribute_query + " VALUES" + value_query + ";"
     )
 
-    data = build_query_data(result)
+    data = build_query_data(result) + [
+        result_identity(result),
+        result_fingerprint(result),
+    ]
 
     run_sql_command(cursor, sqlite_add_result_to_db_query, data)
 
-    result_id = get_result_ID(cursor, result, True)
+    result_id = get_result_ID(cursor, result)
 
-    if result.tags is not None:
-        for tag in result.tags:
-            add_new_tag_result_link(cursor, result_id, tag, result.portal)
+    add_result_links(cursor, result_id, result)
 
-    if result.groups is not None:
-        for group in result.groups:
-            add_new_group_result_link(cursor, result_id, group, result.portal)
+    bm25.index.add(result)
 
     return result_id
 
 
-def get_result_ID(cursor, result, ignore_tag_and_groups=False):
+def keep_result_links(result, tags, groups):
+
+    """
+    Input:  result: object of type main.Result
+            tags: list of the tag names already stored for the result, or None
+            groups: list of (name, description) of the groups already stored for the result, or None
+
+    Output: the result with the stored tags and groups in place of the ones it was sent without
+    """
+
+    kept = {}
+
+    if result.tags is None and tags:
+        kept["tags"] = list(tags)
+    if result.groups is None and groups:
+        kept["groups"] = [
+            {"name": name, "description": description} for name, description in groups
+        ]
+
+    if not kept:
+        return result
+
+    return result.__class__.parse_obj(dict(result.dict(), **kept))
+
+
+def update_result_in_DB(cursor, result_id, result, stored_fingerprint=None):
+
+    """
+    Replace the metadata, tags and groups of a result already in the database,
+    its id is kept so that its feedback history stays attached to it.
+    Tags or groups set to None are left as they are
+
+    Input:  cursor: connection to database
+            result_id: id of the result in the db
+            result: object of type main.Result
+            stored_fingerprint: fingerprint of the stored result, nothing is written if the result
+                                with the tags and groups it keeps has the same
+    """
+
+    # A result sent without its tags or groups keeps the ones already linked to it
+    stored = keep_result_links(
+        result,
+        get_result_tags_list(cursor, result_id) if result.tags is None else None,
+        get_result_groups_list(cursor, result_id) if result.groups is None else None,
+    )
+    fingerprint = result_fingerprint(stored)
+
+    if fingerprint == stored_fingerprint:
+        return
+
+    set_query = " = ?, ".join(attributes + ["fingerprint"]) + " = ?"
+    sqlite_update_result_query = "UPDATE result SET " + set_query + " WHERE id = ?;"
+
+    run_sql_command(
+        cursor,
+        sqlite_update_result_query,
+        build_query_data(stored) + [fingerprint, result_id],
+    )
+
+    if result.tags is not None:
+        run_sql_command(
+            cursor, "DELETE FROM link_results_tags WHERE result_id = ?;", [result_id]
+        )
+    if result.groups is not None:
+        run_sql_command(
+            cursor, "DELETE FROM link_results_groups WHERE result_id = ?;", [result_id],
+        )
+
+    add_result_links(cursor, result_id, result)
+
+    bm25.index.add(stored)
+
+
+def get_result_ID(cursor, result):
 
     """
     Input:  cursor: connection to database
             result: object of type main.Result
-            ignore_tag_and_groups: wether or not to ignore tags and groups attributes
-            ignore_portal: wether or not to ignore the portal attribute
     
     Output: ID of the result if it exist in the database
             return None if result not found
     """
 
-    sqlite_get_result_ID_query = (
-        "SELECT id FROM result WHERE" + build_query_where(result) + ";"
-    )
+    sqlite_get_result_ID_query = "SELECT id FROM result WHERE identity = ?;"
 
-    result_ids = run_sql_command(cursor, sqlite_get_result_ID_query, None)
+    result_ids = run_sql_command(
+        cursor, sqlite_get_result_ID_query, [result_identity(result)]
+    )
 
     if result_ids is not None and len(result_ids) > 0:
+        return result_ids[0][0]
+    return None
 
-        if ignore_tag_and_groups:
 
-            return result_ids[len(result_ids) - 1][0]
+def get_or_add_result_IDs(cursor, results_list):
 
-        else:
+    """
+    Input:  cursor: connection to database
+            results_list: list of objects of type main.Result
 
-            for r_ids in result_ids:
+    Output: list of the IDs of the results, with one query per chunk for the results already in the database.
+            Results not stored yet are added, and results whose metadata changed are updated.
+    """
 
-                result_id = r_ids[0]
+    identities = [result_identity(result) for result in results_list]
+    stored = {}
 
-                result_tag_ids = get_result_tags_ids(cursor, result_id)
-                if result_tag_ids is not None:
-                    result_tag_ids = sorted(result_tag_ids)
+    for chunk in chunked(list(set(identities))):
 
-                result_group_ids = get_result_groups_ids(cursor, result_id)
-                if result_group_ids is not None:
-                    result_group_ids = sorted(result_group_ids)
+        sqlite_get_results_query = "SELECT identity, id, fingerprint FROM result WHERE identity IN ({});".format(
+            ", ".join(["?"] * len(chunk))
+        )
 
-                if result.tags is not None:
-                    tag_ids = [
-                        get_tag_id(cursor, tag, result.portal) for tag in result.tags
-                    ]
-                    if None in tag_ids:
-                        return None
-                    else:
-                        tag_ids = sorted(tag_ids)
-                else:
-                    tag_ids = None
-
-                if result.groups is not None:
-                    group_ids = [
-                        get_group_id(cursor, group, result.portal)
-                        for group in result.groups
-                    ]
-                    if None in group_ids:
-                        return None
-                    else:
-                        group_ids = sorted(group_ids)
-                else:
-                    group_ids = None
+        record = run_sql_command(cursor, sqlite_get_results_query, chunk)
 
-                if tag_ids == result_tag_ids and group_ids == result_group_ids:
-                    return result_id
+        stored.update({row[0]: (row[1], row[2]) for row in record or []})
 
-    return None
+    result_ids = []
+
+    for identity, result in zip(identities, results_list):
+
+        if identity not in stored:
+            stored[identity] = (add_new_result_to_DB(cursor, result), None)
+        elif stored[identity][1] is not None:
+            if stored[identity][1] != result_fingerprint(result):
+                update_result_in_DB(
+                    cursor, stored[identity][0], result, stored[identity][1]
+                )
+            # Only check the first occurrence of a result in the list
+            stored[identity] = (stored[identity][0], None)
+
+        result_ids.append(stored[identity][0])
+
+    return result_ids
 
 
-def get_result_from_ID(cursor, result_id):
+def get_or_add_result_ID(cursor, result):
 
     """
     Input:  cursor: connection to database
-            result_id: id of the result
-    
-    Output: content of the result
-            return None if result not found
+            result: object of type main.Result
+
+    Output: ID of the result, the result is added to the database if it doesn't exist yet
+            and its metadata are updated if they changed since it was stored
+    """
+
+    sqlite_get_result_query = "SELECT id, fingerprint FROM result WHERE identity = ?;"
+
+    record = run_sql_command(cursor, sqlite_get_result_query, [result_identity(result)])
+
+    if record is None or len(record) == 0:
+        return add_new_result_to_DB(cursor, result)
+
+    result_id, fingerprint = record[0]
+
+    if fingerprint != result_fingerprint(result):
+        update_result_in_DB(cursor, result_id, result, fingerprint)
+
+    return result_id
+
+
+# Words ignored when comparing searches
+search_stopwords = {
+    "a",
+    "au",
+    "aux",
+    "avec",
+    "d",
+    "dans",
+    "de",
+    "des",
+    "du",
+    "en",
+    "et",
+    "l",
+    "la",
+    "le",
+    "les",
+    "ou",
+    "par",
+    "pour",
+    "sur",
+    "un",
+    "une",
+}
+
+
+def normalize_word(word):
+
+    """
+    Remove the mark of the plural of a word: barrages -> barrage, reseaux -> reseau
+    """
+
+    if len(word) > 3 and (
+        (word[-1] == "s" and word[-2] not in "siu")
+        or (word[-1] == "x" and word[-2] == "u")
+    ):
+        return word[:-1]
+
+    return word
+
+
+def search_words(text, keep_stopwords=False):
+
+    """
+    Input:  text: search or text of a result
+            keep_stopwords: if True, the stopwords are kept
+
+    Output: list of the words of the text in lower case without accents, punctuation nor plurals
+    """
+
+    without_accents = "".join(
+        character
+        for character in unicodedata.normalize("NFKD", text.lower())
+        if not unicodedata.combining(character)
+    )
+
+    return [
+        normalize_word(word)
+        for word in re.findall(r"\w+", without_accents)
+        if keep_stopwords or word not in search_stopwords
+    ]
+
+
+def normalize_search(user_search):
+
+    """
+    Input:  user_search: search entered by the user
+
+    Output: search used as key of the feedback aggregates, in lower case without accents, punctuation,
+            plurals nor stopwords, so that "Barrages électriques" and "barrage electrique" share their feedbacks
+    """
+
+    # A search made only of stopwords keeps them
+    return " ".join(
+        search_words(user_search) or search_words(user_search, keep_stopwords=True)
+    )
+
+
+# Half-life in days of the feedback counts used to score the results, 0 to never decay them
+feedback_half_life = config.get_float("feedback_half_life_days")
+
+epoch = datetime(1970, 1, 1)
+
+
+def current_day():
+
+    """
+    Output: number of days since 1970-01-01, the time of the decayed feedback counts
+    """
+
+    return time.time() / 86400
+
+
+def search_day(date):
+
+    """
+    Input:  date: date of a search as stored in the search table, yyyy-mm-dd optionally followed by the time
+
+    Output: number of days between 1970-01-01 and the date, the current day if the date can not be read
+    """
+
+    try:
+        moment = datetime.fromisoformat(str(date).strip())
+    except ValueError:
+        return current_day()
+
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return (moment - epoch).total_seconds() / 86400
+
+
+def decay_factor(days):
+
     """
+    Input:  days: age of a feedback in days
+
+    Output: weight of the feedback, halved every feedback_half_life days
+    """
+
+    if feedback_half_life <= 0 or days is None or days <= 0:
+        return 1.0
+
+    return 0.5 ** (days / feedback_half_life)
+
+
+def add_decayed_count(decayed_count, decayed_at, count, day):
+
+    """
+    Add a count to a decayed count without reading the feedback history again: both are decayed
+    to the most recent of their days, which becomes the day of the sum
+
+    Input:  decayed_count: count decayed to the day decayed_at
+            count: count given at the day day, negative values remove feedbacks
+
+    Output: sum of the counts decayed to max(decayed_at, day)
+    """
+
+    latest = max(decayed_at, day)
+
+    return max(
+        decayed_count * decay_factor(latest - decayed_at)
+        + count * decay_factor(latest - day),
+        0,
+    )
 
-    sqlite_get_result_data_query = "SELECT * from result WHERE id = " + str(result_id)
-    result = run_sql_command(cursor, sqlite_get_result_data_query, None)
+
+def add_decayed_counts(decayed_counts, decayed_at, counts, day):
+
+    """
+    Input:  decayed_counts: counts decayed to the day decayed_at
+            counts: counts given at the day day
+
+    Output: (sum of the counts, day of the sum), see add_decayed_count
+    """
 
     return (
-        {
-            "title": result[0][1],
-            "url": result[0][2],
-            "description": result[0][3],
-            "portal": result[0][4],
-            "owner_org": result[0][5],
-            "owner_org_description": result[0][6],
-            "maintainer": result[0][7],
-            "dataset_publication_date": result[0][8],
-            "dataset_modification_date": result[0][9],
-            "metadata_creation_date": result[0][10],
-            "metadata_modification_date": result[0][11],
-            "tags": get_result_tags_list(cursor, result_id),
-            "groups": [
-                {"name": group[0], "description": group[1]}
-                for group in get_result_groups_list(cursor, result_id)
-            ],
-        },
+        [
+            add_decayed_count(decayed_count, decayed_at, count, day)
+            for decayed_count, count in zip(decayed_counts, counts)
+        ],
+        max(decayed_at, day),
+    )
+
+
+# The python functions used by the queries below are added to every sqlite connection
+connection_manager.sql_functions += [
+    ("normalize_search", 1, normalize_search),
+    ("search_day", 1, search_day),
+    ("decay_factor", 1, decay_factor),
+    ("add_decayed_count", 4, add_decayed_count),
+]
+
+# Merge the counts inserted in an aggregate that already exists
+sqlite_merge_feedback_aggregate_clause = (
+    "ON CONFLICT(user_search, result_id, portal) DO UPDATE SET "
+    "chosen = chosen + excluded.chosen, ignored = ignored + excluded.ignored, total = total + excluded.total, "
+    + ", ".join(
+        "{0} = add_decayed_count({0}, decayed_at, excluded.{0}, excluded.decayed_at)".format(
+            column
+        )
+        for column in ["decayed_chosen", "decayed_ignored", "decayed_total"]
+    )
+    + ", decayed_at = MAX(decayed_at, excluded.decayed_at);"
+)
+
+# Add counts to the aggregate of (user_search, portal of the search, result), parameters are
+# (normalized search, result_id, chosen, ignored, total, search_id), the day of the counts being the date of the search
+sqlite_update_feedback_aggregate_query = (
+    "INSERT INTO feedback_aggregate(user_search, portal, result_id, chosen, ignored, total, "
+    "decayed_chosen, decayed_ignored, decayed_total, decayed_at) "
+    "SELECT ?1, portal, ?2, ?3, ?4, ?5, ?3, ?4, ?5, search_day(date) FROM search WHERE id = ?6 "
+    + sqlite_merge_feedback_aggregate_clause
+)
+
+# Add counts already summed to an aggregate, parameters are (normalized search, portal, result_id,
+# chosen, ignored, total, decayed chosen, decayed ignored, decayed total, day of the decayed counts),
+# the decayed counts being already merged with the stored ones, see merge_stored_aggregates
+sqlite_add_feedback_aggregate_query = (
+    "INSERT INTO feedback_aggregate(user_search, portal, result_id, chosen, ignored, total, "
+    "decayed_chosen, decayed_ignored, decayed_total, decayed_at) "
+    "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(user_search, result_id, portal) DO UPDATE SET "
+    "chosen = chosen + excluded.chosen, ignored = ignored + excluded.ignored, total = total + excluded.total, "
+    "decayed_chosen = excluded.decayed_chosen, decayed_ignored = excluded.decayed_ignored, "
+    "decayed_total = excluded.decayed_total, decayed_at = excluded.decayed_at;"
+)
+
+
+# Values bound to an IN (...) list per query, a query with two such lists stays under the 999 parameters
+# allowed by older sqlite versions
+sql_chunk_size = 300
+
+
+def chunked(values):
+
+    """
+    Input:  values: list of the values of an IN (...) list
+
+    Output: list of the chunks of sql_chunk_size values to query one after the other
+    """
+
+    return [
+        values[index : index + sql_chunk_size]
+        for index in range(0, len(values), sql_chunk_size)
+    ]
+
+
+def merge_stored_aggregates(cursor, aggregates):
+
+    """
+    Add the decayed counts already stored to the aggregates of a batch, so that they are written as plain values
+    instead of calling add_decayed_count for every row of the upsert. Must run in the write transaction
+    of the batch so that the stored counts do not change meanwhile.
+
+    Input:  cursor: connection to database
+            aggregates: dict of (search key, portal, result_id) -> [chosen, ignored, total, decayed chosen,
+                        decayed ignored, decayed total, day of the decayed counts], updated in place
+    """
+
+    keys = list(aggregates)
+
+    # 300 keys of 3 parameters stay under the 999 parameters allowed by older sqlite versions
+    for index in range(0, len(keys), 300):
+
+        chunk = keys[index : index + 300]
+        stored_rows = cursor.execute(
+            "SELECT f.user_search, f.portal, f.result_id, f.decayed_chosen, f.decayed_ignored, f.decayed_total, "
+            "f.decayed_at FROM (VALUES {}) AS k JOIN feedback_aggregate AS f ON f.user_search = k.column1 "
+            "AND f.portal = k.column2 AND f.result_id = k.column3;".format(
+                ", ".join(["(?, ?, ?)"] * len(chunk))
+            ),
+            [value for key in chunk for value in key],
+        ).fetchall()
+
+        for search_key, portal, result_id, *decayed_counts, decayed_at in stored_rows:
+
+            # Same sum as add_decayed_counts, with the decay factors computed once per aggregate
+            aggregate = aggregates[(search_key, portal, result_id)]
+            latest = max(decayed_at, aggregate[6])
+            stored_weight = decay_factor(latest - decayed_at)
+            weight = decay_factor(latest - aggregate[6])
+            aggregate[3:7] = [
+                decayed_count * stored_weight + count * weight
+                for decayed_count, count in zip(decayed_counts, aggregate[3:6])
+            ] + [latest]
+
+
+def update_feedback_aggregate(
+    cursor, search, search_id, result_id, chosen, ignored, total
+):
+
+    """
+    Add feedback counts to the aggregate of a (search, portal, result), the portal is the one of the search
+
+    Input:  cursor: connection to database
+            search: search entered by the user
+            search_id: id of the search in the db
+            result_id: id of the result in the db
+            chosen, ignored, total: counts to add, negative values remove feedbacks
+    """
+
+    run_sql_command(
+        cursor,
+        sqlite_update_feedback_aggregate_query,
+        (normalize_search(search), result_id, chosen, ignored, total, search_id),
+    )
+
+
+def rebuild_feedback_aggregates(cursor, result_ids=None):
+
+    """
+    Recompute the feedback_aggregate table from the search_reranking_feedback history,
+    the decayed counts being decayed to the current day
+
+    Input:  cursor: connection to database
+            result_ids: ids of the results whose aggregates are recomputed, None for every result
+
+    Output: number of aggregates stored
+    """
+
+    if result_ids is None:
+        delete_condition, insert_condition, data = "", "", ()
+    else:
+        data = tuple(result_ids)
+        placeholders = ", ".join(["?"] * len(data))
+        delete_condition = " WHERE result_id IN ({})".format(placeholders)
+        insert_condition = " WHERE srf.result_id IN ({})".format(placeholders)
+
+    day = current_day()
+
+    cursor.execute("DELETE FROM feedback_aggregate" + delete_condition + ";", data)
+    cursor.execute(
+        "WITH weighted AS (SELECT normalize_search(s.user_search) AS user_search, s.portal AS portal, "
+        "srf.result_id AS result_id, srf.feedback AS feedback, decay_factor(? - search_day(s.date)) AS weight "
+        "FROM search_reranking_feedback AS srf JOIN search AS s ON s.id = srf.search_id"
+        + insert_condition
+        + ") INSERT INTO feedback_aggregate(user_search, portal, result_id, chosen, ignored, total, "
+        "decayed_chosen, decayed_ignored, decayed_total, decayed_at) "
+        "SELECT user_search, portal, result_id, SUM(feedback = 1), SUM(feedback = -1), COUNT(*), "
+        "SUM((feedback = 1) * weight), SUM((feedback = -1) * weight), SUM(weight), ? "
+        "FROM weighted GROUP BY 1, 2, 3;",
+        (day,) + data + (day,),
     )
 
+    return cursor.execute("SELECT COUNT(*) FROM feedback_aggregate;").fetchone()[0]
+
 
 # Function: Add a new search entry in the database
 def add_new_search_query(conversation_id, user_search, portal, date):
 
     try:
 
-        sqliteConnection = sqlite3.connect(database)
-        cursor = sqliteConnection.cursor()
-
-        sqlite_insert_search_query = "INSERT INTO search(conversation_id, user_search, portal, date) VALUES(?, ?, ?, ?);"
-        run_sql_command(
-            cursor,
-            sqlite_insert_search_query,
-            (conversation_id, user_search, portal, date),
-        )
+        with connection_manager.transaction() as cursor:
 
-        sqliteConnection.commit()
+            sqlite_insert_search_query = "INSERT INTO search(conversation_id, user_search, portal, date) VALUES(?, ?, ?, ?);"
+            run_sql_command(
+                cursor,
+                sqlite_insert_search_query,
+                (conversation_id, user_search, portal, date),
+            )
 
-        cursor.close()
-        sqliteConnection.close()
+        # The feedbacks given to this search can now be borrowed by the similar ones
+        search_key = normalize_search(user_search)
+        if query_index.searches.add(search_key):
+            cache.responses.invalidate_groups(query_index.response_groups([search_key]))
 
     except sqlite3.Error as error:
         print("-ADD_NEW_SEARCH_QUERY-\nError while connecting to sqlite", error, "\n")
 
 
-# Function: Add the proposed result in the database
-def add_proposed_result(
-    conversation_id, search, result, feedback, old_rank, new_rank, methods_used,
+def store_proposed_results(
+    cursor, conversation_id, search, proposed_results, methods_used, feedback=0
 ):
 
-    try:
+    """
+    Store the results proposed for a search in the search_reranking_feedback table
+
+    Input:  cursor: connection to database
+            conversation_id: id of the conversation where the search was done
+            search: search entered by the user
+            proposed_results: list of (result, old_rank, new_rank, origin_source), result being an object of type main.Result,
+                              old_rank the rank of the result in its origin_source, the api_hostname it came from
+            methods_used: reranking methods used to rank the results
+            feedback: initial feedback of the results
+
+    Output: identities of the results stored, results already stored for that search are skipped
+    """
+
+    proposed_identities = []
+
+    search_id = get_search_id_from_conv_id_and_search(cursor, conversation_id, search)
+
+    if search_id is None or len(proposed_results) == 0:
+        return proposed_identities
+
+    result_ids = get_or_add_result_IDs(
+        cursor, [proposed[0] for proposed in proposed_results]
+    )
+
+    check_reranking_entries_exist_already = (
+        "SELECT result_id from search_reranking_feedback WHERE search_id = ?;"
+    )
+
+    record = run_sql_command(cursor, check_reranking_entries_exist_already, [search_id])
+
+    stored_ids = set(row[0] for row in record or [])
+
+    feedback_rows = []
+    aggregate_rows = []
+    search_key = normalize_search(search)
+
+    for result_id, (result, old_rank, new_rank, origin_source) in zip(
+        result_ids, proposed_results
+    ):
 
-        sqliteConnection = sqlite3.connect(database)
-        cursor = sqliteConnection.cursor()
+        if result_id in stored_ids:
+            continue
+        stored_ids.add(result_id)
 
-        search_id = get_search_id_from_conv_id_and_search(
-            cursor, conversation_id, search
+        feedback_rows.append(
+            (
+                search_id,
+                old_rank,
+                new_rank,
+                result_id,
+                feedback,
+                methods_used,
+                origin_source,
+            )
+        )
+        aggregate_rows.append(
+            (
+                search_key,
+                result_id,
+                int(feedback == 1),
+                int(feedback == -1),
+                1,
+                search_id,
+            )
         )
+        proposed_identities.append(result_identity(result))
 
-        if search_id is not None:
+    sqlite_insert_result_feedback_query = "INSERT INTO search_reranking_feedback(search_id, old_rank, new_rank, result_id, feedback, methods_used, origin_source) VALUES(?, ?, ?, ?, ?, ?, ?);"
 
-            result_id = get_result_ID(cursor, result)
+    run_sql_many(cursor, sqlite_insert_result_feedback_query, feedback_rows)
+    run_sql_many(cursor, sqlite_update_feedback_aggregate_query, aggregate_rows)
 
-            if result_id is None:
-                result_id = add_new_result_to_DB(cursor, result)
+    return proposed_identities
 
-            check_reranking_entry_exist_already = "SELECT id from search_reranking_feedback WHERE search_id = ? AND result_id = ?;"
 
-            record = run_sql_command(
-                cursor, check_reranking_entry_exist_already, (search_id, result_id)
+def add_proposed_results_batch(rerankings):
+
+    """
+    Store the results proposed for several searches in a single transaction
+
+    Input:  rerankings: list of (conversation_id, search, proposed_results, methods_used, feedback),
+                        see store_proposed_results
+    """
+
+    stored = []
+
+    try:
+
+        with connection_manager.transaction() as cursor:
+
+            for (
+                conversation_id,
+                search,
+                proposed_results,
+                methods_used,
+                feedback,
+            ) in rerankings:
+
+                proposed_identities = store_proposed_results(
+                    cursor,
+                    conversation_id,
+                    search,
+                    proposed_results,
+                    methods_used,
+                    feedback,
+                )
+                stored.append((search, proposed_identities, feedback))
+
+        # The cached counts of the results get the new proposition instead of being dropped,
+        # with its full weight as the searches reranked by the API were just made
+        for search, proposed_identities, feedback in stored:
+            cache.feedback_counts.update_groups(
+                [
+                    (normalize_search(search), identity)
+                    for identity in proposed_identities
+                ],
+                lambda counts: (
+                    counts[0] + int(feedback == 1),
+                    counts[1] + int(feedback == -1),
+                    counts[2] + 1,
+                ),
+            )
+
+        # The new propositions change the totals the rankings of the search and of the similar ones are scored with
+        cache.responses.invalidate_groups(
+            query_index.response_groups(
+                [
+                    normalize_search(search)
+                    for search, proposed_identities, feedback in stored
+                    if len(proposed_identities) > 0
+                ]
             )
+        )
+
+    except sqlite3.Error as error:
+        print("-ADD_PROPOSED_RESULTS\nError while connecting to sqlite", error, "\n")
+
+        cache.feedback_counts.invalidate_groups(
+            [
+                (normalize_search(search), result_identity(proposed[0]))
+                for conversation_id, search, proposed_results, methods_used, feedback in rerankings
+                for proposed in proposed_results
+            ]
+        )
+
 
-            if record is not None and len(record) > 0:
-                return
+def import_searches(searches, stored_results=None):
+
+    """
+    Store searches with their feedbacks in one transaction, the results, tags and groups being resolved
+    once for the whole batch and the searches, feedbacks and aggregates inserted with executemany
+
+    Input:  searches: list of (conversation_id, user_search, search_target, portal, date, feedbacks),
+                      feedbacks being a list of (result, old_rank, new_rank, feedback, methods_used, origin_source)
+                      and result an object of type main.Result
+            stored_results: dict of result identity -> (id, result) of the results stored by the previous batches
+                            of the same import, a result given again as the same object is not checked again.
+                            It is updated with the results of the batch once it is committed.
+
+    Output: number of feedbacks stored, a result given twice for a search is stored once
+    """
 
+    if stored_results is None:
+        stored_results = {}
+
+    # A result found several times in the batch is stored with its last metadata,
+    # the identity of each result object is computed once
+    results = {}
+    identities = {}
+    for search in searches:
+        for proposed in search[5]:
+            if id(proposed[0]) not in identities:
+                identities[id(proposed[0])] = result_identity(proposed[0])
+            results[identities[id(proposed[0])]] = proposed[0]
+
+    # The key and the day of a search are computed once per distinct search and date
+    search_keys = {search[1]: None for search in searches}
+    for user_search in search_keys:
+        search_keys[user_search] = normalize_search(user_search)
+    days = {search[4]: None for search in searches}
+    for date in days:
+        days[date] = search_day(date)
+
+    # The decayed counts of the batch are all decayed to its most recent day,
+    # so that each search weighs its feedbacks with a single factor
+    batch_day = max(days.values(), default=current_day())
+    weights = {date: decay_factor(batch_day - day) for date, day in days.items()}
+
+    feedback_rows = []
+    # (search key, portal, result_id) -> [chosen, ignored, total, decayed chosen, decayed ignored,
+    # decayed total, day of the decayed counts], the feedbacks of a batch are summed before being stored
+    aggregates = {}
+
+    with connection_manager.transaction() as cursor:
+
+        result_ids = {}
+        changed_results = {}
+
+        for identity, result in results.items():
+            if identity in stored_results and stored_results[identity][1] is result:
+                result_ids[identity] = stored_results[identity][0]
             else:
+                changed_results[identity] = result
 
-                sqlite_insert_result_feedback_query = "INSERT INTO search_reranking_feedback(search_id, old_rank, new_rank, result_id, feedback, methods_used) VALUES(?, ?, ?, ?, ?, ?);"
+        if len(changed_results) > 0:
+            result_ids.update(
+                zip(
+                    changed_results,
+                    get_or_add_result_IDs(cursor, list(changed_results.values())),
+                )
+            )
 
-                run_sql_command(
-                    cursor,
-                    sqlite_insert_result_feedback_query,
-                    (search_id, old_rank, new_rank, result_id, feedback, methods_used,),
+        # id of each result object of the batch
+        object_ids = {
+            object_id: result_ids[identity]
+            for object_id, identity in identities.items()
+        }
+
+        if (
+            run_sql_many(
+                cursor,
+                "INSERT INTO search(conversation_id, user_search, portal, date) VALUES(?, ?, ?, ?);",
+                [
+                    (conversation_id, user_search, portal, date)
+                    for conversation_id, user_search, search_target, portal, date, feedbacks in searches
+                ],
+            )
+            is None
+        ):
+            raise sqlite3.DatabaseError("the searches could not be stored")
+
+        # The transaction holds the write lock since the first insert, the searches got consecutive ids
+        last_search_id = cursor.execute("SELECT last_insert_rowid();").fetchone()[0]
+
+        for search_id, search in zip(
+            range(last_search_id - len(searches) + 1, last_search_id + 1), searches
+        ):
+
+            (
+                conversation_id,
+                user_search,
+                search_target,
+                portal,
+                date,
+                feedbacks,
+            ) = search
+            search_key = search_keys[user_search]
+            weight = weights[date]
+            stored_ids = set()
+
+            if search_target:
+                add_search_target_feedback(cursor, search_id, search_target)
+
+            for (
+                result,
+                old_rank,
+                new_rank,
+                feedback,
+                methods_used,
+                origin_source,
+            ) in feedbacks:
+
+                result_id = object_ids[id(result)]
+                if result_id in stored_ids:
+                    continue
+                stored_ids.add(result_id)
+
+                feedback_rows.append(
+                    (
+                        search_id,
+                        old_rank,
+                        new_rank,
+                        result_id,
+                        feedback,
+                        methods_used,
+                        origin_source,
+                    )
                 )
 
-            sqliteConnection.commit()
+                aggregate = aggregates.get((search_key, portal, result_id))
+                if aggregate is None:
+                    aggregate = [0, 0, 0, 0.0, 0.0, 0.0, batch_day]
+                    aggregates[(search_key, portal, result_id)] = aggregate
+                aggregate[2] += 1
+                aggregate[5] += weight
+                if feedback == 1:
+                    aggregate[0] += 1
+                    aggregate[3] += weight
+                elif feedback == -1:
+                    aggregate[1] += 1
+                    aggregate[4] += weight
+
+        merge_stored_aggregates(cursor, aggregates)
+
+        sqlite_insert_result_feedback_query = "INSERT INTO search_reranking_feedback(search_id, old_rank, new_rank, result_id, feedback, methods_used, origin_source) VALUES(?, ?, ?, ?, ?, ?, ?);"
+
+        # The batch is rolled back as a whole if a part of it can not be stored
+        if (
+            run_sql_many(cursor, sqlite_insert_result_feedback_query, feedback_rows)
+            is None
+            or run_sql_many(
+                cursor,
+                sqlite_add_feedback_aggregate_query,
+                [key + tuple(aggregate) for key, aggregate in aggregates.items()],
+            )
+            is None
+        ):
+            raise sqlite3.DatabaseError("the feedbacks could not be stored")
+
+    for identity, result in results.items():
+        stored_results[identity] = (result_ids[identity], result)
+
+    search_keys = list(set(search_keys.values()))
+
+    # The feedbacks given to these searches can now be borrowed by the similar ones
+    for search_key in search_keys:
+        query_index.searches.add(search_key)
+
+    result_identities = {
+        result_id: identity for identity, result_id in result_ids.items()
+    }
+    id_results = {result_ids[identity]: result for identity, result in results.items()}
+
+    # The metadata affinities only learn the feedbacks once they are committed
+    metadata_scorer.affinities.add_feedbacks(
+        [
+            (search_key, id_results[result_id], aggregate[0])
+            for (search_key, portal, result_id), aggregate in aggregates.items()
+            if aggregate[0] > 0
+        ]
+    )
 
-        cursor.close()
-        sqliteConnection.close()
+    cache.feedback_counts.invalidate_groups(
+        list(
+            set(
+                (search_key, result_identities[result_id])
+                for search_key, portal, result_id in aggregates
+            )
+        )
+    )
+    cache.responses.invalidate_groups(query_index.response_groups(search_keys))
 
-    except sqlite3.Error as error:
-        print("-ADD_FEEDBACK_RESULT\nError while connecting to sqlite", error, "\n")
+    return len(feedback_rows)
+
+
+def add_proposed_results(
+    conversation_id, search, proposed_results, methods_used, feedback=0
+):
+
+    """
+    Store the results proposed for a search in a single transaction, see store_proposed_results
+    """
+
+    add_proposed_results_batch(
+        [(conversation_id, search, proposed_results, methods_used, feedback)]
+    )
 
 
+# Function: Add the proposed result in the database
 def add_search_target_feedback(cursor, search_id, search_target):
 
     try:
@@ -610,28 +1408,29 @@ def update_proposed_result_feedback(
             feedbacks_list: list of feedback of type (result, feedback) by the user who made that search      
     """
 
-    try:
+    chosen_changes = []
 
-        sqliteConnection = sqlite3.connect(database)
-        cursor = sqliteConnection.cursor()
+    try:
 
-        search_id = get_search_id_from_conv_id_and_search(
-            cursor, conversation_id, search
-        )
+        with connection_manager.transaction() as cursor:
 
-        add_search_target_feedback(cursor, search_id, search_target)
+            search_id = get_search_id_from_conv_id_and_search(
+                cursor, conversation_id, search
+            )
 
-        if search_id is not None:
+            add_search_target_feedback(cursor, search_id, search_target)
 
-            for fback in feedbacks_list:
+            if search_id is not None:
 
-                result_id = get_result_ID(cursor, fback.result)
+                for fback in feedbacks_list:
 
-                if result_id is None:
+                    result_id = get_or_add_result_ID(cursor, fback.result)
 
-                    result_id = add_new_result_to_DB(cursor, fback.result)
+                    sqlite_get_old_feedback_query = "SELECT feedback FROM search_reranking_feedback WHERE search_id = ? AND result_id = ?"
 
-                else:
+                    old_feedbacks = run_sql_command(
+                        cursor, sqlite_get_old_feedback_query, (search_id, result_id)
+                    )
 
                     sqlite_update_result_query = "UPDATE search_reranking_feedback SET feedback = ? WHERE search_id = ? AND result_id = ?"
 
@@ -641,13 +1440,41 @@ def update_proposed_result_feedback(
                         (fback.feedback, search_id, result_id),
                     )
 
-            sqliteConnection.commit()
-
-        cursor.close()
-        sqliteConnection.close()
+                    # Move the counts of the updated rows from their old feedback to the new one
+                    for (old_feedback,) in old_feedbacks or []:
+                        chosen_changes.append(
+                            (
+                                fback.result,
+                                int(fback.feedback == 1) - int(old_feedback == 1),
+                            )
+                        )
+                        update_feedback_aggregate(
+                            cursor,
+                            search,
+                            search_id,
+                            result_id,
+                            int(fback.feedback == 1) - int(old_feedback == 1),
+                            int(fback.feedback == -1) - int(old_feedback == -1),
+                            0,
+                        )
 
     except sqlite3.Error as error:
         print("-ADD_FEEDBACK_RESULT\nError while connecting to sqlite", error, "\n")
+        chosen_changes = []
+
+    # The metadata affinities only learn the feedbacks once they are committed
+    for result, chosen in chosen_changes:
+        metadata_scorer.affinities.add_feedback(search, result, chosen)
+
+    cache.feedback_counts.invalidate_groups(
+        [
+            (normalize_search(search), result_identity(fback.result))
+            for fback in feedbacks_list
+        ]
+    )
+    cache.responses.invalidate_groups(
+        query_index.response_groups([normalize_search(search)])
+    )
 
 
 def get_search_id_from_conv_id_and_search(
@@ -686,148 +1513,243 @@ def get_search_id_from_conv_id_and_search(
         print("-GET_SEARCH_ID-\nError while connecting to sqlite", error, "\n")
 
 
-def get_search_ids_from_search(cursor, user_search, portal=None):
+def get_feedback_counts_for_search_key(search_key, results_list, portal=None):
 
     """
-    Input:  user_search: search entered by the users
+    Input:  search_key: search already normalized by normalize_search
+            results_list: list of objects of type main.Result
             portal: if you want to use a particular portal
 
-    Output: List of search_id corresponding to the string user_search by different users 
+    Output: List of (chosen, ignored, total) feedback counts, one for each result of results_list
     """
 
-    try:
+    return get_feedback_counts_for_search_keys([(search_key, results_list)], portal)[0]
 
-        if portal == None:
-            sqlite_get_search_id_query = (
-                "SELECT id FROM search where user_search = ? ORDER BY id DESC;"
-            )
-            record = run_sql_command(cursor, sqlite_get_search_id_query, [user_search])
 
-        else:
-            sqlite_get_search_id_query = "SELECT id FROM search where user_search = ? and portal = ? ORDER BY id DESC;"
-            record = run_sql_command(
-                cursor, sqlite_get_search_id_query, (user_search, portal)
-            )
+def get_feedback_counts_for_search_keys(lookups, portal=None):
 
-        if record != None and len(record) > 0:
-            search_ids = []
-            for search_id in record:
-                search_ids.append(search_id[0])
-            return search_ids
-        else:
-            return None
+    """
+    Read the feedback counts of several searches in one transaction, with one query resolving the ids
+    of every result and one query reading every aggregate
 
-    except sqlite3.Error as error:
-        print("-GET_SEARCH_ID-\nError while connecting to sqlite", error, "\n")
+    Input:  lookups: list of (search_key, results_list), search_key being normalized by normalize_search
+            portal: if you want to use a particular portal
 
+    Output: List of the (chosen, ignored, total) feedback counts of each result, one list for each lookup
+    """
 
-def get_feedback_for_reranking(user_search, result, portal=None):
+    counts = [[(0, 0, 0)] * len(results_list) for search_key, results_list in lookups]
 
-    """
-    Input:  user_search: search entered by the user
-            result: object of type main.Result
+    identities = [
+        [result_identity(result) for result in results_list]
+        for search_key, results_list in lookups
+    ]
+    unique_identities = list(
+        {identity for lookup_identities in identities for identity in lookup_identities}
+    )
+    search_keys = list({search_key for search_key, results_list in lookups})
 
-    Output: List of feedbacks corresponding to the couple (user_search, result)        
-    """
+    if len(unique_identities) == 0:
+        return counts
 
     try:
 
-        sqliteConnection = sqlite3.connect(database)
-        cursor = sqliteConnection.cursor()
+        with connection_manager.transaction() as cursor:
 
-        search_ids = get_search_ids_from_search(cursor, user_search, portal)
+            with metrics.stage("result_id_resolution"):
+                result_ids = {}
+                for chunk in chunked(unique_identities):
+                    sqlite_get_result_ids_query = "SELECT identity, id FROM result WHERE identity IN ({});".format(
+                        ", ".join(["?"] * len(chunk))
+                    )
+                    result_ids.update(
+                        run_sql_command(cursor, sqlite_get_result_ids_query, chunk)
+                        or []
+                    )
 
-        if search_ids != None and len(search_ids) > 0:
+            # Read the aggregated counts of every search and result, decayed to the current day
+            counts_by_key = {}
+            day = current_day()
 
-            result_id = get_result_ID(cursor, result)
+            for search_keys_chunk in chunked(search_keys):
+                for result_ids_chunk in chunked(list(result_ids.values())):
 
-            if result_id is None:
-                return []
+                    sqlite_get_feedback_counts_query = "SELECT user_search, result_id, SUM(decayed_chosen * decay_factor(?1 - decayed_at)), SUM(decayed_ignored * decay_factor(?1 - decayed_at)), SUM(decayed_total * decay_factor(?1 - decayed_at)) FROM feedback_aggregate " "WHERE user_search IN ({})".format(
+                        ", ".join(["?"] * len(search_keys_chunk))
+                    ) + (
+                        " AND portal = ?" if portal is not None else ""
+                    ) + " AND result_id IN ({}) GROUP BY user_search, result_id;".format(
+                        ", ".join(["?"] * len(result_ids_chunk))
+                    )
 
-            sqlite_get_feedback_query = "SELECT feedback FROM search_reranking_feedback where search_id IN ({}) and result_id = ?;".format(
-                ", ".join(["?"] * len(search_ids))
-            )
+                    params = (
+                        [day]
+                        + search_keys_chunk
+                        + ([portal] if portal is not None else [])
+                        + result_ids_chunk
+                    )
 
-            return run_sql_command(
-                cursor, sqlite_get_feedback_query, search_ids + [result_id]
-            )
+                    record = run_sql_command(
+                        cursor, sqlite_get_feedback_counts_query, params
+                    )
 
-        else:
+                    for row in record or []:
+                        counts_by_key[(row[0], row[1])] = tuple(row[2:])
 
-            return []
+            counts = [
+                [
+                    counts_by_key.get((search_key, result_ids.get(identity)), (0, 0, 0))
+                    for identity in lookup_identities
+                ]
+                for (search_key, results_list), lookup_identities in zip(
+                    lookups, identities
+                )
+            ]
 
     except sqlite3.Error as error:
-        print("-GET_FEEDBACK-\nError while connecting to sqlite", error, "\n")
+        print("-GET_FEEDBACK_COUNTS-\nError while connecting to sqlite", error, "\n")
 
+    return counts
 
-def extract_database_feedbacks():
+
+def get_feedback_extraction_page(after_search_id=0, limit=500):
 
     """
-    Return a copy of the database content in JSON format
+    Return the searches following after_search_id with their feedbacks, in the format of
+    extract_database_feedbacks plus the search_id of each search, used to request the next page
+
+    Input:  after_search_id: id of the last search of the previous page, 0 for the first page
+            limit: maximum number of searches returned
     """
 
     try:
 
-        sqliteConnection = sqlite3.connect(database)
-        cursor = sqliteConnection.cursor()
+        with connection_manager.transaction() as cursor:
+
+            sqlite_get_search_page_query = (
+                "SELECT s.id, s.user_search, s.portal, s.date, "
+                "(SELECT search_target FROM search_target_feedback WHERE search_id = s.id LIMIT 1) "
+                "FROM search AS s WHERE s.id > ? ORDER BY s.id LIMIT ?;"
+            )
 
-        sqlite_get_search_list_query = "SELECT * FROM search"  # Get every search info
+            search_list = run_sql_command(
+                cursor, sqlite_get_search_page_query, (after_search_id, limit)
+            )
 
-        database_copy = []
+            if search_list is None or len(search_list) == 0:
+                return []
 
-        search_list = run_sql_command(cursor, sqlite_get_search_list_query, None)
+            search_range = (search_list[0][0], search_list[-1][0])
 
-        for search in search_list:
+            sqlite_get_page_feedbacks_query = (
+                "SELECT srf.search_id, srf.result_id, srf.old_rank, srf.new_rank, srf.feedback, srf.methods_used, srf.origin_source, "
+                + ", ".join("r." + attribute for attribute in attributes)
+                + " FROM search_reranking_feedback AS srf JOIN result AS r ON r.id = srf.result_id "
+                "WHERE srf.search_id BETWEEN ? AND ? ORDER BY srf.search_id, srf.id;"
+            )
 
-            sqlite_get_search_data_query = (
-                "SELECT * from search_reranking_feedback WHERE search_id = "  # For every search, get every feedback
-                + str(search[0])
+            sqlite_get_page_tags_query = (
+                "SELECT DISTINCT lt.result_id, lt.tag_id, t.name FROM search_reranking_feedback AS srf "
+                "JOIN link_results_tags AS lt ON lt.result_id = srf.result_id "
+                "JOIN result_tag AS t ON t.id = lt.tag_id "
+                "WHERE srf.search_id BETWEEN ? AND ? ORDER BY lt.result_id, lt.tag_id;"
             )
-            search_data_list = run_sql_command(
-                cursor, sqlite_get_search_data_query, None
+
+            sqlite_get_page_groups_query = (
+                "SELECT DISTINCT lg.result_id, lg.group_id, g.name, g.description FROM search_reranking_feedback AS srf "
+                "JOIN link_results_groups AS lg ON lg.result_id = srf.result_id "
+                "JOIN result_group AS g ON g.id = lg.group_id "
+                "WHERE srf.search_id BETWEEN ? AND ? ORDER BY lg.result_id, lg.group_id;"
             )
 
-            feedbacks = []
+            tags = {}
+            for result_id, tag_id, name in run_sql_command(
+                cursor, sqlite_get_page_tags_query, search_range
+            ):
+                tags.setdefault(result_id, []).append(name)
+
+            groups = {}
+            for result_id, group_id, name, description in run_sql_command(
+                cursor, sqlite_get_page_groups_query, search_range
+            ):
+                groups.setdefault(result_id, []).append(
+                    {"name": name, "description": description}
+                )
 
-            for data in search_data_list:
+            feedbacks = {}
+            for row in run_sql_command(
+                cursor, sqlite_get_page_feedbacks_query, search_range
+            ):
+                result = dict(zip(attributes, row[7:]))
+                result["tags"] = tags.get(row[1], [])
+                result["groups"] = groups.get(row[1], [])
 
-                feedbacks.append(  # For every feedback, add them to the list
+                feedbacks.setdefault(row[0], []).append(
                     {
-                        "result": get_result_from_ID(cursor, data[4])[0],
-                        "old_rank": data[2],
-                        "new_rank": data[3],
-                        "feedback": data[5],
-                        "methods_used": data[6],
+                        "result": result,
+                        "old_rank": row[2],
+                        "new_rank": row[3],
+                        "feedback": row[4],
+                        "methods_used": row[5],
+                        "origin_source": row[6],
                     }
                 )
 
-            sqlite_get_search_target_query = (
-                "SELECT search_target from search_target_feedback WHERE search_id = "  # For every search, get the search target entered by the user
-                + str(search[0])
-            )
-            search_target = run_sql_command(
-                cursor, sqlite_get_search_target_query, None
-            )
-
-            search_target = (
-                search_target[0][0]
-                if search_target is not None and len(search_target) > 0
-                else ""
-            )
-
-            database_copy.append(  #
+            return [
                 {
-                    "user_search": search[2],
-                    "search_target": search_target,
-                    "portal": search[3],
-                    "date": search[4],
-                    "feedbacks": feedbacks,
+                    "search_id": search[0],
+                    "user_search": search[1],
+                    "search_target": search[4] if search[4] is not None else "",
+                    "portal": search[2],
+                    "date": search[3],
+                    "feedbacks": feedbacks.get(search[0], []),
                 }
-            )
-
-        print(database_copy)
-        return database_copy
+                for search in search_list
+            ]
 
     except sqlite3.Error as error:
         print("-Extract_Feedbacks-\nError while connecting to sqlite:", error, "\n")
         return []
+
+
+def iter_database_feedbacks(after_search_id=0, limit=None, page_size=500):
+
+    """
+    Iterate over the searches of the database with their feedbacks, one page of searches in memory at a time
+
+    Input:  after_search_id: only return the searches with a greater id
+            limit: maximum number of searches returned, None for every search
+            page_size: number of searches fetched per query
+    """
+
+    while limit is None or limit > 0:
+
+        page = get_feedback_extraction_page(
+            after_search_id, page_size if limit is None else min(page_size, limit)
+        )
+
+        if len(page) == 0:
+            return
+
+        after_search_id = page[-1]["search_id"]
+
+        for search in page:
+            yield search
+
+        if limit is not None:
+            limit -= len(page)
+
+
+def extract_database_feedbacks():
+
+    """
+    Return a copy of the database content in JSON format
+    """
+
+    database_copy = []
+
+    for search in iter_database_feedbacks():
+        del search["search_id"]
+        database_copy.append(search)
+
+    return database_copy
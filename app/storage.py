@@ -0,0 +1,754 @@
+import threading
+
+import bm25
+import cache
+import config
+import connection_manager
+import feedback_matrix
+import maintenance
+import metadata_scorer
+import migrations
+import query_index
+import sql_query
+import vocabulary
+
+
+class Storage:
+
+    """
+    Store of the searches, results and feedbacks used by the API. Every backend gives the same answers
+    for the same calls, which is checked by test_storage.py. The in-memory indexes of the reranking
+    (metadata affinities, similar searches, BM25) are kept up to date by the backends.
+    """
+
+    def open(self):
+
+        """
+        Prepare the storage before the API serves its first request
+        """
+
+    def close(self):
+
+        """
+        Release the resources of the storage when the API stops
+        """
+
+    def load_indexes(self):
+
+        """
+        Replace the in-memory indexes of the reranking by the content of the storage
+        """
+
+        raise NotImplementedError
+
+    def load_affinities(self):
+
+        """
+        Replace metadata_scorer.affinities by the affinities computed from the stored feedbacks
+        """
+
+        raise NotImplementedError
+
+    def add_search(self, conversation_id, user_search, portal, date):
+
+        """
+        Store a search made by a user
+
+        Input:  conversation_id: id of the conversation where the search was done
+                user_search: search entered by the user
+                portal: data portal where the search was done
+                date: date of the search
+        """
+
+        raise NotImplementedError
+
+    def get_result_ids(self, results_list):
+
+        """
+        Input:  results_list: list of objects of type main.Result
+
+        Output: list of the ids of the results, None for the results not stored yet
+        """
+
+        raise NotImplementedError
+
+    def store_rerankings(self, rerankings):
+
+        """
+        Store the results proposed for several searches, results not stored yet are added
+        and results whose metadata changed are updated
+
+        Input:  rerankings: list of (conversation_id, search, proposed_results, methods_used, feedback),
+                            see sql_query.store_proposed_results
+        """
+
+        raise NotImplementedError
+
+    def update_feedback(self, conversation_id, search, search_target, feedbacks_list):
+
+        """
+        Update the feedbacks of the results proposed for the last search of a conversation
+
+        Input:  conversation_id: id of the conversation where the search was done
+                search: search entered by the user
+                search_target: description of the target entered by the user
+                feedbacks_list: list of objects of type main.Result_Feedback
+        """
+
+        raise NotImplementedError
+
+    def get_feedback_counts(self, search_key, results_list, portal=None):
+
+        """
+        Input:  search_key: search normalized by sql_query.normalize_search
+                results_list: list of objects of type main.Result
+                portal: if given, only count the feedbacks of the searches made on that portal
+
+        Output: list of (chosen, ignored, total) feedback counts, one for each result of results_list,
+                decayed with the age of their search by sql_query.decay_factor
+        """
+
+        raise NotImplementedError
+
+    def get_feedback_counts_batch(self, lookups, portal=None):
+
+        """
+        Input:  lookups: list of (search_key, results_list), see get_feedback_counts
+                portal: if given, only count the feedbacks of the searches made on that portal
+
+        Output: list of the feedback counts of each lookup
+        """
+
+        return [
+            self.get_feedback_counts(search_key, results_list, portal)
+            for search_key, results_list in lookups
+        ]
+
+    def import_searches(self, searches, stored_results=None):
+
+        """
+        Store searches with their feedbacks, read from an extraction of another instance
+
+        Input:  searches: list of (conversation_id, user_search, search_target, portal, date, feedbacks),
+                          feedbacks being a list of (result, old_rank, new_rank, feedback, methods_used, origin_source)
+                          and result an object of type main.Result
+                stored_results: dict kept between the batches of an import to skip the results already stored,
+                                see sql_query.import_searches
+
+        Output: number of feedbacks stored, a result given twice for a search is stored once
+        """
+
+        raise NotImplementedError
+
+    def run_maintenance(self, vacuum_min_free=None):
+
+        """
+        Remove the rows left by missing results and compact the storage, see maintenance.run_maintenance
+
+        Output: dict reporting what was done
+        """
+
+        raise NotImplementedError
+
+    def export_feedback_matrix(self, directory, chunk_size=None):
+
+        """
+        Write the chosen and ignored counts of every (normalized search, result) as a CSR sparse matrix,
+        see feedback_matrix.write_feedback_matrix
+
+        Output: dict with the number of queries, results and entries written
+        """
+
+        raise NotImplementedError
+
+    def get_feedback_extraction_page(self, after_search_id=0, limit=500):
+
+        """
+        Input:  after_search_id: id of the last search of the previous page, 0 for the first page
+                limit: maximum number of searches returned
+
+        Output: searches following after_search_id with their feedbacks, see sql_query.get_feedback_extraction_page
+        """
+
+        raise NotImplementedError
+
+    def extract_feedbacks(self):
+
+        """
+        Output: every search with its feedbacks, without their search_id
+        """
+
+        database_copy = []
+        after_search_id = 0
+
+        while True:
+
+            page = self.get_feedback_extraction_page(after_search_id)
+            if len(page) == 0:
+                return database_copy
+
+            after_search_id = page[-1]["search_id"]
+
+            for search in page:
+                del search["search_id"]
+                database_copy.append(search)
+
+
+class SqliteStorage(Storage):
+
+    """
+    Storage in the sqlite database of connection_manager.database, through the functions of sql_query
+    """
+
+    def open(self):
+
+        migrations.run_migrations()
+
+    def close(self):
+
+        connection_manager.close_all_connections()
+
+    def load_indexes(self):
+
+        with connection_manager.transaction() as cursor:
+            vocabulary.tags_and_groups.load(cursor)
+            metadata_scorer.affinities.load(cursor)
+            query_index.searches.load(cursor)
+            bm25.index.load(cursor)
+
+    def load_affinities(self):
+
+        with connection_manager.transaction() as cursor:
+            metadata_scorer.affinities.load(cursor)
+
+    def add_search(self, conversation_id, user_search, portal, date):
+
+        sql_query.add_new_search_query(conversation_id, user_search, portal, date)
+
+    def get_result_ids(self, results_list):
+
+        with connection_manager.transaction() as cursor:
+            return [sql_query.get_result_ID(cursor, result) for result in results_list]
+
+    def store_rerankings(self, rerankings):
+
+        sql_query.add_proposed_results_batch(rerankings)
+
+    def update_feedback(self, conversation_id, search, search_target, feedbacks_list):
+
+        sql_query.update_proposed_result_feedback(
+            conversation_id, search, search_target, feedbacks_list
+        )
+
+    def get_feedback_counts(self, search_key, results_list, portal=None):
+
+        return sql_query.get_feedback_counts_for_search_key(
+            search_key, results_list, portal
+        )
+
+    def get_feedback_counts_batch(self, lookups, portal=None):
+
+        return sql_query.get_feedback_counts_for_search_keys(lookups, portal)
+
+    def import_searches(self, searches, stored_results=None):
+
+        return sql_query.import_searches(searches, stored_results)
+
+    def run_maintenance(self, vacuum_min_free=None):
+
+        report = maintenance.run_maintenance(vacuum_min_free)
+
+        # The removed rows may still be in the indexes and the caches
+        self.load_indexes()
+        cache.feedback_counts.clear()
+        cache.responses.clear()
+
+        return report
+
+    def export_feedback_matrix(self, directory, chunk_size=None):
+
+        return feedback_matrix.export_feedback_matrix(directory, chunk_size)
+
+    def get_feedback_extraction_page(self, after_search_id=0, limit=500):
+
+        return sql_query.get_feedback_extraction_page(after_search_id, limit)
+
+    def extract_feedbacks(self):
+
+        return sql_query.extract_database_feedbacks()
+
+
+class MemoryStorage(Storage):
+
+    """
+    Storage in dicts indexed like the tables of the sqlite database, lost when the API stops.
+    Used to run the tests and the benchmarks without a database file.
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+
+        # id -> (conversation_id, user_search, portal, date), ids start at 1 like in sqlite
+        self.searches = [None]
+        # (conversation_id, user_search) -> id of the last search
+        self.search_ids = {}
+        # search id -> first search target given for the search
+        self.search_targets = {}
+        # id -> [result, fingerprint]
+        self.results = [None]
+        # result identity -> id
+        self.result_ids = {}
+        # search id -> {result id: [old_rank, new_rank, feedback, methods_used, origin_source]}
+        self.feedbacks = {}
+        # search key -> {result id: {portal: [chosen, ignored, total, decayed counts, day they are decayed to]}}
+        self.aggregates = {}
+
+    def load_indexes(self):
+
+        with self.lock:
+            search_keys = list(self.aggregates)
+            documents = [
+                (sql_query.result_identity(result), bm25.fields_of_result(result))
+                for result, fingerprint in self.results[1:]
+            ]
+
+        query_index.searches.replace(search_keys)
+        bm25.index.replace(documents)
+        self.load_affinities()
+
+    def load_affinities(self):
+
+        with self.lock:
+
+            chosen_results = []
+            features = {}
+
+            for search_key, result_counts in self.aggregates.items():
+                for result_id, portal_counts in result_counts.items():
+                    chosen = sum(counts[0] for counts in portal_counts.values())
+                    if chosen > 0:
+                        chosen_results.append((search_key, result_id, chosen))
+                        features[result_id] = metadata_scorer.metadata_features(
+                            self.results[result_id][0]
+                        )
+
+        metadata_scorer.affinities.replace(chosen_results, features)
+
+    def add_search(self, conversation_id, user_search, portal, date):
+
+        with self.lock:
+            self.search_ids[(conversation_id, user_search)] = len(self.searches)
+            self.searches.append((conversation_id, user_search, portal, date))
+
+        # The feedbacks given to this search can now be borrowed by the similar ones
+        search_key = sql_query.normalize_search(user_search)
+        if query_index.searches.add(search_key):
+            cache.responses.invalidate_groups(query_index.response_groups([search_key]))
+
+    def get_result_ids(self, results_list):
+
+        with self.lock:
+            return [
+                self.result_ids.get(sql_query.result_identity(result))
+                for result in results_list
+            ]
+
+    def get_or_add_result_id(self, result, identity=None):
+
+        """
+        Input:  result: object of type main.Result
+                identity: sql_query.result_identity of the result, computed if not given
+
+        Output: id of the result, added if it is not stored yet or updated if its metadata changed,
+                called with the lock held
+        """
+
+        if identity is None:
+            identity = sql_query.result_identity(result)
+        fingerprint = sql_query.result_fingerprint(result)
+        result_id = self.result_ids.get(identity)
+
+        if result_id is None:
+            result_id = len(self.results)
+            self.result_ids[identity] = result_id
+            self.results.append([result, fingerprint])
+        elif self.results[result_id][1] != fingerprint:
+            # A result sent without its tags or groups keeps the ones already stored, like in sqlite
+            stored = self.results[result_id][0]
+            result = sql_query.keep_result_links(
+                result,
+                stored.tags,
+                [(group.name, group.description) for group in stored.groups]
+                if stored.groups is not None
+                else None,
+            )
+            fingerprint = sql_query.result_fingerprint(result)
+            if fingerprint == self.results[result_id][1]:
+                return result_id
+            self.results[result_id] = [result, fingerprint]
+        else:
+            return result_id
+
+        bm25.index.add(result)
+
+        return result_id
+
+    def add_to_aggregate(
+        self, search_key, portal, result_id, chosen, ignored, total, day
+    ):
+
+        counts = (
+            self.aggregates.setdefault(search_key, {})
+            .setdefault(result_id, {})
+            .setdefault(portal, [0, 0, 0, [0, 0, 0], day])
+        )
+        counts[0] += chosen
+        counts[1] += ignored
+        counts[2] += total
+        counts[3], counts[4] = sql_query.add_decayed_counts(
+            counts[3], counts[4], (chosen, ignored, total), day
+        )
+
+    def store_rerankings(self, rerankings):
+
+        stored = []
+
+        with self.lock:
+
+            for (
+                conversation_id,
+                search,
+                proposed_results,
+                methods_used,
+                feedback,
+            ) in rerankings:
+
+                search_id = self.search_ids.get((conversation_id, search))
+                if search_id is None:
+                    continue
+
+                search_key = sql_query.normalize_search(search)
+                portal, date = self.searches[search_id][2:]
+                day = sql_query.search_day(date)
+                search_feedbacks = self.feedbacks.setdefault(search_id, {})
+                proposed_identities = []
+
+                for result, old_rank, new_rank, origin_source in proposed_results:
+
+                    identity = sql_query.result_identity(result)
+                    result_id = self.get_or_add_result_id(result, identity)
+                    if result_id in search_feedbacks:
+                        continue
+
+                    search_feedbacks[result_id] = [
+                        old_rank,
+                        new_rank,
+                        int(feedback),
+                        methods_used,
+                        origin_source,
+                    ]
+                    self.add_to_aggregate(
+                        search_key,
+                        portal,
+                        result_id,
+                        int(feedback == 1),
+                        int(feedback == -1),
+                        1,
+                        day,
+                    )
+                    proposed_identities.append(identity)
+
+                stored.append((search_key, proposed_identities, feedback))
+
+        # The cached counts of the results get the new proposition instead of being dropped,
+        # with its full weight as the searches reranked by the API were just made
+        for search_key, proposed_identities, feedback in stored:
+            cache.feedback_counts.update_groups(
+                [(search_key, identity) for identity in proposed_identities],
+                lambda counts: (
+                    counts[0] + int(feedback == 1),
+                    counts[1] + int(feedback == -1),
+                    counts[2] + 1,
+                ),
+            )
+
+        # The new propositions change the totals the rankings of the search and of the similar ones are scored with
+        cache.responses.invalidate_groups(
+            query_index.response_groups(
+                [
+                    search_key
+                    for search_key, proposed_identities, feedback in stored
+                    if len(proposed_identities) > 0
+                ]
+            )
+        )
+
+    def update_feedback(self, conversation_id, search, search_target, feedbacks_list):
+
+        chosen_changes = []
+        search_key = sql_query.normalize_search(search)
+
+        with self.lock:
+
+            search_id = self.search_ids.get((conversation_id, search))
+
+            if search_id is not None:
+
+                self.search_targets.setdefault(search_id, search_target)
+                portal, date = self.searches[search_id][2:]
+                search_feedbacks = self.feedbacks.get(search_id, {})
+
+                for fback in feedbacks_list:
+
+                    result_id = self.get_or_add_result_id(fback.result)
+                    stored_feedback = search_feedbacks.get(result_id)
+
+                    if stored_feedback is None:
+                        continue
+
+                    old_feedback, stored_feedback[2] = (
+                        stored_feedback[2],
+                        int(fback.feedback),
+                    )
+
+                    # Move the counts of the updated row from its old feedback to the new one
+                    chosen = int(fback.feedback == 1) - int(old_feedback == 1)
+                    chosen_changes.append((fback.result, chosen))
+                    self.add_to_aggregate(
+                        search_key,
+                        portal,
+                        result_id,
+                        chosen,
+                        int(fback.feedback == -1) - int(old_feedback == -1),
+                        0,
+                        sql_query.search_day(date),
+                    )
+
+        for result, chosen in chosen_changes:
+            metadata_scorer.affinities.add_feedback(search, result, chosen)
+
+        cache.feedback_counts.invalidate_groups(
+            [
+                (search_key, sql_query.result_identity(fback.result))
+                for fback in feedbacks_list
+            ]
+        )
+        cache.responses.invalidate_groups(query_index.response_groups([search_key]))
+
+    def get_feedback_counts(self, search_key, results_list, portal=None):
+
+        day = sql_query.current_day()
+
+        with self.lock:
+
+            result_counts = self.aggregates.get(search_key, {})
+            counts = []
+
+            for result in results_list:
+
+                portal_counts = result_counts.get(
+                    self.result_ids.get(sql_query.result_identity(result)), {}
+                )
+                if portal is not None:
+                    portal_counts = (
+                        {portal: portal_counts[portal]}
+                        if portal in portal_counts
+                        else {}
+                    )
+
+                # Counts decayed to the current day
+                counts.append(
+                    tuple(
+                        sum(
+                            portal_count[3][i]
+                            * sql_query.decay_factor(day - portal_count[4])
+                            for portal_count in portal_counts.values()
+                        )
+                        for i in range(3)
+                    )
+                )
+
+            return counts
+
+    def export_result(self, result_id):
+
+        """
+        Output: result in the format of the extraction, called with the lock held
+        """
+
+        result = self.results[result_id][0]
+
+        exported = {
+            attribute: getattr(result, attribute) for attribute in sql_query.attributes
+        }
+        exported["tags"] = list(dict.fromkeys(result.tags or []))
+        exported["groups"] = [
+            {"name": name, "description": description}
+            for name, description in dict.fromkeys(
+                (group.name, group.description) for group in result.groups or []
+            )
+        ]
+
+        return exported
+
+    def import_searches(self, searches, stored_results=None):
+
+        imported_keys = []
+        chosen_feedbacks = []
+
+        with self.lock:
+
+            for (
+                conversation_id,
+                user_search,
+                search_target,
+                portal,
+                date,
+                feedbacks,
+            ) in searches:
+
+                search_id = len(self.searches)
+                self.search_ids[(conversation_id, user_search)] = search_id
+                self.searches.append((conversation_id, user_search, portal, date))
+                if search_target:
+                    self.search_targets[search_id] = search_target
+
+                search_key = sql_query.normalize_search(user_search)
+                day = sql_query.search_day(date)
+                search_feedbacks = self.feedbacks.setdefault(search_id, {})
+
+                for (
+                    result,
+                    old_rank,
+                    new_rank,
+                    feedback,
+                    methods_used,
+                    origin_source,
+                ) in feedbacks:
+
+                    result_id = self.get_or_add_result_id(result)
+                    if result_id in search_feedbacks:
+                        continue
+
+                    search_feedbacks[result_id] = [
+                        old_rank,
+                        new_rank,
+                        int(feedback),
+                        methods_used,
+                        origin_source,
+                    ]
+                    self.add_to_aggregate(
+                        search_key,
+                        portal,
+                        result_id,
+                        int(feedback == 1),
+                        int(feedback == -1),
+                        1,
+                        day,
+                    )
+                    imported_keys.append(
+                        (search_key, sql_query.result_identity(result))
+                    )
+                    if feedback == 1:
+                        chosen_feedbacks.append((search_key, result, 1))
+
+        search_keys = list(
+            {sql_query.normalize_search(search[1]) for search in searches}
+        )
+
+        for search_key in search_keys:
+            query_index.searches.add(search_key)
+
+        metadata_scorer.affinities.add_feedbacks(chosen_feedbacks)
+
+        cache.feedback_counts.invalidate_groups(imported_keys)
+        cache.responses.invalidate_groups(query_index.response_groups(search_keys))
+
+        return len(imported_keys)
+
+    def run_maintenance(self, vacuum_min_free=None):
+
+        # Results are stored once per identity and tags are not stored apart, there is nothing to compact
+        return {
+            "links_removed": 0,
+            "aggregates_removed": 0,
+            "vacuumed": False,
+            "seconds": 0.0,
+        }
+
+    def export_feedback_matrix(self, directory, chunk_size=None):
+
+        with self.lock:
+            results = [
+                (result_id, result.portal, result.url)
+                for result_id, (result, fingerprint) in enumerate(self.results[1:], 1)
+            ]
+            entries = sorted(
+                (
+                    search_key,
+                    result_id,
+                    sum(counts[0] for counts in portals.values()),
+                    sum(counts[1] for counts in portals.values()),
+                )
+                for search_key, result_counts in self.aggregates.items()
+                for result_id, portals in result_counts.items()
+            )
+
+        entries = [entry for entry in entries if entry[2] > 0 or entry[3] > 0]
+
+        return feedback_matrix.write_feedback_matrix(
+            directory,
+            (len({entry[0] for entry in entries}), len(results)),
+            len(entries),
+            [results],
+            [entries],
+        )
+
+    def get_feedback_extraction_page(self, after_search_id=0, limit=500):
+
+        with self.lock:
+
+            page = []
+
+            for search_id in range(
+                max(after_search_id, 0) + 1,
+                min(len(self.searches), max(after_search_id, 0) + 1 + limit),
+            ):
+                conversation_id, user_search, portal, date = self.searches[search_id]
+                page.append(
+                    {
+                        "search_id": search_id,
+                        "user_search": user_search,
+                        "search_target": self.search_targets.get(search_id, ""),
+                        "portal": portal,
+                        "date": date,
+                        "feedbacks": [
+                            {
+                                "result": self.export_result(result_id),
+                                "old_rank": old_rank,
+                                "new_rank": new_rank,
+                                "feedback": feedback,
+                                "methods_used": methods_used,
+                                "origin_source": origin_source,
+                            }
+                            for result_id, (
+                                old_rank,
+                                new_rank,
+                                feedback,
+                                methods_used,
+                                origin_source,
+                            ) in self.feedbacks.get(search_id, {}).items()
+                        ],
+                    }
+                )
+
+            return page
+
+
+backends = {"sqlite": SqliteStorage, "memory": MemoryStorage}
+
+backend = backends[config.get_str("storage_backend")]()
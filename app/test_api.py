@@ -0,0 +1,324 @@
+import contextvars
+import json
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+import cache
+import log_writer
+import main
+import metrics
+import storage
+
+
+def make_result(number):
+
+    return {
+        "title": "Jeu de données " + str(number),
+        "url": "url-" + str(number),
+        "description": "Description " + str(number),
+        "portal": "datasud",
+        "tags": ["tag-" + str(number % 2)],
+    }
+
+
+def make_query(user_search, numbers, **options):
+
+    return dict(
+        {
+            "conversation_id": "conversation",
+            "user_search": user_search,
+            "data": [
+                {
+                    "api_hostname": "datasud",
+                    "results_list": [make_result(number) for number in numbers],
+                }
+            ],
+        },
+        **options
+    )
+
+
+@pytest.fixture
+def client(monkeypatch):
+
+    # The API runs on an empty memory storage, started and stopped like in production
+    monkeypatch.setattr(storage, "backend", storage.MemoryStorage())
+    cache.feedback_counts.clear()
+    cache.responses.clear()
+
+    with TestClient(main.app) as client:
+        yield client
+
+    cache.feedback_counts.clear()
+    cache.responses.clear()
+
+
+def add_search(client, user_search):
+
+    response = client.post(
+        "/add_search",
+        json={
+            "conversation_id": "conversation",
+            "user_search": user_search,
+            "portal": "datasud",
+            "date": "2021-07-02 10:36:11",
+        },
+    )
+    assert response.status_code == 200
+
+
+def choose(client, user_search, number):
+
+    response = client.post(
+        "/add_feedback",
+        json={
+            "conversation_id": "conversation",
+            "user_search": user_search,
+            "search_target": "target of " + user_search,
+            "feedbacks_list": [{"result": make_result(number), "feedback": 1}],
+        },
+    )
+    assert response.status_code == 200
+
+
+def test_unchanged_ranking_gets_a_304(client):
+
+    add_search(client, "barrage")
+    query = make_query("barrage", range(5))
+
+    response = client.post("/search_reranking", json=query)
+    etag = response.headers["ETag"]
+
+    assert response.status_code == 200
+    assert [result["url"] for result in response.json()] == [
+        "url-" + str(number) for number in range(5)
+    ]
+
+    response = client.post(
+        "/search_reranking", json=query, headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+    # Another query or another etag gets the ranking
+    response = client.post(
+        "/search_reranking", json=query, headers={"If-None-Match": '"other"'}
+    )
+    assert response.status_code == 200
+    response = client.post(
+        "/search_reranking",
+        json=make_query("barrage", range(4)),
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_feedback_drops_the_cached_ranking(client):
+
+    add_search(client, "barrage")
+    query = make_query("barrage", range(5))
+
+    etag = client.post("/search_reranking", json=query).headers["ETag"]
+    choose(client, "barrage", 3)
+
+    response = client.post(
+        "/search_reranking", json=query, headers={"If-None-Match": etag}
+    )
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()[0]["url"] == "url-3"
+
+
+def test_feedback_to_a_later_similar_search_drops_the_cached_ranking(client):
+
+    add_search(client, "barrage")
+    query = make_query("barrage", range(5))
+    etag = client.post("/search_reranking", json=query).headers["ETag"]
+
+    # barage is stored after the ranking of barrage was cached, its feedbacks are borrowed by barrage
+    add_search(client, "barage")
+    client.post("/search_reranking", json=make_query("barage", range(5)))
+    choose(client, "barage", 3)
+
+    response = client.post(
+        "/search_reranking", json=query, headers={"If-None-Match": etag}
+    )
+
+    assert response.status_code == 200
+    assert response.json()[0]["url"] == "url-3"
+
+
+def test_logged_proposals_drop_the_cached_ranking(client):
+
+    add_search(client, "barrage")
+    query = make_query("barrage", range(5))
+
+    client.post("/search_reranking", json=query)
+    assert cache.responses.stats()["entries"] == 1
+
+    # The proposals change the totals the ranking was scored with
+    log_writer.writer.flush()
+    assert cache.responses.stats()["entries"] == 0
+
+    # Proposed again in the same conversation the results are not counted twice, the ranking stays cached
+    client.post("/search_reranking", json=query)
+    log_writer.writer.flush()
+    hits = cache.responses.stats()["hits"]
+    client.post("/search_reranking", json=query)
+    assert cache.responses.stats()["hits"] == hits + 1
+
+
+def test_batch_ranks_each_query_as_a_single_request(client):
+
+    for user_search in ["barrage", "barrage hydraulique", "piscine"]:
+        add_search(client, user_search)
+
+    queries = [
+        make_query("barrage", range(5)),
+        make_query("barrage hydraulique", range(5), use_metadata=True, top_k=3),
+        make_query("piscine", [4, 1, 0], fusion="weighted", use_lexical=False),
+        make_query("barrage", range(5)),
+    ]
+    queries[1]["data"].append(
+        {
+            "api_hostname": "Other",
+            "results_list": [make_result(number) for number in [6, 2, 5]],
+        }
+    )
+
+    # The results are proposed before being chosen
+    for query in queries[:3]:
+        client.post("/search_reranking", json=query)
+    choose(client, "barrage", 2)
+    choose(client, "piscine", 1)
+
+    response = client.post("/search_reranking_batch", json=queries)
+    assert response.status_code == 200
+    batch = response.json()
+
+    # Every single request is reranked again instead of being answered from the rankings cached by the batch
+    singles = []
+    for query in queries:
+        cache.responses.clear()
+        singles.append(client.post("/search_reranking", json=query).json())
+
+    assert batch == singles
+    assert [len(results) for results in batch] == [5, 3, 3, 5]
+    assert batch[0][0]["url"] == "url-2"
+    assert batch[2][0]["url"] == "url-1"
+
+
+def line_starting(lines, start):
+
+    return next(line for line in lines if line.startswith(start))
+
+
+def test_metrics_are_rendered(client, monkeypatch):
+
+    # The requests of this test are recorded alone, with a counter having labels to escape
+    latency = metrics.Histogram(
+        "http_request_duration_seconds",
+        "Latency",
+        ("method", "endpoint", "status"),
+        [0.5, 1],
+    )
+    escaped = metrics.Counter("escaped_total", "Escaped labels", ("portal",))
+    escaped.inc(('data"sud\\',), 2)
+    monkeypatch.setattr(metrics, "enabled", True)
+    monkeypatch.setattr(metrics, "request_latency", latency)
+    monkeypatch.setattr(metrics, "registry", [latency, escaped])
+
+    client.get("/cache_stats")
+    client.get("/extract_all_feedbacks_stream", params={"limit": 1})
+    client.get("/missing")
+
+    lines = client.get("/metrics").text.splitlines()
+
+    # The endpoint is the path of the route, without the query string
+    labels = 'method="GET",endpoint="/extract_all_feedbacks_stream",status="200"'
+    assert [line for line in lines if labels in line] == [
+        "http_request_duration_seconds_bucket{" + labels + ',le="0.5"} 1',
+        "http_request_duration_seconds_bucket{" + labels + ',le="1"} 1',
+        "http_request_duration_seconds_bucket{" + labels + ',le="+Inf"} 1',
+        line_starting(lines, "http_request_duration_seconds_sum{" + labels),
+        "http_request_duration_seconds_count{" + labels + "} 1",
+    ]
+    assert (
+        'http_request_duration_seconds_count{method="GET",endpoint="unmatched",status="404"} 1'
+        in lines
+    )
+    assert "# TYPE http_request_duration_seconds histogram" in lines
+    assert 'escaped_total{portal="data\\"sud\\\\"} 2' in lines
+
+
+def test_sql_counts_of_a_request_add_up_across_threads(monkeypatch):
+
+    monkeypatch.setattr(metrics, "enabled", True)
+    monkeypatch.setattr(
+        metrics,
+        "request_sql_statements",
+        metrics.Histogram("statements", "", ("endpoint",), [10000, 100000]),
+    )
+
+    token = metrics.start_request()
+
+    # The scoring threads of a request count their statements in a copy of its context
+    def count():
+        for i in range(10000):
+            metrics.count_sql(1, 2)
+
+    threads = [
+        threading.Thread(target=contextvars.copy_context().run, args=(count,))
+        for thread in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert metrics.request_sql_counts.get().get() == (80000, 160000)
+
+    metrics.end_request(token, "POST", "/search_reranking", 200)
+    assert metrics.request_sql_statements.values[("/search_reranking",)][1] == 80000
+
+
+def test_feedbacks_are_streamed_by_pages(client):
+
+    searches = ["search " + str(number) for number in range(7)]
+    for user_search in searches:
+        add_search(client, user_search)
+    for user_search in searches[1:4]:
+        client.post("/search_reranking", json=make_query(user_search, range(3)))
+    choose(client, "search 2", 1)
+
+    pages = []
+    after_search_id = 0
+    while True:
+        response = client.get(
+            "/extract_all_feedbacks_stream",
+            params={"after_search_id": after_search_id, "limit": 3},
+        )
+        assert response.headers["content-type"] == "application/x-ndjson"
+        # One search per line, every line ending with a newline
+        assert response.text == "" or response.text.endswith("\n")
+        page = [json.loads(line) for line in response.text.splitlines()]
+        if len(page) == 0:
+            break
+        pages.append(page)
+        after_search_id = page[-1]["search_id"]
+
+    assert [len(page) for page in pages] == [3, 3, 1]
+
+    streamed = [search for page in pages for search in page]
+    assert [search.pop("search_id") for search in streamed] == list(range(1, 8))
+    assert streamed == client.get("/extract_all_feedbacks").json()
+    assert [len(search["feedbacks"]) for search in streamed] == [0, 3, 3, 3, 0, 0, 0]
+
+    # Without a limit every search is streamed in one response
+    response = client.get("/extract_all_feedbacks_stream")
+    assert len(response.text.splitlines()) == 7
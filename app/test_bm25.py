@@ -0,0 +1,144 @@
+import math
+
+import pytest
+
+import bm25
+import connection_manager
+import main
+import sql_query
+import storage
+import vocabulary
+
+k1 = 1.2
+b = 0.75
+
+
+def make_result(number, title, description):
+
+    return main.Result(
+        title=title,
+        url="url-" + str(number),
+        description=description,
+        portal="datasud",
+    )
+
+
+def term_score(idf, frequency, length, average_length):
+
+    return (
+        idf
+        * frequency
+        * (k1 + 1)
+        / (frequency + k1 * (1 - b + b * length / average_length))
+    )
+
+
+corpus = [
+    make_result(1, "barrage", "riviere lac"),
+    make_result(2, "lac", "montagne"),
+    make_result(3, "foret", "barrage barrage foret"),
+]
+
+
+def make_index(results, field_weights):
+
+    index = bm25.BM25Index(k1, b, field_weights)
+    index.replace(
+        [
+            (sql_query.result_identity(result), bm25.fields_of_result(result))
+            for result in results
+        ]
+    )
+
+    return index
+
+
+def test_scores_match_the_bm25_formula():
+
+    index = make_index(corpus, {"title": 2})
+
+    # With titles weighing 2 the results have 4, 3 and 5 words, 4 on average.
+    # barrage is in 2 of the 3 results, twice in the first and the third, montagne once in the second only.
+    barrage_idf = math.log(1 + (3 - 2 + 0.5) / (2 + 0.5))
+    montagne_idf = math.log(1 + (3 - 1 + 0.5) / (1 + 0.5))
+    expected = [
+        term_score(barrage_idf, 2, 4, 4),
+        term_score(montagne_idf, 1, 3, 4),
+        term_score(barrage_idf, 2, 5, 4),
+    ]
+
+    scores = index.scores("barrage montagne", corpus)
+
+    assert list(scores) == pytest.approx([score / max(expected) for score in expected])
+    assert list(index.scores("barrage", corpus)) == pytest.approx(
+        [1, 0, term_score(barrage_idf, 2, 5, 4) / term_score(barrage_idf, 2, 4, 4)]
+    )
+
+
+def test_field_weights_change_the_frequencies():
+
+    results = [make_result(1, "barrage", "lac"), make_result(2, "lac", "barrage")]
+
+    # Without weights the word counts the same in the title and in the description
+    assert list(make_index(results, {}).scores("barrage", results)) == [1, 1]
+
+    # A title weighing 2 gives the first result a frequency of 2 for 3 words, the second 1 for 3 words
+    idf = math.log(1 + (2 - 2 + 0.5) / (2 + 0.5))
+    assert list(
+        make_index(results, {"title": 2}).scores("barrage", results)
+    ) == pytest.approx([1, term_score(idf, 1, 3, 3) / term_score(idf, 2, 3, 3)])
+
+
+def test_results_not_indexed_are_scored_from_their_text():
+
+    index = make_index(corpus[:2], {"title": 2})
+
+    scores = index.scores("barrage", [corpus[2], corpus[1]])
+
+    assert scores[0] == 1
+    assert scores[1] == 0
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(connection_manager, "database", str(tmp_path / "test.db"))
+    monkeypatch.setattr(bm25, "index", bm25.BM25Index(k1, b, {"title": 2}))
+    connection_manager.close_all_connections()
+    vocabulary.tags_and_groups.reset()
+
+    storage.SqliteStorage().open()
+
+    yield
+
+    connection_manager.close_all_connections()
+    vocabulary.tags_and_groups.reset()
+
+
+def test_updated_result_is_indexed_again(database):
+
+    result = make_result(1, "barrage", "riviere")
+    other = make_result(2, "lac", "montagne")
+
+    with connection_manager.transaction() as cursor:
+        result_id = sql_query.add_new_result_to_DB(cursor, result)
+        sql_query.add_new_result_to_DB(cursor, other)
+
+    assert list(bm25.index.scores("barrage", [result, other])) == [1, 0]
+
+    updated = make_result(1, "centrale", "riviere")
+    with connection_manager.transaction() as cursor:
+        sql_query.update_result_in_DB(cursor, result_id, updated)
+
+    # The previous words of the result are dropped from the index, not only the new ones added
+    assert bm25.index.postings["barrage"] == {}
+    assert len(bm25.index.document_lengths) == 2
+    assert list(bm25.index.scores("centrale", [updated, other])) == [1, 0]
+
+    # The index loaded from the database gives the same scores
+    loaded = bm25.BM25Index(k1, b, {"title": 2})
+    with connection_manager.transaction() as cursor:
+        loaded.load(cursor)
+    assert list(loaded.scores("centrale riviere", [updated, other])) == list(
+        bm25.index.scores("centrale riviere", [updated, other])
+    )
@@ -0,0 +1,125 @@
+import cache
+
+
+class Clock:
+
+    """
+    Clock moved forward by the tests
+    """
+
+    def __init__(self):
+
+        self.now = 1000.0
+
+    def __call__(self):
+
+        return self.now
+
+
+def test_least_recently_used_entry_is_evicted():
+
+    lru = cache.LRUCache(2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+
+    # Reading a makes b the least recently used entry
+    assert lru.get("a") == 1
+    lru.set("c", 3)
+
+    assert lru.get("b") is cache.missing
+    assert lru.get("a") == 1
+    assert lru.get("c") == 3
+    assert lru.stats()["evictions"] == 1
+    assert lru.stats()["entries"] == 2
+
+
+def test_entries_expire_after_the_ttl():
+
+    clock = Clock()
+    lru = cache.LRUCache(10, ttl=30, clock=clock)
+    lru.set("a", 1)
+
+    clock.now += 29
+    assert lru.get("a") == 1
+
+    clock.now += 1
+    assert lru.get("a", "expired") == "expired"
+    assert lru.stats()["entries"] == 0
+
+    # Without a ttl the entries never expire
+    lru = cache.LRUCache(10, clock=clock)
+    lru.set("a", 1)
+    clock.now += 10 ** 6
+    assert lru.get("a") == 1
+
+
+def test_hits_and_misses_are_counted():
+
+    clock = Clock()
+    lru = cache.LRUCache(10, ttl=5, clock=clock)
+    lru.set("a", 1)
+
+    lru.get("a")
+    lru.get("a")
+    lru.get("b")
+    clock.now += 5
+    lru.get("a")
+
+    assert lru.stats() == {
+        "entries": 0,
+        "max_entries": 10,
+        "hits": 2,
+        "misses": 2,
+        "evictions": 0,
+        "invalidations": 0,
+    }
+
+
+def test_groups_are_invalidated_together():
+
+    lru = cache.LRUCache(10)
+    lru.set("a", 1, groups=["barrage", "eau"])
+    lru.set("b", 2, groups=["barrage"])
+    lru.set("c", 3, groups=["eau"])
+    lru.set("d", 4)
+
+    assert lru.invalidate_groups(["barrage"]) == 2
+
+    assert lru.get("a") is cache.missing
+    assert lru.get("b") is cache.missing
+    assert lru.get("c") == 3
+    assert lru.get("d") == 4
+    assert lru.invalidate_groups(["barrage"]) == 0
+
+
+def test_groups_are_updated_in_place():
+
+    lru = cache.LRUCache(10)
+    lru.set("a", 1, groups=["barrage"])
+    lru.set("b", 2, groups=["eau"])
+
+    assert lru.update_groups(["barrage"], lambda value: value + 10) == 1
+
+    assert lru.get("a") == 11
+    assert lru.get("b") == 2
+
+
+def test_value_read_before_an_invalidation_is_not_cached():
+
+    lru = cache.LRUCache(10)
+    version = lru.version()
+
+    lru.invalidate_groups(["barrage"])
+    lru.set("a", 1, groups=["barrage"], version=version)
+    assert lru.get("a") is cache.missing
+
+    lru.set("a", 1, groups=["barrage"], version=lru.version())
+    assert lru.get("a") == 1
+
+
+def test_disabled_cache_keeps_nothing():
+
+    lru = cache.LRUCache(0)
+    lru.set("a", 1)
+
+    assert lru.get("a") is cache.missing
@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+import main
+import sql_query
+
+request_duration = 0.2
+in_flight_requests = 8
+
+
+def slow_add_new_search_query(conversation_id, user_search, portal, date):
+    time.sleep(request_duration)
+
+
+def test_requests_overlap_while_database_work_blocks(monkeypatch):
+
+    monkeypatch.setattr(sql_query, "add_new_search_query", slow_add_new_search_query)
+
+    search = main.Add_Search_Query(
+        conversation_id="conversation",
+        user_search="barrage",
+        portal="datasud",
+        date="2021-07-02 10:36:11",
+    )
+
+    async def send_requests(count):
+        start = time.perf_counter()
+        await asyncio.gather(*[main.add_search(search) for _ in range(count)])
+        return count / (time.perf_counter() - start)
+
+    single_throughput = asyncio.run(send_requests(1))
+    concurrent_throughput = asyncio.run(send_requests(in_flight_requests))
+
+    # A blocked event loop would keep the throughput at one request per request_duration
+    assert concurrent_throughput > single_throughput * in_flight_requests / 2
@@ -0,0 +1,112 @@
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import config
+import connection_manager
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(connection_manager, "database", str(tmp_path / "test.db"))
+    connection_manager.close_all_connections()
+
+    with connection_manager.transaction() as cursor:
+        cursor.execute("CREATE TABLE item(id INTEGER PRIMARY KEY, thread TEXT);")
+
+    yield
+
+    connection_manager.close_all_connections()
+
+
+def connection_of_new_thread():
+
+    connections = []
+    thread = threading.Thread(
+        target=lambda: connections.append(connection_manager.get_connection())
+    )
+    thread.start()
+    thread.join()
+
+    return connections[0]
+
+
+def test_each_thread_reuses_its_connection(database):
+
+    connection = connection_manager.get_connection()
+
+    assert connection_manager.get_connection() is connection
+    assert connection_of_new_thread() is not connection
+    assert len(connection_manager.open_connections) == 2
+
+
+def test_connections_are_set_up_for_concurrent_access(database):
+
+    connection = connection_manager.get_connection()
+
+    assert connection.execute("PRAGMA journal_mode;").fetchone() == ("wal",)
+    # NORMAL
+    assert connection.execute("PRAGMA synchronous;").fetchone() == (1,)
+    assert connection.execute("PRAGMA busy_timeout;").fetchone() == (
+        config.get_int("sqlite_busy_timeout"),
+    )
+
+
+def test_transaction_commits_or_rolls_back(database, monkeypatch):
+
+    rollbacks = []
+    monkeypatch.setattr(
+        connection_manager, "rollback_callbacks", [lambda: rollbacks.append(1)]
+    )
+
+    with connection_manager.transaction() as cursor:
+        cursor.execute("INSERT INTO item(thread) VALUES('committed');")
+
+    with pytest.raises(RuntimeError):
+        with connection_manager.transaction() as cursor:
+            cursor.execute("INSERT INTO item(thread) VALUES('rolled back');")
+            raise RuntimeError
+
+    # Another connection only sees the committed row
+    assert connection_of_new_thread().execute(
+        "SELECT thread FROM item;"
+    ).fetchall() == [("committed",)]
+    assert rollbacks == [1]
+
+
+def test_closed_connections_are_opened_again(database):
+
+    connection = connection_manager.get_connection()
+
+    connection_manager.close_all_connections()
+
+    assert connection_manager.open_connections == []
+    with pytest.raises(sqlite3.ProgrammingError):
+        connection.execute("SELECT 1;")
+
+    # The thread opens a new connection on its next request
+    with connection_manager.transaction() as cursor:
+        assert cursor.execute("SELECT COUNT(*) FROM item;").fetchone() == (0,)
+    assert connection_manager.open_connections == [connection_manager.get_connection()]
+
+
+def test_open_connections_are_bounded_by_the_threads(database):
+    def insert(number):
+        with connection_manager.transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO item(thread) VALUES(?);",
+                (threading.current_thread().name,),
+            )
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(insert, range(200)))
+
+    with connection_manager.transaction() as cursor:
+        threads = cursor.execute("SELECT COUNT(DISTINCT thread) FROM item;").fetchone()
+        assert cursor.execute("SELECT COUNT(*) FROM item;").fetchone() == (200,)
+
+    # One connection per thread of the pool, and the one of this thread
+    assert len(connection_manager.open_connections) == threads[0] + 1 <= 5
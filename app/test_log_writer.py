@@ -0,0 +1,213 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import log_writer
+import main
+import storage
+
+
+class RecordingStorage:
+
+    """
+    Storage keeping the rerankings written, the writes wait for the gate to be opened
+    """
+
+    def __init__(self):
+
+        self.rerankings = []
+        self.writing = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def store_rerankings(self, rerankings):
+
+        self.writing.set()
+        self.gate.wait()
+        self.rerankings += rerankings
+
+
+def reranking(number):
+
+    return ("conversation", "search " + str(number), [], "feedback")
+
+
+@pytest.fixture
+def recording_storage(monkeypatch):
+
+    recording_storage = RecordingStorage()
+    monkeypatch.setattr(storage, "backend", recording_storage)
+
+    return recording_storage
+
+
+def make_writer(policy, timeout=0, flush_interval=0, max_size=1):
+
+    return log_writer.LogWriter(max_size, policy, timeout, 10, flush_interval)
+
+
+def fill_queue(writer, recording_storage):
+
+    """
+    Block the writer on a first write and fill its queue of one place
+    """
+
+    recording_storage.gate.clear()
+    assert writer.submit(*reranking(0))
+    assert recording_storage.writing.wait(5)
+    assert writer.submit(*reranking(1))
+
+
+@pytest.mark.parametrize("policy", ["drop", "block"])
+def test_full_queue_drops_after_its_policy(recording_storage, policy):
+
+    writer = make_writer(policy, timeout=0.2)
+    fill_queue(writer, recording_storage)
+
+    start = time.perf_counter()
+    assert not writer.submit(*reranking(2))
+    waited = time.perf_counter() - start
+
+    # The block policy waits for a place up to its timeout, the drop policy doesn't wait
+    if policy == "block":
+        assert waited >= 0.2
+    else:
+        assert waited < 0.2
+
+    recording_storage.gate.set()
+    writer.stop()
+
+    assert [search for c, search, *other in recording_storage.rerankings] == [
+        "search 0",
+        "search 1",
+    ]
+    assert writer.stats()["dropped"] == 1
+    assert writer.stats()["written"] == 2
+
+
+def test_blocked_submission_is_queued_when_a_place_frees(recording_storage):
+
+    writer = make_writer("block", timeout=5)
+    fill_queue(writer, recording_storage)
+
+    threading.Timer(0.1, recording_storage.gate.set).start()
+    assert writer.submit(*reranking(2))
+
+    writer.stop()
+
+    assert len(recording_storage.rerankings) == 3
+    assert writer.stats()["dropped"] == 0
+
+
+def test_flush_waits_for_every_submission(recording_storage):
+
+    writer = make_writer("block", timeout=5, flush_interval=0.05, max_size=100)
+
+    for number in range(20):
+        writer.submit_batch([reranking(number), reranking(number + 100)])
+
+    writer.flush()
+
+    assert len(recording_storage.rerankings) == 40
+    assert writer.stats()["queued"] == 0
+    assert writer.stats()["written"] == 40
+
+    writer.stop()
+
+
+def test_flush_does_not_wait_for_later_submissions(recording_storage):
+
+    writer = make_writer("block", timeout=5, flush_interval=0.05, max_size=100)
+
+    recording_storage.gate.clear()
+    writer.submit(*reranking(0))
+    assert recording_storage.writing.wait(5)
+
+    flushed = threading.Event()
+    flusher = threading.Thread(target=lambda: (writer.flush(), flushed.set()))
+    flusher.start()
+    # The flush marker is queued after the first reranking, the second one after the marker
+    while writer.stats()["queued"] == 0:
+        time.sleep(0.001)
+    writer.submit(*reranking(1))
+
+    # The second reranking waits for its write while the first one is written
+    second_gate = threading.Event()
+    store_rerankings = recording_storage.store_rerankings
+    recording_storage.store_rerankings = lambda rerankings: (
+        second_gate.wait(),
+        store_rerankings(rerankings),
+    )
+    recording_storage.gate.set()
+
+    assert flushed.wait(5)
+    assert [reranking[1] for reranking in recording_storage.rerankings] == ["search 0"]
+
+    second_gate.set()
+    flusher.join()
+    writer.stop()
+    assert len(recording_storage.rerankings) == 2
+
+
+def test_counters_add_up_under_concurrent_submissions(recording_storage):
+
+    writer = make_writer("drop", max_size=10)
+    thread_count = 8
+    barrier = threading.Barrier(thread_count)
+
+    def submit():
+        barrier.wait()
+        for number in range(500):
+            writer.submit(*reranking(number))
+
+    threads = [threading.Thread(target=submit) for thread in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.flush()
+
+    stats = writer.stats()
+    assert stats["submitted"] + stats["dropped"] == thread_count * 500
+    assert stats["written"] == stats["submitted"] == len(recording_storage.rerankings)
+
+    writer.stop()
+
+
+def test_stop_writes_the_queue_and_drops_later_submissions(recording_storage):
+
+    writer = make_writer("block", timeout=5, flush_interval=0.05, max_size=100)
+
+    for number in range(5):
+        writer.submit(*reranking(number))
+
+    writer.stop()
+
+    assert len(recording_storage.rerankings) == 5
+    assert writer.thread is None
+
+    # A stopped writer is not started again by a submission
+    assert not writer.submit(*reranking(5))
+    assert writer.thread is None
+    assert writer.stats()["dropped"] == 1
+
+    writer.start()
+    assert writer.submit(*reranking(6))
+    writer.stop()
+
+    assert len(recording_storage.rerankings) == 6
+
+
+def test_writer_counters_are_served(monkeypatch):
+
+    writer = make_writer("drop")
+    writer.dropped = 3
+    monkeypatch.setattr(log_writer, "writer", writer)
+
+    assert asyncio.run(main.get_cache_stats())["log_writer"]["dropped"] == 3
+
+    metrics = asyncio.run(main.get_metrics()).body.decode()
+    assert "reranking_log_dropped_total 3" in metrics
+    assert "reranking_log_queue_depth 0" in metrics
@@ -0,0 +1,144 @@
+import time
+
+import pytest
+
+import connection_manager
+import main
+import metadata_scorer
+import storage
+import vocabulary
+
+
+def make_result(number, tags, groups=()):
+
+    return main.Result(
+        title="Résultat " + str(number),
+        url="url-" + str(number),
+        description="Description",
+        portal="datasud",
+        tags=tags,
+        groups=[{"name": group, "description": group} for group in groups],
+    )
+
+
+def make_matrix(compaction_size=1000):
+
+    matrix = metadata_scorer.AffinityMatrix(compaction_size, 0)
+    # Result 1 was chosen twice for barrage and result 2 once
+    matrix.replace(
+        [("barrage", 1, 2), ("barrage", 2, 1)],
+        {1: {("tag", "eau"), ("group", "energie")}, 2: {("tag", "eau")}},
+    )
+
+    return matrix
+
+
+def test_scores_are_the_share_of_the_chosen_results_having_the_metadata():
+
+    matrix = make_matrix()
+    results = [
+        make_result(1, ["eau"], ["energie"]),
+        make_result(2, ["eau", "autre"]),
+        make_result(3, ["autre"]),
+        make_result(4, []),
+    ]
+
+    # eau is found in the 3 chosen results, energie in 2 of them
+    assert list(matrix.scores("Barrages", results)) == pytest.approx(
+        [(1 + 2 / 3) / 2, (1 + 0) / 2, 0, 0]
+    )
+    assert list(matrix.scores("piscine", results)) == [0, 0, 0, 0]
+
+
+def test_feedbacks_are_scored_before_and_after_the_compaction():
+
+    matrix = make_matrix()
+    results = [make_result(1, ["eau"], ["energie"]), make_result(3, ["autre"])]
+
+    matrix.add_feedbacks([("barrage", results[1], 1), ("piscine", results[1], 2)])
+
+    assert matrix.pending_size == 2
+    pending_scores = list(matrix.scores("barrage", results))
+    # 4 chosen results for barrage: eau in 3, energie in 2, autre in 1
+    assert pending_scores == pytest.approx([(3 / 4 + 2 / 4) / 2, 1 / 4])
+    assert list(matrix.scores("piscine", results)) == [0, 1]
+
+    with matrix.lock:
+        matrix.compact()
+
+    assert matrix.pending == {} and matrix.pending_size == 0
+    assert list(matrix.scores("barrage", results)) == pytest.approx(pending_scores)
+    assert list(matrix.scores("piscine", results)) == [0, 1]
+
+
+def test_pending_feedbacks_are_compacted_past_compaction_size():
+
+    matrix = make_matrix(compaction_size=3)
+    results = [make_result(1, ["eau"], ["energie"]), make_result(3, ["autre"])]
+
+    matrix.add_feedbacks([("barrage", results[1], 1)])
+    assert matrix.pending_size == 1
+
+    # A removed choice lowers the counts, the result having 2 metadata reaches the compaction size
+    matrix.add_feedbacks([("barrage", results[0], -1), ("barrage", results[0], 0)])
+
+    assert matrix.pending_size == 0
+    # 3 chosen results for barrage: eau in 2, energie in 1, autre in 1
+    assert list(matrix.scores("barrage", results)) == pytest.approx(
+        [(2 / 3 + 1 / 3) / 2, 1 / 3]
+    )
+
+
+def test_feedbacks_are_ignored_until_the_matrix_is_loaded():
+
+    matrix = metadata_scorer.AffinityMatrix(1000, 0)
+
+    matrix.add_feedbacks([("barrage", make_result(1, ["eau"]), 1)])
+
+    assert matrix.pending == {} and matrix.rows == {}
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(connection_manager, "database", str(tmp_path / "test.db"))
+    monkeypatch.setattr(
+        metadata_scorer, "affinities", metadata_scorer.AffinityMatrix(1000, 0.001)
+    )
+    connection_manager.close_all_connections()
+    vocabulary.tags_and_groups.reset()
+
+    backend = storage.SqliteStorage()
+    monkeypatch.setattr(storage, "backend", backend)
+    backend.open()
+
+    yield backend
+
+    backend.close()
+    connection_manager.close_all_connections()
+    vocabulary.tags_and_groups.reset()
+
+
+def test_reloads_reuse_one_connection(database):
+
+    affinities = metadata_scorer.affinities
+    result = make_result(1, ["eau"])
+
+    database.add_search("conversation", "barrage", "datasud", "2021-07-02")
+    database.store_rerankings(
+        [("conversation", "barrage", [(result, 0, 0, "datasud")], "feedback", 1)]
+    )
+    affinities.ensure_loaded()
+    connections = len(connection_manager.open_connections)
+
+    for reload in range(20):
+        affinities.loaded_at = time.monotonic() - 1
+        affinities.ensure_loaded()
+        deadline = time.monotonic() + 10
+        while affinities.refreshing and time.monotonic() < deadline:
+            time.sleep(0.001)
+        assert not affinities.refreshing
+
+    # The reloads run on one thread, which opens a single connection
+    assert len(connection_manager.open_connections) == connections + 1
+    assert list(affinities.scores("barrage", [result])) == [1]
@@ -0,0 +1,323 @@
+import sqlite3
+
+import pytest
+
+import connection_manager
+import migrations
+import sql_query
+import vocabulary
+
+# db-SQL.txt of the first version of the API, before the migrations existed
+baseline_schema = """
+CREATE TABLE search (
+    "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+    "conversation_id" VARCHAR(255) NOT NULL,
+    "user_search" VARCHAR(255) NOT NULL,
+    "portal" VARCHAR (255) NOT NULL,
+    "date" DATETIME NOT NULL
+);
+
+CREATE TABLE search_target_feedback (
+    "search_id" INTEGER NOT NULL,
+    "search_target" VARCHAR(255) NOT NULL,
+    FOREIGN KEY ("search_id")
+        REFERENCES search ("id"),
+    PRIMARY KEY (search_id, search_target)
+);
+
+CREATE TABLE result_tag (
+    "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+    "name" VARCHAR(255) NOT NULL,
+    "portal" VARCHAR(255) NOT NULL
+);
+
+CREATE TABLE result_group (
+    "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+    "name" VARCHAR(255) NOT NULL,
+    "description" VARCHAR(255),
+    "portal" VARCHAR(255) NOT NULL
+);
+
+
+CREATE TABLE result (
+    "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+    "title" VARCHAR(255) NOT NULL,
+    "url" VARCHAR(255) NOT NULL,
+    "description" VARCHAR(255) NOT NULL,
+    "portal" VARCHAR(255) NOT NULL,
+    "owner_org" VARCHAR(255),
+    "owner_org_description" VARCHAR(255),
+    "maintainer" VARCHAR(255),
+    "dataset_publication_date" VARCHAR(255),
+    "dataset_modification_date" VARCHAR(255),
+    "metadata_creation_date" VARCHAR(255),
+    "metadata_modification_date" VARCHAR(255)
+);
+
+CREATE TABLE link_results_tags (
+    "result_id" INTEGER NOT NULL,
+    "tag_id" INTEGER NOT NULL,
+    FOREIGN KEY ("result_id")
+        REFERENCES result ("id"),
+    FOREIGN KEY ("tag_id")
+        REFERENCES result_tag ("id")
+    PRIMARY KEY (result_id, tag_id)
+);
+
+
+CREATE TABLE link_results_groups (
+    "result_id" INTEGER NOT NULL,
+    "group_id" INTEGER NOT NULL,
+    FOREIGN KEY ("result_id")
+        REFERENCES result ("id"),
+    FOREIGN KEY ("group_id")
+        REFERENCES result_group ("id")
+    PRIMARY KEY (result_id, group_id)
+);
+
+
+CREATE TABLE search_reranking_feedback (
+    "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+    "search_id" INTEGER NOT NULL,
+    "old_rank" INTEGER NOT NULL,
+    "new_rank" INTEGER NOT NULL,
+    "result_id" INTEGER NOT NULL,
+    "feedback" INTEGER NOT NULL,
+    "methods_used" VARCHAR(255) NOT NULL,
+    FOREIGN KEY ("search_id")
+        REFERENCES search ("id"),
+    FOREIGN KEY ("result_id")
+        REFERENCES result ("id")
+    );
+"""
+
+
+@pytest.fixture
+def baseline_database(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(connection_manager, "database", str(tmp_path / "baseline.db"))
+    connection_manager.close_all_connections()
+    vocabulary.tags_and_groups.reset()
+
+    sqliteConnection = sqlite3.connect(connection_manager.database)
+    sqliteConnection.executescript(baseline_schema)
+
+    yield sqliteConnection
+
+    sqliteConnection.close()
+    connection_manager.close_all_connections()
+    vocabulary.tags_and_groups.reset()
+
+
+def insert_result(sqliteConnection, title, url, tags):
+
+    result_id = sqliteConnection.execute(
+        "INSERT INTO result(title, url, description, portal) VALUES(?, ?, '', 'datasud');",
+        (title, url),
+    ).lastrowid
+
+    for tag in tags:
+        row = sqliteConnection.execute(
+            "SELECT id FROM result_tag WHERE name = ?;", (tag,)
+        ).fetchone()
+        tag_id = (
+            row[0]
+            if row is not None
+            else sqliteConnection.execute(
+                "INSERT INTO result_tag(name, portal) VALUES(?, 'datasud');", (tag,)
+            ).lastrowid
+        )
+        sqliteConnection.execute(
+            "INSERT INTO link_results_tags(result_id, tag_id) VALUES(?, ?);",
+            (result_id, tag_id),
+        )
+
+    return result_id
+
+
+def insert_feedback(sqliteConnection, search_id, result_id, feedback):
+
+    sqliteConnection.execute(
+        "INSERT INTO search_reranking_feedback(search_id, old_rank, new_rank, result_id, feedback, methods_used) "
+        "VALUES(?, 0, 0, ?, ?, 'feedback');",
+        (search_id, result_id, feedback),
+    )
+
+
+def test_duplicate_results_are_merged_by_the_identity_migration(baseline_database):
+
+    for date in ["2021-07-02", "2021-07-03"]:
+        baseline_database.execute(
+            "INSERT INTO search(conversation_id, user_search, portal, date) "
+            "VALUES('conversation', 'barrage', 'datasud', ?);",
+            (date,),
+        )
+
+    # The baseline stored a result again each time its metadata changed
+    old_id = insert_result(baseline_database, "Ancien titre", "url-0", ["ancien"])
+    new_id = insert_result(baseline_database, "Titre", "url-0", ["tag-0"])
+    other_id = insert_result(baseline_database, "Autre", "url-1", [])
+    insert_feedback(baseline_database, 1, old_id, 1)
+    insert_feedback(baseline_database, 1, new_id, 0)
+    insert_feedback(baseline_database, 2, old_id, -1)
+    insert_feedback(baseline_database, 2, other_id, 0)
+    baseline_database.commit()
+
+    migrations.run_migrations()
+
+    cursor = baseline_database.cursor()
+    assert cursor.execute("SELECT id, title FROM result ORDER BY id;").fetchall() == [
+        (new_id, "Titre"),
+        (other_id, "Autre"),
+    ]
+    # Search 1 keeps one row, which takes the feedback of the duplicate
+    assert cursor.execute(
+        "SELECT search_id, result_id, feedback FROM search_reranking_feedback ORDER BY search_id, result_id;"
+    ).fetchall() == [(1, new_id, 1), (2, new_id, -1), (2, other_id, 0)]
+    assert sorted(sql_query.get_result_tags_list(cursor, new_id)) == ["ancien", "tag-0"]
+    assert cursor.execute(
+        "SELECT result_id, chosen, ignored, total FROM feedback_aggregate ORDER BY result_id;"
+    ).fetchall() == [(new_id, 1, 1, 2), (other_id, 0, 0, 1)]
+
+
+def schema(path):
+
+    """
+    Output: dict of table -> names of its columns, and set of the names of the indexes
+    """
+
+    sqliteConnection = sqlite3.connect(path)
+
+    try:
+        tables = [
+            row[0]
+            for row in sqliteConnection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%';"
+            )
+        ]
+        columns = {
+            table: [
+                column[1]
+                for column in sqliteConnection.execute(
+                    "PRAGMA table_info({});".format(table)
+                )
+            ]
+            for table in tables
+        }
+        indexes = {
+            row[0]
+            for row in sqliteConnection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index';"
+            )
+        }
+    finally:
+        sqliteConnection.close()
+
+    return columns, indexes
+
+
+def test_baseline_database_is_upgraded_without_losing_feedbacks(
+    baseline_database, tmp_path, monkeypatch
+):
+
+    for conversation_id, user_search, date in [
+        ("conversation-1", "Barrages", "2021-07-02 10:36:11"),
+        ("conversation-2", "barrage", "2021-07-03 08:00:00"),
+        ("conversation-3", "piscine", "2021-07-04 18:30:00"),
+    ]:
+        baseline_database.execute(
+            "INSERT INTO search(conversation_id, user_search, portal, date) VALUES(?, ?, 'datasud', ?);",
+            (conversation_id, user_search, date),
+        )
+    baseline_database.execute(
+        "INSERT INTO search_target_feedback(search_id, search_target) VALUES(1, 'un barrage');"
+    )
+
+    first_id = insert_result(baseline_database, "Barrage", "url-0", ["eau", "barrage"])
+    second_id = insert_result(baseline_database, "Lac", "url-1", ["eau"])
+    baseline_database.execute(
+        "INSERT INTO result_group(name, description, portal) VALUES('environnement', 'Environnement', 'datasud');"
+    )
+    baseline_database.execute(
+        "INSERT INTO link_results_groups(result_id, group_id) VALUES(?, 1);",
+        (second_id,),
+    )
+
+    insert_feedback(baseline_database, 1, first_id, 1)
+    insert_feedback(baseline_database, 1, second_id, 0)
+    insert_feedback(baseline_database, 2, first_id, -1)
+    insert_feedback(baseline_database, 2, second_id, 1)
+    insert_feedback(baseline_database, 3, second_id, 0)
+    baseline_database.commit()
+
+    def read(query):
+        return baseline_database.execute(query).fetchall()
+
+    searches = read("SELECT * FROM search ORDER BY id;")
+    targets = read("SELECT * FROM search_target_feedback;")
+    feedbacks = read(
+        "SELECT id, search_id, old_rank, new_rank, result_id, feedback, methods_used "
+        "FROM search_reranking_feedback ORDER BY id;"
+    )
+
+    assert migrations.run_migrations() == migrations.migrations[-1][0]
+
+    assert read("PRAGMA user_version;") == [(migrations.migrations[-1][0],)]
+    assert read("SELECT * FROM search ORDER BY id;") == searches
+    assert read("SELECT * FROM search_target_feedback;") == targets
+    assert (
+        read(
+            "SELECT id, search_id, old_rank, new_rank, result_id, feedback, methods_used "
+            "FROM search_reranking_feedback ORDER BY id;"
+        )
+        == feedbacks
+    )
+    assert read("SELECT DISTINCT origin_source FROM search_reranking_feedback;") == [
+        (None,)
+    ]
+
+    cursor = baseline_database.cursor()
+    assert read("SELECT id, identity FROM result ORDER BY id;") == [
+        (first_id, sql_query.compute_result_identity("datasud", "url-0")),
+        (second_id, sql_query.compute_result_identity("datasud", "url-1")),
+    ]
+    assert sql_query.get_result_tags_list(cursor, first_id) == ["eau", "barrage"]
+    assert sql_query.get_result_groups_list(cursor, second_id) == [
+        ("environnement", "Environnement")
+    ]
+    # The frozen helpers of the migration give the fingerprints the API computes today
+    for row in read("SELECT * FROM result;"):
+        assert row[-1] == sql_query.compute_result_fingerprint(
+            row[1:12],
+            sql_query.get_result_tags_list(cursor, row[0]),
+            sql_query.get_result_groups_list(cursor, row[0]),
+        )
+
+    # Barrages and barrage are counted together once normalized
+    aggregates = read(
+        "SELECT user_search, result_id, chosen, ignored, total, decayed_total "
+        "FROM feedback_aggregate ORDER BY user_search, result_id;"
+    )
+    assert [aggregate[:5] for aggregate in aggregates] == [
+        ("barrage", first_id, 1, 1, 2),
+        ("barrage", second_id, 1, 0, 2),
+        ("piscine", second_id, 0, 0, 1),
+    ]
+    assert all(0 < aggregate[5] <= aggregate[4] for aggregate in aggregates)
+
+    # The upgraded database has the schema of a database created by the migrations
+    upgraded_database = connection_manager.database
+    monkeypatch.setattr(connection_manager, "database", str(tmp_path / "new.db"))
+    migrations.run_migrations()
+    assert schema(upgraded_database) == schema(connection_manager.database)
+
+    # Running the migrations again changes nothing
+    monkeypatch.setattr(connection_manager, "database", upgraded_database)
+    assert migrations.run_migrations() == migrations.migrations[-1][0]
+    assert (
+        read(
+            "SELECT user_search, result_id, chosen, ignored, total, decayed_total "
+            "FROM feedback_aggregate ORDER BY user_search, result_id;"
+        )
+        == aggregates
+    )
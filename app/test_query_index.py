@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+
+import query_index
+
+
+def dice(first, second):
+
+    first, second = query_index.search_grams(first), query_index.search_grams(second)
+
+    return 2 * len(first & second) / (len(first) + len(second))
+
+
+def make_index(search_keys, max_postings=1000, cache_size=0):
+
+    index = query_index.QueryIndex(max_postings, cache_size)
+    index.replace(search_keys)
+
+    return index
+
+
+def test_grams_are_trigrams_and_words():
+
+    assert query_index.search_grams("eau") == {" ea", "eau", "au ", "w:eau"}
+
+
+def test_similar_and_dissimilar_searches():
+
+    index = make_index(["barrages", "piscine", "barrage", "barrage hydraulique"])
+
+    # barrage and barrages share 6 of their 8 and 9 grams
+    assert index.similar_searches("barrage", 5, 0.6) == [
+        ("barrages", pytest.approx(12 / 17))
+    ]
+    assert index.similar_searches("piscine", 5, 0.6) == []
+    # A search missing from the index is looked up the same way
+    assert index.similar_searches("barage", 5, 0.6) == [
+        ("barrage", pytest.approx(dice("barage", "barrage")))
+    ]
+
+
+@pytest.mark.parametrize(
+    "min_similarity, expected",
+    [
+        (0.3, ["barrages", "barrage hydraulique"]),
+        (0.7, ["barrages"]),
+        # 12 / 17 = 0.706 is just below
+        (0.71, []),
+    ],
+)
+def test_dice_threshold(min_similarity, expected):
+
+    index = make_index(["barrages", "piscine", "barrage", "barrage hydraulique"])
+
+    similar = index.similar_searches("barrage", 5, min_similarity)
+
+    assert [key for key, similarity in similar] == expected
+    assert all(similarity >= min_similarity for key, similarity in similar)
+
+
+def test_prefix_filtering_finds_every_similar_search():
+
+    generator = np.random.default_rng(0)
+    words = ["eau", "barrage", "barrages", "riviere", "rivieres", "debit", "crue"]
+    search_keys = sorted(
+        {
+            " ".join(generator.choice(words, generator.integers(1, 4)))
+            for i in range(300)
+        }
+    )
+    index = make_index(search_keys)
+
+    # The candidates gathered from the rarest grams only must be the searches found by comparing every pair
+    for min_similarity in [0.2, 0.5, 0.8]:
+        for search_key in search_keys[:40]:
+            expected = sorted(
+                (
+                    (-dice(search_key, other), position, other)
+                    for position, other in enumerate(search_keys)
+                    if other != search_key and dice(search_key, other) >= min_similarity
+                )
+            )[:5]
+            assert index.similar_searches(search_key, 5, min_similarity) == [
+                (other, pytest.approx(-similarity))
+                for similarity, position, other in expected
+            ]
+
+
+def test_grams_above_max_postings_are_ignored():
+
+    search_keys = ["barrages", "barragex"]
+
+    # Every gram barrage shares with them is found in both, too common with max_postings=1
+    assert make_index(search_keys, 1).similar_searches("barrage", 5, 0.5) == []
+    assert [
+        key
+        for key, similarity in make_index(search_keys, 2).similar_searches(
+            "barrage", 5, 0.5
+        )
+    ] == ["barrages", "barragex"]
+
+
+def test_lookups_are_cached_until_a_search_is_added():
+
+    index = make_index(["barrages"], cache_size=10)
+
+    assert [key for key, s in index.similar_searches("barrage", 5, 0.6)] == ["barrages"]
+    assert [key for key, s in index.similar_searches("barrage", 5, 0.6)] == ["barrages"]
+    assert index.lookups.stats()["hits"] == 1
+
+    index.add("barrage")
+    index.add("barragex")
+
+    assert [key for key, s in index.similar_searches("barrage", 5, 0.6)] == [
+        "barrages",
+        "barragex",
+    ]
@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+import main
+import reranking
+
+
+def make_result(name):
+
+    return main.Result(
+        title=name, url="url-" + name, description=name, portal="datasud"
+    )
+
+
+results = {name: make_result(name) for name in ["r1", "r2", "r3", "r4"]}
+
+# r3 is returned by both sources, first by B
+sources = [
+    ("A", [results["r1"], results["r2"], results["r3"]]),
+    ("B", [results["r3"], results["r4"]]),
+]
+source_scores = [[0.2, 0.9, 0.5], [0.8, 0.1]]
+
+
+@pytest.mark.parametrize(
+    "strategy, source_weights, expected",
+    [
+        # A ranks r2, r3, r1 and B ranks r3, r4: r3 gets 1/62 + 1/61, r2 1/61, r4 1/62 and r1 1/63
+        ("rrf", None, ["r3", "r2", "r4", "r1"]),
+        # r3 gets 1/62 from A only, r4 nothing
+        ("rrf", {"B": 0}, ["r2", "r3", "r1", "r4"]),
+        # r3 gets 0.5 + 0.8, r2 0.9, r1 0.2 and r4 0.1
+        ("weighted", None, ["r3", "r2", "r1", "r4"]),
+        # r3 gets 0.5 + 0.1 * 0.8, r4 0.1 * 0.1
+        ("weighted", {"B": 0.1}, ["r2", "r3", "r1", "r4"]),
+    ],
+)
+def test_sources_are_fused(strategy, source_weights, expected):
+
+    fused = reranking.fuse_rankings(
+        sources, source_scores, strategy, 60, source_weights
+    )
+
+    assert [result.title for result, origin_source, old_rank in fused] == expected
+
+
+def test_fused_results_keep_their_best_origin():
+
+    fused = reranking.fuse_rankings(sources, source_scores, "rrf", 60)
+
+    assert [
+        (result.title, origin_source, old_rank)
+        for result, origin_source, old_rank in fused
+    ] == [("r3", "B", 0), ("r2", "A", 1), ("r4", "B", 1), ("r1", "A", 0)]
+
+
+@pytest.mark.parametrize("strategy", ["rrf", "weighted"])
+def test_ties_are_broken_by_origin_rank_then_source(strategy):
+
+    tied_sources = [
+        ("A", [results["r1"], results["r2"]]),
+        ("B", [results["r3"], results["r4"]]),
+    ]
+
+    fused = reranking.fuse_rankings(tied_sources, [[1, 1], [1, 1]], strategy, 60)
+
+    # Without the origin tiebreak the results of the first source would come first
+    assert [result.title for result, origin_source, old_rank in fused] == [
+        "r1",
+        "r3",
+        "r2",
+        "r4",
+    ]
+
+
+def test_single_source_keeps_the_order_of_its_scores():
+
+    fused = reranking.fuse_rankings(
+        [("A", [results["r1"], results["r2"], results["r3"], results["r1"]])],
+        [[0.5, 0.9, 0.5, 1.0]],
+        "rrf",
+        60,
+    )
+
+    # The second r1 is a duplicate of the first one and is ignored
+    assert [result.title for result, origin_source, old_rank in fused] == [
+        "r2",
+        "r1",
+        "r3",
+    ]
+
+
+@pytest.mark.parametrize("strategy", ["rrf", "weighted"])
+def test_top_k_returns_the_head_of_the_fusion(strategy):
+
+    fused = reranking.fuse_rankings(sources, source_scores, strategy, 60)
+
+    for top_k in range(1, 5):
+        assert (
+            reranking.fuse_rankings(sources, source_scores, strategy, 60, top_k=top_k)
+            == fused[:top_k]
+        )
+
+
+@pytest.mark.parametrize(
+    "scores, tiebreak, top_k, expected",
+    [
+        ([0.5, 0.9, 0.5, 0.1], None, None, [1, 0, 2, 3]),
+        ([0.5, 0.9, 0.5, 0.1], [3, 0, 1, 2], None, [1, 2, 0, 3]),
+        ([0.5, 0.9, 0.5, 0.1], None, 2, [1, 0]),
+        ([0.5, 0.9, 0.5, 0.1], [3, 0, 1, 2], 2, [1, 2]),
+        ([0.5, 0.9, 0.5, 0.1], None, 10, [1, 0, 2, 3]),
+        ([], None, 3, []),
+    ],
+)
+def test_rank_order(scores, tiebreak, top_k, expected):
+
+    assert list(reranking.rank_order(scores, tiebreak, top_k)) == expected
+
+
+def test_top_k_selection_matches_a_full_sort():
+
+    generator = np.random.default_rng(0)
+
+    for size in [1, 2, 10, 100]:
+        # Few distinct scores so that the top_k boundary often falls inside a tie
+        scores = generator.integers(0, 5, size) / 4
+        tiebreak = generator.permutation(size)
+        full_sort = np.lexsort((tiebreak, -scores))
+
+        for top_k in range(1, size + 1):
+            assert list(reranking.rank_order(scores, tiebreak, top_k)) == list(
+                full_sort[:top_k]
+            )
@@ -0,0 +1,501 @@
+import json
+import sqlite3
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+import bm25
+import cache
+import connection_manager
+import feedback_matrix
+import main
+import metadata_scorer
+import query_index
+import sql_query
+import storage
+import vocabulary
+
+
+def make_result(number, title=None, tags=None, portal="datasud"):
+
+    return main.Result(
+        title=title or "Résultat " + str(number),
+        url="url-" + str(number),
+        description="Description " + str(number),
+        portal=portal,
+        owner_org="org-" + str(number % 2),
+        tags=tags if tags is not None else ["tag-" + str(number)],
+        groups=[{"name": "groupe", "description": "Groupe"}],
+    )
+
+
+def make_feedback(result, feedback):
+
+    return main.Result_Feedback(result=result, feedback=feedback)
+
+
+def propose(backend, conversation_id, search, results_list, feedback=0):
+
+    backend.store_rerankings(
+        [
+            (
+                conversation_id,
+                search,
+                [
+                    (result, rank, rank, "datasud")
+                    for rank, result in enumerate(results_list)
+                ],
+                "feedback",
+                feedback,
+            )
+        ]
+    )
+
+
+@pytest.fixture(params=sorted(storage.backends))
+def backend(request, tmp_path, monkeypatch):
+
+    # Every backend starts empty, the sqlite one in a new database file
+    monkeypatch.setattr(connection_manager, "database", str(tmp_path / "test.db"))
+    # The feedbacks keep their full weight unless a test gives them a half-life
+    monkeypatch.setattr(sql_query, "feedback_half_life", 0)
+    connection_manager.close_all_connections()
+    vocabulary.tags_and_groups.reset()
+    cache.feedback_counts.clear()
+
+    backend = storage.backends[request.param]()
+    monkeypatch.setattr(storage, "backend", backend)
+    backend.open()
+    backend.load_indexes()
+
+    yield backend
+
+    backend.close()
+    connection_manager.close_all_connections()
+    vocabulary.tags_and_groups.reset()
+    cache.feedback_counts.clear()
+
+
+def test_proposed_results_are_counted(backend):
+
+    results = [make_result(i) for i in range(3)]
+
+    backend.add_search("conversation", "Barrages électriques", "datasud", "2021-07-02")
+    propose(backend, "conversation", "Barrages électriques", results)
+
+    assert backend.get_feedback_counts(
+        sql_query.normalize_search("barrage electrique"), results + [make_result(9)]
+    ) == [(0, 0, 1), (0, 0, 1), (0, 0, 1), (0, 0, 0)]
+
+    result_ids = backend.get_result_ids(results + [make_result(9)])
+    assert len(set(result_ids[:3])) == 3 and result_ids[3] is None
+
+
+def test_results_are_counted_once_per_search(backend):
+
+    results = [make_result(i) for i in range(2)]
+
+    backend.add_search("conversation", "barrage", "datasud", "2021-07-02")
+    propose(backend, "conversation", "barrage", results)
+    propose(backend, "conversation", "barrage", results + results)
+    propose(backend, "unknown conversation", "barrage", results)
+
+    assert backend.get_feedback_counts("barrage", results) == [(0, 0, 1), (0, 0, 1)]
+
+    backend.add_search("other conversation", "barrage", "datasud", "2021-07-03")
+    propose(backend, "other conversation", "barrage", results[:1])
+
+    assert backend.get_feedback_counts("barrage", results) == [(0, 0, 2), (0, 0, 1)]
+
+
+def test_feedbacks_move_the_counts(backend):
+
+    results = [make_result(i) for i in range(3)]
+
+    backend.add_search("conversation", "barrage", "datasud", "2021-07-02")
+    propose(backend, "conversation", "barrage", results)
+
+    backend.update_feedback(
+        "conversation",
+        "barrage",
+        "target",
+        [make_feedback(results[0], 1), make_feedback(results[1], -1)],
+    )
+    assert backend.get_feedback_counts("barrage", results) == [
+        (1, 0, 1),
+        (0, 1, 1),
+        (0, 0, 1),
+    ]
+
+    backend.update_feedback(
+        "conversation", "barrage", "target", [make_feedback(results[0], -1)]
+    )
+    assert backend.get_feedback_counts("barrage", results) == [
+        (0, 1, 1),
+        (0, 1, 1),
+        (0, 0, 1),
+    ]
+
+    # A feedback on a result that was never proposed for the search is not counted
+    backend.update_feedback(
+        "conversation", "barrage", "target", [make_feedback(make_result(9), 1)]
+    )
+    assert backend.get_feedback_counts("barrage", [make_result(9)]) == [(0, 0, 0)]
+
+
+def limit_sql_variables(backend):
+
+    """
+    Give the connection of the sqlite backend the limit of bound parameters of older sqlite versions
+    """
+
+    if isinstance(backend, storage.SqliteStorage):
+        connection_manager.get_connection().setlimit(
+            sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999
+        )
+
+
+def test_large_batches_are_stored_and_read(backend, capsys):
+
+    results = [make_result(i) for i in range(1100)]
+    searches = ["search " + str(i) for i in range(320)]
+
+    for search in searches:
+        backend.add_search("conversation", search, "datasud", "2021-07-02")
+    # The results are stored by the first reranking of 1100 results and looked up by the second one
+    limit_sql_variables(backend)
+    backend.store_rerankings(
+        [
+            (
+                "conversation",
+                search,
+                [
+                    (result, rank, rank, "datasud")
+                    for rank, result in enumerate(
+                        results if search in searches[:2] else results[:1]
+                    )
+                ],
+                "feedback",
+                0,
+            )
+            for search in searches
+        ]
+    )
+
+    assert None not in backend.get_result_ids(results)
+    # The errors of the queries are printed and not raised
+    assert "too many SQL variables" not in capsys.readouterr().out
+    counts = backend.get_feedback_counts_batch(
+        [(sql_query.normalize_search(searches[0]), results)]
+        + [(sql_query.normalize_search(search), results[:2]) for search in searches]
+    )
+
+    assert counts[0] == [(0, 0, 1)] * 1100
+    assert counts[1:] == [[(0, 0, 1), (0, 0, 1)]] * 2 + [[(0, 0, 1), (0, 0, 0)]] * 318
+
+
+def test_counts_can_be_filtered_by_portal(backend):
+
+    results = [make_result(0)]
+
+    backend.add_search("conversation 1", "barrage", "datasud", "2021-07-02")
+    backend.add_search("conversation 2", "barrage", "other", "2021-07-02")
+    propose(backend, "conversation 1", "barrage", results, feedback=1)
+    propose(backend, "conversation 2", "barrage", results)
+
+    assert backend.get_feedback_counts("barrage", results) == [(1, 0, 2)]
+    assert backend.get_feedback_counts("barrage", results, "datasud") == [(1, 0, 1)]
+    assert backend.get_feedback_counts("barrage", results, "other") == [(0, 0, 1)]
+    assert backend.get_feedback_counts("barrage", results, "none") == [(0, 0, 0)]
+
+
+def test_feedbacks_decay_with_the_age_of_their_search(backend, monkeypatch):
+
+    monkeypatch.setattr(sql_query, "feedback_half_life", 30)
+    results = [make_result(0)]
+
+    for conversation_id, age in [("old", 30), ("recent", 0)]:
+        backend.add_search(
+            conversation_id,
+            "barrage",
+            "datasud",
+            str(date.today() - timedelta(days=age)),
+        )
+    propose(backend, "old", "barrage", results, feedback=1)
+    propose(backend, "recent", "barrage", results)
+
+    # The day of the search is its midnight, the counts decay a little during the day
+    chosen, ignored, total = backend.get_feedback_counts("barrage", results)[0]
+    assert (chosen, ignored, total) == (
+        pytest.approx(0.5, rel=0.05),
+        0,
+        pytest.approx(1.5, rel=0.05),
+    )
+
+    # Moving the feedback of the old search removes what it added
+    backend.update_feedback("old", "barrage", "", [make_feedback(results[0], -1)])
+    chosen, ignored, total = backend.get_feedback_counts("barrage", results)[0]
+    assert chosen == pytest.approx(0, abs=1e-9)
+    assert ignored == pytest.approx(0.5, rel=0.05)
+
+    if isinstance(backend, storage.SqliteStorage):
+        # Rebuilding the aggregates from the history gives the same counts
+        with connection_manager.transaction() as cursor:
+            sql_query.rebuild_feedback_aggregates(cursor)
+        assert backend.get_feedback_counts("barrage", results)[0] == pytest.approx(
+            (chosen, ignored, total)
+        )
+
+
+def test_updated_results_keep_their_id(backend):
+
+    backend.add_search("conversation", "barrage", "datasud", "2021-07-02")
+    propose(backend, "conversation", "barrage", [make_result(0)])
+    result_ids = backend.get_result_ids([make_result(0)])
+
+    updated = make_result(0, title="Nouveau titre", tags=["nouveau"])
+    backend.add_search("conversation", "centrale", "datasud", "2021-07-03")
+    propose(backend, "conversation", "centrale", [updated])
+
+    assert backend.get_result_ids([updated]) == result_ids
+
+    extraction = backend.extract_feedbacks()
+    assert extraction[0]["feedbacks"][0]["result"]["title"] == "Nouveau titre"
+    assert extraction[0]["feedbacks"][0]["result"]["tags"] == ["nouveau"]
+
+
+def test_update_keeps_the_links_it_is_not_sent(backend, monkeypatch):
+
+    backend.add_search("conversation", "barrage", "datasud", "2021-07-02")
+    propose(backend, "conversation", "barrage", [make_result(0, tags=["eau", "a"])])
+
+    updated = main.Result(
+        **dict(make_result(0, title="Nouveau titre").dict(), tags=None, groups=None)
+    )
+    propose(backend, "conversation", "barrage", [updated])
+
+    exported = backend.extract_feedbacks()[0]["feedbacks"][0]["result"]
+    assert exported["title"] == "Nouveau titre"
+    assert exported["tags"] == ["eau", "a"]
+    assert exported["groups"] == [{"name": "groupe", "description": "Groupe"}]
+    # The result is indexed with the tags it kept
+    assert list(bm25.index.scores("eau", [updated, make_result(1)])) == [1, 0]
+
+    # The same result sent again is not seen as changed
+    indexed = []
+    with monkeypatch.context() as patch:
+        patch.setattr(bm25.index, "add", indexed.append)
+        propose(backend, "conversation", "barrage", [updated])
+    assert indexed == []
+
+    # Empty lists remove the links, a new list replaces them
+    emptied = main.Result(
+        **dict(
+            make_result(0, tags=[]).dict(),
+            groups=[{"name": "autre", "description": "Autre"}],
+        )
+    )
+    propose(backend, "conversation", "barrage", [emptied])
+
+    exported = backend.extract_feedbacks()[0]["feedbacks"][0]["result"]
+    assert not exported["tags"]
+    assert exported["groups"] == [{"name": "autre", "description": "Autre"}]
+
+
+def test_extraction(backend):
+
+    results = [make_result(i) for i in range(2)]
+
+    for i in range(5):
+        backend.add_search(
+            "conversation", "search " + str(i), "datasud", "2021-07-0" + str(i)
+        )
+    propose(backend, "conversation", "search 1", results)
+    backend.update_feedback(
+        "conversation", "search 1", "target", [make_feedback(results[1], 1)]
+    )
+
+    page = backend.get_feedback_extraction_page(0, 2)
+    assert [search["user_search"] for search in page] == ["search 0", "search 1"]
+
+    search = page[1]
+    assert (search["search_target"], search["portal"], search["date"]) == (
+        "target",
+        "datasud",
+        "2021-07-01",
+    )
+    assert [
+        (
+            feedback["result"]["url"],
+            feedback["old_rank"],
+            feedback["feedback"],
+            feedback["methods_used"],
+            feedback["origin_source"],
+        )
+        for feedback in search["feedbacks"]
+    ] == [
+        ("url-0", 0, 0, "feedback", "datasud"),
+        ("url-1", 1, 1, "feedback", "datasud"),
+    ]
+    assert search["feedbacks"][0]["result"]["groups"] == [
+        {"name": "groupe", "description": "Groupe"}
+    ]
+    assert search["feedbacks"][0]["result"]["owner_org"] == "org-0"
+
+    next_page = backend.get_feedback_extraction_page(page[-1]["search_id"], 10)
+    assert [search["user_search"] for search in next_page] == [
+        "search 2",
+        "search 3",
+        "search 4",
+    ]
+    assert backend.get_feedback_extraction_page(next_page[-1]["search_id"]) == []
+
+    extraction = backend.extract_feedbacks()
+    assert len(extraction) == 5 and "search_id" not in extraction[0]
+    assert extraction[0]["search_target"] == "" and extraction[0]["feedbacks"] == []
+
+
+def test_extraction_can_be_imported(backend):
+
+    results = [make_result(0), make_result(1)]
+
+    backend.add_search("conversation", "barrage", "datasud", "2021-07-02")
+    propose(backend, "conversation", "barrage", results)
+    backend.update_feedback(
+        "conversation", "barrage", "target", [make_feedback(results[0], 1)]
+    )
+
+    lines = [json.dumps(search) for search in backend.get_feedback_extraction_page()]
+    lines += [
+        "",
+        '{"user_search": "centrale", "portal": "datasud", "date": "2021-07-03"}',
+    ]
+
+    # Every search with feedbacks fills a chunk of one feedback
+    importer = main.FeedbackImport("import", 1)
+    for line in lines:
+        chunk = importer.add_line(line)
+        if chunk is not None:
+            importer.store(chunk)
+    importer.store(importer.take_chunk())
+
+    assert importer.report() == {"searches_imported": 2, "feedbacks_imported": 2}
+    assert backend.get_feedback_counts("barrage", results) == [(2, 0, 2), (0, 0, 2)]
+
+    extraction = backend.extract_feedbacks()
+    assert len(extraction) == 3 and extraction[1] == extraction[0]
+    assert extraction[2]["user_search"] == "centrale"
+    assert extraction[2]["feedbacks"] == []
+
+    with pytest.raises(ValueError, match="line 1"):
+        main.FeedbackImport("import", 1).add_line('{"user_search": "barrage"}')
+
+
+def test_feedback_matrix_export(backend, tmp_path):
+
+    results = [make_result(i) for i in range(4)]
+
+    backend.add_search("conversation 1", "Pollution de l'air", "datasud", "2021-07-02")
+    backend.add_search("conversation 2", "barrage", "datasud", "2021-07-02")
+    backend.add_search("conversation 3", "barrage", "other", "2021-07-03")
+    propose(backend, "conversation 1", "Pollution de l'air", results[:2], feedback=1)
+    propose(backend, "conversation 2", "barrage", results[1:])
+    propose(backend, "conversation 3", "barrage", results[2:])
+    backend.update_feedback(
+        "conversation 2",
+        "barrage",
+        "target",
+        [make_feedback(results[2], 1), make_feedback(results[3], -1)],
+    )
+    backend.update_feedback(
+        "conversation 3", "barrage", "target", [make_feedback(results[2], 1)]
+    )
+
+    report = backend.export_feedback_matrix(tmp_path / "matrix", chunk_size=2)
+    assert report == {"queries": 2, "results": 4, "entries": 4}
+
+    matrix = feedback_matrix.load_feedback_matrix(tmp_path / "matrix")
+    assert isinstance(matrix["indices"], np.memmap)
+    assert matrix["queries"] == ["barrage", "pollution air"]
+    assert [result["url"] for result in matrix["results"]] == [
+        "url-0",
+        "url-1",
+        "url-2",
+        "url-3",
+    ]
+
+    # Result 1 was proposed for barrage without feedback, it has no entry in its row
+    assert list(matrix["indptr"]) == [0, 2, 4]
+    assert list(matrix["indices"]) == [2, 3, 0, 1]
+    assert list(matrix["chosen"]) == [2, 0, 1, 1]
+    assert list(matrix["ignored"]) == [0, 1, 0, 0]
+
+
+def test_indexes_are_loaded_from_the_storage(backend):
+
+    results = [make_result(0, tags=["énergie"]), make_result(1, tags=["eau"])]
+
+    backend.add_search("conversation", "barrage hydraulique", "datasud", "1")
+    propose(backend, "conversation", "barrage hydraulique", results)
+    backend.update_feedback(
+        "conversation", "barrage hydraulique", "", [make_feedback(results[0], 1)]
+    )
+
+    backend.load_indexes()
+
+    assert [
+        search_key
+        for search_key, similarity in query_index.searches.similar_searches(
+            "barrage", 5, 0.1
+        )
+    ] == ["barrage hydraulique"]
+    scores = metadata_scorer.affinities.scores("barrage hydraulique", results)
+    assert scores[0] > scores[1]
+
+
+def test_maintenance_removes_the_rows_of_missing_results(backend):
+
+    results = [make_result(0), make_result(1)]
+
+    backend.add_search("conversation", "barrage", "datasud", "2021-07-02")
+    propose(backend, "conversation", "barrage", results)
+    backend.update_feedback(
+        "conversation", "barrage", "target", [make_feedback(results[0], 1)]
+    )
+
+    if isinstance(backend, storage.SqliteStorage):
+        # Rows left by a result deleted by hand, and a tag linked to no result
+        with connection_manager.transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO link_results_tags(result_id, tag_id) "
+                "VALUES(999, (SELECT id FROM result_tag WHERE name = 'tag-0'));"
+            )
+            cursor.execute(
+                "INSERT INTO link_results_groups(result_id, group_id) VALUES(999, 1);"
+            )
+            cursor.execute(
+                "INSERT INTO feedback_aggregate(user_search, portal, result_id, chosen, ignored, total) "
+                "VALUES('barrage', 'datasud', 999, 1, 0, 1);"
+            )
+            cursor.execute(
+                "INSERT INTO result_tag(name, portal) VALUES('orphelin', 'datasud');"
+            )
+
+    report = backend.run_maintenance(vacuum_min_free=0)
+
+    if isinstance(backend, storage.SqliteStorage):
+        assert (report["links_removed"], report["aggregates_removed"]) == (2, 1)
+        assert report["vacuumed"]
+
+        # The other workers may still hold the id of the tag in their vocabulary
+        with connection_manager.transaction() as cursor:
+            assert cursor.execute(
+                "SELECT COUNT(*) FROM result_tag WHERE name = 'orphelin';"
+            ).fetchone() == (1,)
+
+    assert backend.get_feedback_counts("barrage", results) == [(1, 0, 1), (0, 0, 1)]
+    assert [
+        feedback["result"]["tags"]
+        for feedback in backend.extract_feedbacks()[0]["feedbacks"]
+    ] == [["tag-0"], ["tag-1"]]
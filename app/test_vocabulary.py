@@ -0,0 +1,153 @@
+import threading
+
+import pytest
+
+import connection_manager
+import main
+import sql_query
+import storage
+import vocabulary
+
+
+def make_result(number, tags, portal="datasud"):
+
+    return main.Result(
+        title="Résultat " + str(number),
+        url="url-" + str(number),
+        description="Description",
+        portal=portal,
+        tags=tags,
+        groups=[{"name": "groupe", "description": "Groupe"}],
+    )
+
+
+def add_result(result):
+
+    with connection_manager.transaction() as cursor:
+        return sql_query.add_new_result_to_DB(cursor, result)
+
+
+def table(name):
+
+    with connection_manager.transaction() as cursor:
+        return cursor.execute("SELECT * FROM " + name + " ORDER BY id;").fetchall()
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(connection_manager, "database", str(tmp_path / "test.db"))
+    connection_manager.close_all_connections()
+    vocabulary.tags_and_groups.reset()
+
+    storage.SqliteStorage().open()
+
+    yield
+
+    connection_manager.close_all_connections()
+    vocabulary.tags_and_groups.reset()
+
+
+def test_tags_and_groups_are_reused(database):
+
+    add_result(make_result(1, ["eau", "barrage"]))
+    add_result(make_result(2, ["barrage", "riviere"]))
+    # Tags are stored per portal
+    add_result(make_result(3, ["eau"], portal="other"))
+
+    assert table("result_tag") == [
+        (1, "eau", "datasud"),
+        (2, "barrage", "datasud"),
+        (3, "riviere", "datasud"),
+        (4, "eau", "other"),
+    ]
+    assert len(table("result_group")) == 2
+
+    tags = vocabulary.tags_and_groups
+    assert tags.get_tag_id("barrage", "datasud") == 2
+    assert tags.get_tag_id("eau", "other") == 4
+    assert tags.get_tag_id("eau") == 1
+    assert tags.get_tag_name(3) == "riviere"
+    assert tags.get_group_id("groupe", "Groupe", "other") == 2
+    assert tags.get_group_data(1) == ("groupe", "Groupe")
+
+
+def test_vocabulary_is_loaded_from_the_database(database):
+
+    result_id = add_result(make_result(1, ["eau", "barrage"]))
+    vocabulary.tags_and_groups.reset()
+
+    add_result(make_result(2, ["barrage"]))
+
+    assert vocabulary.tags_and_groups.loaded
+    assert len(table("result_tag")) == 2
+    assert vocabulary.tags_and_groups.get_tag_id("eau", "datasud") == 1
+
+    with connection_manager.transaction() as cursor:
+        assert sql_query.get_result_tags_list(cursor, result_id) == ["eau", "barrage"]
+
+
+def test_rolled_back_tags_are_forgotten(database):
+
+    add_result(make_result(1, ["eau"]))
+
+    with pytest.raises(RuntimeError):
+        with connection_manager.transaction() as cursor:
+            sql_query.add_new_result_to_DB(cursor, make_result(2, ["barrage"]))
+            raise RuntimeError
+
+    assert vocabulary.tags_and_groups.get_tag_id("barrage", "datasud") is None
+
+    # The tag gets an id of a row of the table, not the one of the rolled back insert
+    add_result(make_result(2, ["barrage"]))
+    tag_id = vocabulary.tags_and_groups.get_tag_id("barrage", "datasud")
+    assert (tag_id, "barrage", "datasud") in table("result_tag")
+
+
+def test_concurrent_inserts_share_the_tags(database):
+
+    thread_count = 8
+    barrier = threading.Barrier(thread_count)
+    errors = []
+
+    def insert_results(thread):
+        barrier.wait()
+        try:
+            for number in range(10):
+                add_result(
+                    make_result(
+                        thread * 100 + number,
+                        ["eau", "barrage", "tag-" + str(number % 3)],
+                    )
+                )
+        except Exception as error:
+            errors.append(error)
+
+    threads = [
+        threading.Thread(target=insert_results, args=(thread,))
+        for thread in range(thread_count)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(name for tag_id, name, portal in table("result_tag")) == [
+        "barrage",
+        "eau",
+        "tag-0",
+        "tag-1",
+        "tag-2",
+    ]
+    assert len(table("result_group")) == 1
+
+    # Every result is linked to its three tags, all of them stored
+    with connection_manager.transaction() as cursor:
+        assert cursor.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT result_id) FROM link_results_tags "
+            "WHERE tag_id IN (SELECT id FROM result_tag);"
+        ).fetchone() == (thread_count * 10 * 3, thread_count * 10)
+
+    for tag_id, name, portal in table("result_tag"):
+        assert vocabulary.tags_and_groups.get_tag_id(name, portal) == tag_id
@@ -0,0 +1,138 @@
+import threading
+
+import connection_manager
+
+
+class TagGroupVocabulary:
+
+    """
+    In-memory copy of the result_tag and result_group tables, mapping names to ids and ids to names.
+    These tables are small and only grow, so tags and groups are resolved without querying the database.
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.tag_ids = {}  # (name, portal) -> id
+        self.tag_ids_by_name = {}  # name -> id of the first tag with that name
+        self.tag_names = {}  # id -> name
+        self.group_ids = {}  # (name, description, portal) -> id
+        self.group_ids_by_data = (
+            {}
+        )  # (name, description) -> id of the first group with that name and description
+        self.group_data = {}  # id -> (name, description)
+
+    def ensure_loaded(self, cursor):
+
+        """
+        Load the tables on the first use
+
+        Input:  cursor: connection to database
+        """
+
+        if not self.loaded:
+            self.load(cursor)
+
+    def load(self, cursor):
+
+        """
+        Replace the vocabulary by the content of the database
+
+        Input:  cursor: connection to database
+        """
+
+        tags = cursor.execute(
+            "SELECT id, name, portal FROM result_tag ORDER BY id;"
+        ).fetchall()
+        groups = cursor.execute(
+            "SELECT id, name, description, portal FROM result_group ORDER BY id;"
+        ).fetchall()
+
+        with self.lock:
+
+            self.clear()
+
+            for tag_id, name, portal in tags:
+                self.store_tag(tag_id, name, portal)
+            for group_id, name, description, portal in groups:
+                self.store_group(group_id, name, description, portal)
+
+            self.loaded = True
+
+    def clear(self):
+
+        self.tag_ids = {}
+        self.tag_ids_by_name = {}
+        self.tag_names = {}
+        self.group_ids = {}
+        self.group_ids_by_data = {}
+        self.group_data = {}
+
+    def reset(self):
+
+        """
+        Forget the vocabulary, it is loaded again on its next use
+        """
+
+        with self.lock:
+            self.loaded = False
+            self.clear()
+
+    def store_tag(self, tag_id, name, portal):
+
+        self.tag_ids[(name, portal)] = tag_id
+        self.tag_ids_by_name.setdefault(name, tag_id)
+        self.tag_names[tag_id] = name
+
+    def store_group(self, group_id, name, description, portal):
+
+        self.group_ids[(name, description, portal)] = group_id
+        self.group_ids_by_data.setdefault((name, description), group_id)
+        self.group_data[group_id] = (name, description)
+
+    def add_tag(self, tag_id, name, portal):
+
+        """
+        Add a tag stored in the database
+        """
+
+        with self.lock:
+            if self.loaded:
+                self.store_tag(tag_id, name, portal)
+
+    def add_group(self, group_id, name, description, portal):
+
+        """
+        Add a group stored in the database
+        """
+
+        with self.lock:
+            if self.loaded:
+                self.store_group(group_id, name, description, portal)
+
+    def get_tag_id(self, name, portal=None):
+
+        if portal is None:
+            return self.tag_ids_by_name.get(name)
+        return self.tag_ids.get((name, portal))
+
+    def get_tag_name(self, tag_id):
+
+        return self.tag_names.get(tag_id)
+
+    def get_group_id(self, name, description, portal=None):
+
+        if portal is None:
+            return self.group_ids_by_data.get((name, description))
+        return self.group_ids.get((name, description, portal))
+
+    def get_group_data(self, group_id):
+
+        return self.group_data.get(group_id)
+
+
+tags_and_groups = TagGroupVocabulary()
+
+# Tags and groups inserted by a transaction that rolls back must not stay in the vocabulary
+connection_manager.rollback_callbacks.append(tags_and_groups.reset)